@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+from db_connection import connect
+from synthetic_fhir import generate_dataset, start_binary_server, DEFAULT_URL_FRACTION, DEFAULT_ATTACHMENT_SIZE, DEFAULT_BINARY_PORT
+
+# Benchmark the importers against synthetic data: each stage runs in a fresh process
+# inside a scratch directory, so it gets its own healthcare.db path, its own log
+# files and a peak RSS that only counts that importer.
+
+# Stages in run order; binaries fetches the URL references the documents stage imported
+STAGES = ('Medication', 'MedicationRequest', 'MedicationAdministration', 'documents', 'binaries')
+
+# How each stage is run, for the report
+IMPORTERS = {
+    'Medication': 'import_json_data.import_ndjson_file',
+    'MedicationRequest': 'import_json_data.import_ndjson_file',
+    'MedicationAdministration': 'import_json_data.import_ndjson_file',
+    'documents': 'import_document_reference.import_document_references{mode}',
+    'binaries': 'extract_binary_content.process_url_references{mode}',
+}
+
+# Version of the JSON report layout
+REPORT_FORMAT = 1
+
+# Peak resident set size of this process and of its largest finished child, in MiB
+def peak_rss_mb():
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return round(own / 2 ** 20, 1), round(children / 2 ** 20, 1)
+
+# Size of the database including its WAL, in bytes
+def database_size(db_path):
+    return sum(os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path))
+
+# Run one stage in the scratch directory and send back (records, seconds, peak RSS, worker peak RSS).
+# Runs in a spawned process: the importers are imported only after the chdir, so their log files
+# and the relative healthcare.db path land in the scratch directory
+def run_stage(stage, workdir, data_dir, options, results):
+    os.chdir(workdir)
+    # Keep anything the importers print out of the benchmark report
+    sys.stdout = open(f'{stage}.out', 'w')
+    try:
+        if stage in ('Medication', 'MedicationRequest', 'MedicationAdministration'):
+            from db_connection import get_connection
+            from import_json_data import import_ndjson_file, BULK_RESOURCES
+            _, table, columns, extract = next(entry for entry in BULK_RESOURCES if entry[0] == stage)
+            conn = get_connection(row_factory=None)
+            start = time.perf_counter()
+            stats = import_ndjson_file(conn, os.path.join(data_dir, 'medications', f'{stage}.ndjson'), stage, table,
+                                       columns, extract, options['batch_size'], workers=options['workers'])
+            seconds = time.perf_counter() - start
+            conn.close()
+            records = stats['inserted'] + stats['updated']
+        elif stage == 'documents':
+            from fhir_stream import iter_resources
+            import import_document_reference as importer
+            doc_references = iter_resources(os.path.join(data_dir, 'DocumentReference.json'), 'DocumentReference')
+            start = time.perf_counter()
+            if options['document_mode'] == 'parallel':
+                records, _ = importer.import_document_references_parallel(
+                    doc_references, options['chunk_size'], max(options['workers'], 1))
+            elif options['document_mode'] == 'bulk':
+                records, _ = importer.import_document_references_bulk(doc_references, options['chunk_size'])
+            else:
+                records, _ = importer.import_document_references(doc_references)
+            seconds = time.perf_counter() - start
+        elif stage == 'binaries':
+            import extract_binary_content as fetcher
+            start = time.perf_counter()
+            if options['concurrency'] > 1:
+                records, _ = fetcher.process_url_references_concurrent(options['concurrency'])
+            else:
+                records, _ = fetcher.process_url_references()
+            seconds = time.perf_counter() - start
+        else:
+            raise ValueError(f"Unknown stage {stage}")
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+    results.send((records, seconds) + peak_rss_mb())
+
+# Run a stage in a fresh process and return its result entry
+def benchmark_stage(stage, workdir, data_dir, options):
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_stage, args=(stage, workdir, data_dir, options, sender))
+    process.start()
+    sender.close()
+    try:
+        records, seconds, rss, worker_rss = receiver.recv()
+    except EOFError:
+        records = seconds = rss = worker_rss = None
+    process.join()
+    if process.exitcode != 0 or records is None:
+        raise RuntimeError(f"Stage {stage} failed (exit code {process.exitcode}); see {workdir}/{stage}.out")
+
+    mode = ''
+    if stage == 'documents' and options['document_mode'] != 'serial':
+        mode = '_' + options['document_mode']
+    elif stage == 'binaries' and options['concurrency'] > 1:
+        mode = '_concurrent'
+    return {
+        'stage': stage,
+        'importer': IMPORTERS[stage].format(mode=mode),
+        'records': records,
+        'seconds': round(seconds, 3),
+        'records_per_sec': round(records / seconds, 1) if seconds else None,
+        'peak_rss_mb': rss,
+        'worker_peak_rss_mb': worker_rss or None,
+        'db_bytes': database_size(os.path.join(workdir, 'healthcare.db')),
+    }
+
+# Short git revision of the working tree, or None outside a checkout
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Generate (or reuse) the data set and run the stages against a fresh database; returns the report
+def run_benchmark(scale, stages=STAGES, data_dir=None, workdir=None, options=None, seed=0,
+                  url_fraction=DEFAULT_URL_FRACTION, attachment_size=DEFAULT_ATTACHMENT_SIZE,
+                  binary_port=DEFAULT_BINARY_PORT, label=None, log=print):
+    options = dict(options or {})
+    data_dir = os.path.abspath(data_dir or os.path.join(workdir, 'data'))
+    db_path = os.path.join(workdir, 'healthcare.db')
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+    generate_start = time.perf_counter()
+    dataset = generate_dataset(data_dir, scale, seed, url_fraction, attachment_size, binary_port, log)
+    generate_seconds = time.perf_counter() - generate_start
+
+    # Create the schema up front so migrations don't count against the first stage
+    connect(db_path).close()
+
+    server = start_binary_server(binary_port) if 'binaries' in stages else None
+    results = []
+    try:
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+            log(f"Running {stage}...")
+            result = benchmark_stage(stage, workdir, data_dir, options)
+            log(f"  {result['records']} records in {result['seconds']:.2f}s "
+                f"({result['records_per_sec'] or 0:.0f}/s), peak RSS {result['peak_rss_mb']} MiB, "
+                f"database {result['db_bytes'] / 1024 / 1024:.1f} MiB")
+            results.append(result)
+    finally:
+        if server:
+            server.shutdown()
+
+    return {
+        'format': REPORT_FORMAT,
+        'label': label,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'dataset': dataset,
+        'generate_seconds': round(generate_seconds, 1),
+        'options': options,
+        'results': results,
+    }
+
+# Print records/sec, peak RSS and database size of each stage next to a baseline report
+def print_comparison(report, baseline):
+    before = {result['stage']: result for result in baseline['results']}
+    print(f"Compared with {baseline.get('label') or baseline.get('git_revision') or 'baseline'} "
+          f"(scale {baseline['dataset']['params']['scale']}):")
+    print(f"{'stage':26} {'records/s':>25} {'peak RSS MiB':>25} {'database MiB':>25}")
+    for result in report['results']:
+        old = before.get(result['stage'])
+        if not old:
+            print(f"{result['stage']:26} (not in baseline)")
+            continue
+
+        def column(key, scale=1):
+            new_value, old_value = result[key], old[key]
+            if new_value is None or old_value is None:
+                return f"{'-':>25}"
+            change = f"{(new_value - old_value) / old_value * 100:+.0f}%" if old_value else ''
+            return f"{old_value / scale:>8.1f} ->{new_value / scale:>8.1f} {change:>5}"
+        print(f"{result['stage']:26} {column('records_per_sec')} {column('peak_rss_mb')} "
+              f"{column('db_bytes', 1024 * 1024)}")
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the importers on synthetic FHIR data: records/sec, peak RSS and database size per stage')
+    parser.add_argument('--scale', type=int, default=10000,
+                        help='Documents, medication requests and administrations to generate, 10k to 10M (default: 10000)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f'Comma-separated stages to run (default: {",".join(STAGES)})')
+    parser.add_argument('--data-dir',
+                        help='Keep generated data here and reuse it on later runs with the same parameters')
+    parser.add_argument('--workdir', help='Scratch directory for the database and logs (default: a temporary one)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary scratch directory')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the generator (default: 0)')
+    parser.add_argument('--url-fraction', type=float, default=DEFAULT_URL_FRACTION,
+                        help=f'Share of documents referencing a Binary URL (default: {DEFAULT_URL_FRACTION})')
+    parser.add_argument('--attachment-size', type=int, default=DEFAULT_ATTACHMENT_SIZE,
+                        help=f'Approximate bytes per inline attachment (default: {DEFAULT_ATTACHMENT_SIZE})')
+    parser.add_argument('--binary-port', type=int, default=DEFAULT_BINARY_PORT,
+                        help=f'Port for the local Binary server (default: {DEFAULT_BINARY_PORT})')
+    parser.add_argument('--document-mode', choices=('serial', 'bulk', 'parallel'), default='bulk',
+                        help='How DocumentReferences are imported (default: bulk)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Extraction worker processes for the medication and parallel document imports (default: 0)')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='Rows per transaction for the medication imports (default: 5000)')
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='Documents per transaction in bulk document imports (default: 5000)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Concurrent Binary fetches; 1 uses the sequential fetcher (default: 16)')
+    parser.add_argument('--label', help='Name for this run in the report, e.g. a release')
+    parser.add_argument('--output', help='Write the JSON report here (- for stdout)')
+    parser.add_argument('--compare', help='Earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    options = {
+        'document_mode': args.document_mode,
+        'workers': args.workers,
+        'batch_size': args.batch_size,
+        'chunk_size': args.chunk_size,
+        'concurrency': args.concurrency,
+    }
+    # Progress goes to stderr when the report itself goes to stdout
+    log = (lambda message: print(message, file=sys.stderr)) if args.output == '-' else print
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ingest_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        report = run_benchmark(args.scale, stages, args.data_dir, os.path.abspath(workdir), options, args.seed,
+                               args.url_fraction, args.attachment_size, args.binary_port, args.label, log)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            log(f"Scratch directory kept at {workdir}")
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        log(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
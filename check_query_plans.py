@@ -0,0 +1,145 @@
+import re
+import sys
+import sqlite3
+import argparse
+from db_connection import connect
+from schema_migrations import migrate
+
+# The lookups the importers, viewer, search and fetcher run, with sample parameters.
+# Each must be answered through an index; a plain "SCAN <table>" fails the check, here and
+# in tests/test_query_plans.py
+QUERY_PATHS = {
+    'note by external id': (
+        "SELECT note_id, current_version_id FROM note WHERE note_id_external = ?", ('doc-1',)),
+    'notes per encounter': (
+        "SELECT note_id, note_date FROM note WHERE encounter_id = ? ORDER BY note_date_at", (42,)),
+    'notes in a date range': (
+        "SELECT note_id FROM note WHERE note_date_at >= ? AND note_date_at < ?", (0, 86400)),
+    'current version of a note': (
+        """SELECT nv.note_text, nv.content_type, nv.content_hash FROM note n
+           JOIN note_version nv ON nv.version_id = n.current_version_id WHERE n.note_id = ?""", (1,)),
+    'latest version of a note': (
+        "SELECT MAX(version_id) FROM note_version WHERE note_id = ?", (1,)),
+    'latest version per note': (
+        """SELECT nv.note_id, nv.version_id, nv.content_hash FROM note_version nv
+           WHERE nv.version_id IN (SELECT MAX(version_id) FROM note_version GROUP BY note_id)""", ()),
+    'next version number': (
+        "SELECT MAX(version_number) FROM note_version WHERE note_id = ?", (1,)),
+    'versions by practitioner': (
+        "SELECT note_id, version_id FROM note_version WHERE practioner_id = ?", (77,)),
+    'payload of a version': (
+        """SELECT b.rowid, nv.content_type FROM note_version nv
+           LEFT JOIN note_blob b ON b.content_hash = nv.content_hash WHERE nv.version_id = ?""", (1,)),
+    'versions sharing a payload': (
+        "SELECT version_id FROM note_version WHERE content_hash = ?", ('0' * 64,)),
+    'due fetch queue entries': (
+        """SELECT version_id, note_id, url FROM binary_fetch_queue
+           WHERE state = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, version_id LIMIT 200""", (0,)),
+    'medication requests per encounter': (
+        """SELECT medication_request_id, medication_id, status, authored_on FROM medication_request
+           WHERE encounter_id = ? ORDER BY authored_at""", ('42',)),
+    'medication administrations per encounter': (
+        """SELECT medication_administration_id, medication_id, status, effective_start FROM medication_administration
+           WHERE encounter_id = ? ORDER BY effective_start_at""", ('42',)),
+    'administrations of a request': (
+        "SELECT medication_administration_id FROM medication_administration WHERE medication_request_id = ?", (1,)),
+    'requests for a medication': (
+        "SELECT medication_request_id FROM medication_request WHERE medication_id = ?", (1,)),
+    'administrations of a medication': (
+        "SELECT medication_administration_id FROM medication_administration WHERE medication_id = ?", (1,)),
+    'requests authored in a time range': (
+        "SELECT medication_request_id FROM medication_request WHERE authored_at >= ? AND authored_at < ?", (0, 86400)),
+    'requests running at a time': (
+        """SELECT medication_request_id FROM medication_request
+           WHERE timing_start_at <= ? AND timing_end_at > ?""", (86400, 86400)),
+    'administrations in a time range': (
+        """SELECT medication_administration_id FROM medication_administration
+           WHERE effective_start_at >= ? AND effective_start_at < ?""", (0, 86400)),
+    'medication by external id': (
+        "SELECT medication_id FROM medication WHERE medication_id_external = ?", ('med-1',)),
+    'request by external id': (
+        "SELECT medication_request_id FROM medication_request WHERE medication_request_id_external = ?", ('medrx-1',)),
+    'administrations without a request key': (
+        """SELECT medication_administration_id FROM medication_administration
+           WHERE medication_request_id IS NULL AND medication_request_id_external IS NOT NULL""", ()),
+    'medication summary of an encounter': (
+        "SELECT * FROM medication_encounter_summary WHERE encounter_id = ?", ('42',)),
+    'encounters given a medication': (
+        "SELECT encounter_id, given_count, dose_total FROM medication_encounter_summary WHERE medication_id = ?", (1,)),
+    'summary rows of a request': (
+        """SELECT COUNT(*) FROM medication_request
+           WHERE encounter_id = ? AND COALESCE(medication_id, 0) = ? AND COALESCE(dosage_unit, '') = ?""",
+        ('42', 1, 'TAB')),
+    'summary rows of an administration': (
+        """SELECT COUNT(*) FROM medication_administration
+           WHERE encounter_id = ? AND COALESCE(medication_id, 0) = ? AND COALESCE(dosage_unit, '') = ?""",
+        ('42', 1, 'TAB')),
+}
+
+# A full table scan in EXPLAIN QUERY PLAN output, e.g. "SCAN note" (index scans say USING ... INDEX)
+_FULL_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+# Fresh in-memory database with every schema migration applied
+def schema_database():
+    conn = sqlite3.connect(':memory:')
+    migrate(conn)
+    return conn
+
+# Run EXPLAIN QUERY PLAN for every query path; returns {name: (plan lines, full scans)}.
+# Paths over tables the database doesn't have yet are left out
+def check_query_plans(conn, query_paths=QUERY_PATHS):
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    results = {}
+    for name, (sql, params) in query_paths.items():
+        try:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            continue
+        scans = []
+        for detail in plan:
+            match = _FULL_SCAN.match(detail)
+            # Scans of subquery results and CTEs are not table scans
+            if match and match.group(1) in tables:
+                scans.append(detail)
+        results[name] = (plan, scans)
+    return results
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fail if any known query path needs a full table scan (checks a freshly migrated schema by default)')
+    parser.add_argument('--db', help='Check this database as it is instead of a freshly migrated one')
+    parser.add_argument('--apply', action='store_true',
+                        help='First apply pending schema migrations to the --db database')
+    parser.add_argument('--verbose', action='store_true', help='Print the full plan of every query')
+    args = parser.parse_args()
+
+    if args.apply and not args.db:
+        parser.error('--apply needs --db')
+    if args.apply:
+        # Opening it through db_connection migrates it
+        conn = connect(args.db)
+    elif args.db:
+        conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    else:
+        conn = schema_database()
+    try:
+        results = check_query_plans(conn)
+    finally:
+        conn.close()
+
+    failures = 0
+    for name, (plan, scans) in results.items():
+        print(f"{'FULL SCAN' if scans else 'ok':9}  {name}")
+        if scans or args.verbose:
+            for detail in plan:
+                print(f"           {detail}")
+        failures += bool(scans)
+
+    print(f"{len(results) - failures} of {len(results)} query paths use an index")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+-- Reference only: databases are created and upgraded by schema_migrations.py
+-- (run db_connect.py); keep this file in step with the migrations
+
 -- Create Category Table
 CREATE TABLE note_category (
     category_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -19,7 +22,10 @@ CREATE TABLE note (
     encounter_id INTEGER,
     -- practitioner_id INTEGER,
     note_date DATE,
+    note_date_at INTEGER, -- note_date as UTC Unix time, for sorting and range filters
     current_version_id INTEGER,
+    source_version TEXT,  -- meta.versionId of the DocumentReference last imported
+    source_hash TEXT,     -- SHA-256 of its attachment, compared by incremental imports
     -- is_active INTEGER DEFAULT 1,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -33,15 +39,71 @@ CREATE TABLE note_version (
     version_number INTEGER,
     note_text TEXT,
     practioner_id INTEGER,
+    content_type TEXT,
+    content_blob BLOB,
+    content_hash TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (note_id) REFERENCES note(note_id)
 );
 
+-- Create Note Blob Table (payloads stored once per SHA-256, shared by versions)
+CREATE TABLE note_blob (
+    content_hash TEXT PRIMARY KEY,
+    content BLOB NOT NULL,
+    content_type TEXT,
+    size INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create Note Blob Source Table (Binary URLs already fetched)
+CREATE TABLE note_blob_source (
+    source_url TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    FOREIGN KEY (content_hash) REFERENCES note_blob(content_hash)
+) WITHOUT ROWID;
+
+-- Create Note Blob Text Table (plain text extracted once per payload)
+CREATE TABLE note_blob_text (
+    content_hash TEXT PRIMARY KEY,
+    text TEXT,
+    extractor TEXT,
+    error TEXT,
+    extracted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (content_hash) REFERENCES note_blob(content_hash)
+);
+
+-- Create Binary Fetch Queue Table (URL references waiting for extract_binary_content)
+CREATE TABLE binary_fetch_queue (
+    version_id INTEGER PRIMARY KEY,
+    note_id INTEGER,
+    url TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',  -- pending, in_progress, done, failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL DEFAULT 0,  -- unix time before which a retry is not claimed
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (version_id) REFERENCES note_version(version_id)
+);
+
+-- Create Binary Fetch Backfill Table (checkpoint of the one-time queue backfill)
+CREATE TABLE binary_fetch_backfill (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_version_id INTEGER NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0
+);
+
 -- Create indexes for better performance
 CREATE INDEX idx_note_category ON note(category_id);
 CREATE INDEX idx_note_type ON note(note_type);
-CREATE INDEX idx_note_date ON note(note_date);
+CREATE INDEX idx_note_date_at ON note(note_date_at);
+CREATE INDEX idx_note_external ON note(note_id_external);
+CREATE INDEX idx_note_encounter ON note(encounter_id, note_date_at);
 CREATE INDEX idx_note_version ON note_version(note_id, version_number);
+-- Latest version per note: MAX(version_id) for a note_id is a single index seek
+CREATE INDEX idx_note_version_latest ON note_version(note_id, version_id);
+CREATE INDEX idx_note_version_practitioner ON note_version(practioner_id, note_id);
+CREATE INDEX idx_note_version_hash ON note_version(content_hash);
+CREATE INDEX idx_fetch_queue_due ON binary_fetch_queue(state, next_attempt_at, version_id);
 -- -- Simplified Clinical Notes Database Schema
 -- -- With proper versioning and categories
 
@@ -0,0 +1,136 @@
+import os
+import atexit
+import sqlite3
+import threading
+
+# Database used by the scripts, relative to the working directory they run in
+DB_PATH = 'healthcare.db'
+
+# Seconds a connection waits on another connection's write lock before "database is locked"
+DEFAULT_BUSY_TIMEOUT = 30
+
+# Page cache per connection (negative means KiB, so 64 MiB) and memory-mapped I/O window
+DEFAULT_CACHE_SIZE = -65536
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+# Idle connections kept per database file
+DEFAULT_POOL_SIZE = 4
+
+# Pooled connections by database path, and the process that opened them
+_idle = {}
+_idle_pid = os.getpid()
+_lock = threading.Lock()
+
+# Database files whose schema this process has already brought up to date
+_migrated = set()
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool instead of closing it"""
+
+    def close(self):
+        release_connection(self)
+
+    def really_close(self):
+        super().close()
+
+
+def configure_connection(conn):
+    """Apply the shared PRAGMAs to a new connection.
+
+    WAL lets readers (the viewer, search, the fetcher's queue reads) run while
+    an importer writes, and with synchronous=NORMAL a commit no longer waits
+    for an fsync of the main database file. WAL is a property of the database
+    file, so this also switches databases created before it.
+    """
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = {DEFAULT_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size = {DEFAULT_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+def ensure_schema(conn, db_path):
+    """Apply pending schema migrations the first time this process opens db_path.
+
+    For a database that is already current this is one PRAGMA user_version read.
+    """
+    key = os.path.abspath(db_path)
+    if key in _migrated:
+        return
+    # Imported here because the migrations use modules that import this one
+    from schema_migrations import migrate
+    migrate(conn)
+    _migrated.add(key)
+
+
+def connect(db_path=DB_PATH, row_factory=sqlite3.Row, timeout=DEFAULT_BUSY_TIMEOUT):
+    """Open a new, unpooled connection with the shared settings"""
+    # Connections may be handed to a writer thread, one user at a time
+    conn = sqlite3.connect(db_path, timeout=timeout, check_same_thread=False)
+    configure_connection(conn)
+    ensure_schema(conn, db_path)
+    conn.row_factory = row_factory
+    return conn
+
+
+def get_connection(db_path=DB_PATH, row_factory=sqlite3.Row):
+    """Borrow a configured connection from the pool, opening one if none is idle.
+
+    close() returns the connection to the pool (rolling back anything left
+    uncommitted, as a real close would), so helpers that open and close a
+    connection per call reuse the same one and its warm page cache.
+    """
+    global _idle_pid
+    key = os.path.abspath(db_path)
+    with _lock:
+        if _idle_pid != os.getpid():
+            # Connections must not cross a fork; worker processes start their own pool
+            _idle.clear()
+            _idle_pid = os.getpid()
+        idle = _idle.get(key)
+        conn = idle.pop() if idle else None
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=DEFAULT_BUSY_TIMEOUT, check_same_thread=False,
+                               factory=PooledConnection)
+        configure_connection(conn)
+        ensure_schema(conn, db_path)
+        conn.pool_key = key
+    conn.row_factory = row_factory
+    return conn
+
+
+def release_connection(conn):
+    """Return a pooled connection, rolled back and reset; it is closed if the pool is full"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        # The next borrower gets the sqlite3 defaults back, e.g. implicit transactions
+        # after a bulk writer switched to managing its own
+        conn.isolation_level = ''
+    except sqlite3.ProgrammingError:
+        # Already closed
+        return
+    with _lock:
+        if _idle_pid == os.getpid():
+            idle = _idle.setdefault(conn.pool_key, [])
+            if conn not in idle and len(idle) < DEFAULT_POOL_SIZE:
+                idle.append(conn)
+                return
+    conn.really_close()
+
+
+def close_all():
+    """Close every idle pooled connection"""
+    with _lock:
+        if _idle_pid != os.getpid():
+            # Inherited across a fork; the parent still owns them
+            return
+        connections = [conn for idle in _idle.values() for conn in idle]
+        _idle.clear()
+    for conn in connections:
+        conn.really_close()
+
+
+# Closing the last connection checkpoints the WAL back into the database file
+atexit.register(close_all)
@@ -1,10 +1,24 @@
 import json
-import sqlite3
-import os
-import base64
 import logging
+import asyncio
+import argparse
+import signal
+import threading
+import time
 import requests
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from db_connection import get_connection
+from note_content_store import (
+    store_binary_content, store_binary_contents, lookup_source_urls, link_versions_to_blobs,
+)
+from fetch_queue import (
+    prepare_fetch_queue, iter_claimed, mark_done, queue_counts, requeue_failed,
+    release_stale_claims, record_failures, defer, next_due_time, RetryPolicy,
+    DEFAULT_CLAIM_BATCH_SIZE, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_BASE_DELAY, DEFAULT_RETRY_MAX_DELAY,
+)
+from ingest_metrics import METRICS, add_arguments as add_metrics_arguments, configure_from_args as configure_metrics
 
 # Set up logging
 logging.basicConfig(
@@ -16,43 +30,206 @@ logging.basicConfig(
 
 # Database connection
 def get_db_connection():
-    conn = sqlite3.connect('healthcare.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_connection()
+
+# Defaults for the concurrent fetch engine
+DEFAULT_CONCURRENCY = 16
+DEFAULT_WRITE_BATCH_SIZE = 200
+
+# How long a negotiated content type is trusted, in seconds
+DEFAULT_MIME_CACHE_TTL = 3600
+
+# Consecutive transient failures before a host's circuit opens, and how long it then stays open (seconds)
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 60
+DEFAULT_BREAKER_MAX_COOLDOWN = 900
+
+# Longest stretch, in seconds, that fetched results wait before being committed
+DEFAULT_CHECKPOINT_INTERVAL = 30
+
+# Set by SIGINT/SIGTERM: finish the fetches in flight, checkpoint and exit
+STOP_REQUESTED = threading.Event()
+
+# First signal asks for a clean stop, a second one interrupts immediately
+def request_stop(signum, frame):
+    if STOP_REQUESTED.is_set():
+        raise KeyboardInterrupt
+    logging.info(f"Received signal {signum}, stopping after the fetches in flight")
+    STOP_REQUESTED.set()
+
+# Thread-safe per-host rate limiter: spaces request starts to at most `rate` per second per host
+class HostRateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+    
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+# Function to create a pooled, keep-alive HTTP session
+def create_http_session(pool_size=DEFAULT_CONCURRENCY):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Per host/path cache of what the Accept fallback found for servers whose Binary metadata
+# can't be used: the Accept header that worked, or that none did. Binaries under one path
+# have their own contentType, so what their metadata says is never cached
+class ContentTypeCache:
+    def __init__(self, ttl=DEFAULT_MIME_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.requests_saved = 0
+    
+    @staticmethod
+    def key(url):
+        # Binaries on the same server and path prefix (e.g. .../r4/<tenant>/Binary) resolve the same way
+        parts = urlsplit(url)
+        return parts.netloc + parts.path.rsplit('/', 1)[0]
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['expires_at'] <= time.monotonic():
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+    
+    def store(self, key, content_type, metadata_failed, cost):
+        # cost is how many requests negotiation takes without the cache
+        with self.lock:
+            self.entries[key] = {
+                'content_type': content_type,
+                'metadata_failed': metadata_failed,
+                'cost': cost,
+                'expires_at': time.monotonic() + self.ttl,
+            }
+    
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.evictions += 1
+    
+    def record_saved(self, count):
+        with self.lock:
+            self.requests_saved += count
+    
+    def log_stats(self):
+        logging.info(f"Content-type cache: {self.hits} hits, {self.misses} misses, "
+                     f"{self.evictions} evictions, {self.requests_saved} requests saved")
 
-# Function to fetch binary content from URL
-def fetch_binary_content(url):
+# Raised by fetch_binary when a URL could not be fetched. transient is True for failures
+# worth retrying later (connection errors, timeouts, 429 and 5xx responses)
+class FetchError(Exception):
+    def __init__(self, message, transient=False):
+        super().__init__(message)
+        self.transient = transient
+
+# Status codes that mean "try again later" rather than "this will never work"
+def is_transient_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+# Media type a response says its body is (parameters such as charset dropped), or `default` if it doesn't say
+def response_content_type(response, default):
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    return content_type or default
+
+# Function to fetch binary content from URL, returning (content, content_type) or raising FetchError
+def fetch_binary(url, session=None, rate_limiter=None, mime_cache=None):
+    http = session or requests
+    requests_made = 0
+    statuses = []
+    
+    def get(headers):
+        nonlocal requests_made
+        requests_made += 1
+        if rate_limiter:
+            rate_limiter.wait(url)
+        with METRICS.timer('http_request'):
+            response = http.get(url, headers=headers, timeout=30)
+        METRICS.count('http_requests')
+        METRICS.add_bytes('http_response', len(response.content))
+        statuses.append(response.status_code)
+        return response
+    
     try:
-        # First, try to get the Binary resource metadata using application/fhir+json
-        metadata_headers = {
-            'Accept': 'application/fhir+json'
-        }
+        cache_key = None
+        entry = None
+        if mime_cache:
+            cache_key = mime_cache.key(url)
+            entry = mime_cache.get(cache_key)
         
-        # Make a GET request to get the Binary resource metadata
-        metadata_response = requests.get(url, headers=metadata_headers, timeout=30)
+        # An Accept header already known to work for this host/path goes straight to the content request
+        stale_attempts = 0
+        if entry and entry['content_type']:
+            response = get({'Accept': entry['content_type']})
+            if response.status_code == 200:
+                mime_cache.record_saved(entry['cost'] - 1)
+                return response.content, response_content_type(response, entry['content_type'])
+            mime_cache.invalidate(cache_key)
+            stale_attempts = 1
+            entry = None
         
-        if metadata_response.status_code == 200:
-            try:
-                # Parse the Binary resource to get the contentType
-                binary_resource = metadata_response.json()
-                content_type = binary_resource.get('contentType', 'application/octet-stream')
-                
-                # Now request the actual binary content with the correct content type
-                content_headers = {
-                    'Accept': content_type
-                }
-                
-                # Make a GET request to get the actual binary content
-                content_response = requests.get(url, headers=content_headers, timeout=30)
-                
-                if content_response.status_code == 200:
-                    return content_response.content, content_type
-                else:
-                    logging.error(f"Failed to fetch binary content from {url}. Status code: {content_response.status_code}")
-            except json.JSONDecodeError:
-                logging.error(f"Failed to parse Binary resource metadata from {url}")
+        # Skip the metadata request when this host/path is known not to serve it
+        skip_metadata = bool(entry and entry['metadata_failed'])
+        metadata_failed = True
+        if skip_metadata:
+            mime_cache.record_saved(1)
         else:
-            logging.error(f"Failed to fetch Binary resource metadata from {url}. Status code: {metadata_response.status_code}")
+            # First, try to get the Binary resource metadata using application/fhir+json
+            metadata_headers = {
+                'Accept': 'application/fhir+json'
+            }
+            
+            # Make a GET request to get the Binary resource metadata
+            metadata_response = get(metadata_headers)
+            
+            if metadata_response.status_code == 200:
+                try:
+                    # Parse the Binary resource to get the contentType
+                    binary_resource = metadata_response.json()
+                    content_type = binary_resource.get('contentType', 'application/octet-stream')
+                    metadata_failed = False
+                    
+                    # Now request the actual binary content with the correct content type
+                    content_headers = {
+                        'Accept': content_type
+                    }
+                    
+                    # Make a GET request to get the actual binary content
+                    content_response = get(content_headers)
+                    
+                    if content_response.status_code == 200:
+                        return content_response.content, response_content_type(content_response, content_type)
+                    else:
+                        logging.error(f"Failed to fetch binary content from {url}. Status code: {content_response.status_code}")
+                except json.JSONDecodeError:
+                    logging.error(f"Failed to parse Binary resource metadata from {url}")
+            else:
+                logging.error(f"Failed to fetch Binary resource metadata from {url}. Status code: {metadata_response.status_code}")
+        
+        # Requests an uncached negotiation would have made (the skipped metadata call included)
+        base_cost = requests_made - stale_attempts + (1 if skip_metadata else 0)
         
         # If we couldn't get the content with the specific approach, try with common MIME types
         common_mime_types = [
@@ -65,91 +242,262 @@ def fetch_binary_content(url):
             'application/octet-stream'
         ]
         
-        for mime_type in common_mime_types:
+        for attempt, mime_type in enumerate(common_mime_types, start=1):
             headers = {
                 'Accept': mime_type
             }
             
-            response = requests.get(url, headers=headers, timeout=30)
+            response = get(headers)
             
             if response.status_code == 200:
-                return response.content, mime_type
+                if mime_cache:
+                    mime_cache.store(cache_key, mime_type, metadata_failed, base_cost + attempt)
+                # Servers may ignore Accept; the payload is what the response says it is
+                return response.content, response_content_type(response, mime_type)
         
-        logging.error(f"Failed to fetch content from {url} with any MIME type")
-        return None, None
+        # A server that is down answers every Accept with 5xx; don't remember that as a negotiation result
+        transient = any(is_transient_status(status) for status in statuses)
+        if mime_cache and not transient:
+            mime_cache.store(cache_key, None, metadata_failed, base_cost + len(common_mime_types))
+        raise FetchError(f"Failed to fetch content from {url} with any MIME type "
+                         f"(status codes {sorted(set(statuses))})", transient)
+    except FetchError:
+        raise
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise FetchError(f"Error fetching content from {url}: {e}", transient=True)
     except Exception as e:
-        logging.error(f"Error fetching content from {url}: {e}")
-        return None, None
+        raise FetchError(f"Error fetching content from {url}: {e}")
+
+# Function to fetch binary content with the whole negotiation timed as the 'fetch' stage
+def timed_fetch_binary(url, session=None, rate_limiter=None, mime_cache=None):
+    with METRICS.timer('fetch'):
+        return fetch_binary(url, session, rate_limiter, mime_cache)
 
 # Function to update note version with actual content
-def update_note_with_binary_content(note_id, version_id, binary_content, content_type):
+def update_note_with_binary_content(note_id, version_id, binary_content, content_type, url=None, dedup_stats=None):
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # Convert binary content to base64 for storage
-        base64_content = base64.b64encode(binary_content).decode('utf-8')
-        
-        # Update the note_version record with the actual content
-        cursor.execute(
-            """UPDATE note_version 
-               SET note_text = ?, content_type = ? 
-               WHERE version_id = ?""",
-            (base64_content, content_type, version_id)
-        )
+        # Store the raw bytes once per SHA-256 in the blob store (no base64 inflation)
+        with METRICS.timer('store'):
+            bytes_written, bytes_saved = store_binary_content(cursor, version_id, binary_content, content_type, url)
+            mark_done(cursor, [version_id])
         
-        conn.commit()
+        with METRICS.timer('commit'):
+            conn.commit()
+        if dedup_stats is not None:
+            dedup_stats['bytes_written'] += bytes_written
+            dedup_stats['bytes_saved'] += bytes_saved
+        METRICS.count('versions_written')
+        METRICS.add_bytes('blob_written', bytes_written)
+        METRICS.add_bytes('blob_deduplicated', bytes_saved)
         return True
     except Exception as e:
         logging.error(f"Error updating note version {version_id} with binary content: {e}")
+        METRICS.error('store')
         conn.rollback()
         return False
     finally:
         conn.close()
 
+# Counters for the content-addressed store: fetches avoided and payload bytes not written again
+def new_dedup_stats():
+    return {'fetches_skipped': 0, 'bytes_written': 0, 'bytes_saved': 0}
+
+def log_dedup_stats(dedup_stats):
+    logging.info(f"Blob store: {dedup_stats['fetches_skipped']} fetches skipped (URL already stored), "
+                 f"{dedup_stats['bytes_written']} bytes written, {dedup_stats['bytes_saved']} bytes saved by deduplication")
+
+# Per-host circuit breaker: after `failure_threshold` consecutive transient failures a host is
+# left alone for `cooldown` seconds, then a single probe decides whether it is back. Each failed
+# probe doubles the cooldown (up to max_cooldown), so a dead endpoint isn't hammered all night
+class HostCircuitBreaker:
+    def __init__(self, failure_threshold=DEFAULT_BREAKER_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN,
+                 max_cooldown=DEFAULT_BREAKER_MAX_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.trips = 0
+        self.deferred = 0
+    
+    def _state(self, host):
+        return self.hosts.setdefault(host, {'failures': 0, 'open_until': None, 'cooldown': self.cooldown, 'probing': False})
+    
+    def allow(self, url):
+        # Returns (allowed, retry_at); retry_at is when a refused fetch should be tried again
+        host = urlsplit(url).netloc
+        with self.lock:
+            state = self._state(host)
+            if state['open_until'] is None:
+                return True, None
+            now = time.time()
+            if now < state['open_until'] or state['probing']:
+                self.deferred += 1
+                return False, max(state['open_until'], now + 1)
+            # Cooldown over: half-open, let exactly one probe through
+            state['probing'] = True
+            return True, None
+    
+    def record(self, url, failed):
+        # failed is True only for transient failures; a 404 still proves the host is up
+        host = urlsplit(url).netloc
+        with self.lock:
+            state = self._state(host)
+            if not failed:
+                if state['open_until'] is not None:
+                    logging.info(f"Circuit for {host} closed again")
+                state.update(failures=0, open_until=None, cooldown=self.cooldown, probing=False)
+                return
+            state['failures'] += 1
+            if state['probing']:
+                state['cooldown'] = min(state['cooldown'] * 2, self.max_cooldown)
+                state['probing'] = False
+                state['open_until'] = time.time() + state['cooldown']
+                logging.warning(f"Probe to {host} failed, circuit stays open for {state['cooldown']:.0f}s")
+            elif state['open_until'] is None and state['failures'] >= self.failure_threshold:
+                state['open_until'] = time.time() + state['cooldown']
+                self.trips += 1
+                logging.warning(f"{state['failures']} consecutive failures from {host}, "
+                                f"circuit open for {state['cooldown']:.0f}s")
+    
+    def log_stats(self):
+        logging.info(f"Circuit breaker: {self.trips} trips, {self.deferred} fetches deferred while a host was open")
+
+# Decides when a backfill run stops and keeps it going until the queue settles: retries whose
+# backoff expires inside the time budget are waited for, everything else stays queued for the next run
+class FetchScheduler:
+    def __init__(self, retry_policy=None, breaker=None, deadline=None, stop_event=None):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker or HostCircuitBreaker()
+        self.deadline = deadline
+        self.stop_event = stop_event or threading.Event()
+    
+    def should_stop(self):
+        return self.stop_event.is_set() or (self.deadline is not None and time.time() >= self.deadline)
+    
+    def run(self, conn, run_round):
+        # run_round() fetches everything currently due and returns (success_count, error_count)
+        success_count = 0
+        error_count = 0
+        while True:
+            round_success, round_errors = run_round()
+            success_count += round_success
+            error_count += round_errors
+            # Entries claimed ahead but never started (stop requested, deadline hit) go back to pending
+            release_stale_claims(conn)
+            
+            if self.stop_event.is_set():
+                logging.info("Stopped on request; progress is checkpointed in the fetch queue")
+                break
+            if self.should_stop():
+                logging.info("Time budget reached; remaining work stays queued")
+                break
+            due = next_due_time(conn)
+            if due is None:
+                break
+            if self.deadline is not None and due >= self.deadline:
+                logging.info("Next retry falls outside the time budget; remaining work stays queued")
+                break
+            wait = due - time.time()
+            if wait > 0:
+                if wait >= 1:
+                    logging.info(f"Waiting {wait:.0f}s for the next scheduled retry")
+                if self.stop_event.wait(wait):
+                    logging.info("Stopped on request; progress is checkpointed in the fetch queue")
+                    break
+        return success_count, error_count
+    
+    def log_stats(self):
+        self.breaker.log_stats()
+
+# Function to log how much work the fetch queue holds
+def log_queue_counts(conn, when):
+    counts = queue_counts(conn)
+    logging.info(f"Fetch queue {when}: " + ', '.join(f"{state} {count}" for state, count in sorted(counts.items())))
+
 # Function to process all notes with URL references
-def process_url_references():
+def process_url_references(mime_cache_ttl=DEFAULT_MIME_CACHE_TTL, claim_batch_size=DEFAULT_CLAIM_BATCH_SIZE,
+                           scheduler=None):
     conn = get_db_connection()
     cursor = conn.cursor()
+    mime_cache = ContentTypeCache(mime_cache_ttl) if mime_cache_ttl else None
+    dedup_stats = new_dedup_stats()
+    scheduler = scheduler or FetchScheduler()
+    breaker = scheduler.breaker
     
-    try:
-        # Find all note versions with URL references
-        cursor.execute(
-            """SELECT n.note_id, nv.version_id, nv.note_text 
-               FROM note n 
-               JOIN note_version nv ON n.note_id = nv.note_id 
-               WHERE nv.note_text LIKE 'URL: %'"""
-        )
-        
-        url_notes = cursor.fetchall()
-        logging.info(f"Found {len(url_notes)} notes with URL references")
-        
+    def run_round():
         success_count = 0
         error_count = 0
         
-        for note in url_notes:
+        for note in iter_claimed(conn, claim_batch_size):
+            if scheduler.should_stop():
+                break
             note_id = note['note_id']
             version_id = note['version_id']
-            url_text = note['note_text']
-            
-            # Extract the URL from the text
-            url = url_text.replace('URL: ', '').strip()
+            url = note['url']
             
             logging.info(f"Processing note {note_id}, version {version_id} with URL: {url}")
             
+            # A URL whose content is already stored only needs linking, not fetching
+            known = lookup_source_urls(cursor, [url]).get(url)
+            if known:
+                blob_hash, content_type, size = known
+                link_versions_to_blobs(cursor, [(version_id, blob_hash, content_type)])
+                mark_done(cursor, [version_id])
+                conn.commit()
+                dedup_stats['fetches_skipped'] += 1
+                dedup_stats['bytes_saved'] += size
+                METRICS.count('versions_linked')
+                success_count += 1
+                continue
+            
+            # Leave hosts with an open circuit alone until their cooldown is over
+            allowed, retry_at = breaker.allow(url)
+            if not allowed:
+                defer(cursor, [(version_id, retry_at)])
+                conn.commit()
+                continue
+            
             # Fetch the binary content
-            binary_content, content_type = fetch_binary_content(url)
+            try:
+                binary_content, content_type = timed_fetch_binary(url, mime_cache=mime_cache)
+            except FetchError as e:
+                logging.error(str(e))
+                METRICS.error('fetch_transient' if e.transient else 'fetch_permanent')
+                breaker.record(url, e.transient)
+                record_failures(cursor, [(version_id, str(e), e.transient)], scheduler.retry_policy)
+                conn.commit()
+                error_count += 1
+                continue
+            breaker.record(url, False)
+            METRICS.count('fetched')
             
-            if binary_content:
-                # Update the note version with the actual content
-                if update_note_with_binary_content(note_id, version_id, binary_content, content_type):
-                    success_count += 1
-                else:
-                    error_count += 1
+            # Update the note version with the actual content
+            if update_note_with_binary_content(note_id, version_id, binary_content, content_type, url, dedup_stats):
+                success_count += 1
             else:
+                record_failures(cursor, [(version_id, 'Could not store fetched content', True)], scheduler.retry_policy)
+                conn.commit()
                 error_count += 1
         
+        return success_count, error_count
+    
+    try:
+        # Work comes from the indexed fetch queue, claimed a batch at a time
+        prepare_fetch_queue(conn)
+        log_queue_counts(conn, 'before run')
+        
+        success_count, error_count = scheduler.run(conn, run_round)
+        
         logging.info(f"Completed processing URL references. Success: {success_count}, Errors: {error_count}")
+        log_queue_counts(conn, 'after run')
+        if mime_cache:
+            mime_cache.log_stats()
+        scheduler.log_stats()
+        log_dedup_stats(dedup_stats)
         return success_count, error_count
     
     except Exception as e:
@@ -158,39 +506,254 @@ def process_url_references():
     finally:
         conn.close()
 
-# Add content_type column to note_version table if it doesn't exist
-def ensure_content_type_column():
-    conn = get_db_connection()
+# Function to write a batch of fetched payloads back to note_version in one transaction,
+# marking their queue entries done in the same commit
+def write_binary_contents(conn, results, dedup_stats=None):
+    try:
+        cursor = conn.cursor()
+        with METRICS.timer('store'):
+            bytes_written, bytes_saved = store_binary_contents(cursor, results)
+            mark_done(cursor, [result[0] for result in results])
+        with METRICS.timer('commit'):
+            conn.commit()
+        if dedup_stats is not None:
+            dedup_stats['bytes_written'] += bytes_written
+            dedup_stats['bytes_saved'] += bytes_saved
+        METRICS.count('versions_written', len(results))
+        METRICS.add_bytes('blob_written', bytes_written)
+        METRICS.add_bytes('blob_deduplicated', bytes_saved)
+        return len(results)
+    except Exception as e:
+        logging.error(f"Error writing batch of {len(results)} binary contents: {e}")
+        METRICS.error('store', len(results))
+        conn.rollback()
+        return 0
+
+# Function to fetch all URL references concurrently and write them back in batches
+async def fetch_url_references_async(conn, url_notes, concurrency=DEFAULT_CONCURRENCY,
+                                     rate_limit=None, write_batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                                     mime_cache=None, dedup_stats=None, scheduler=None,
+                                     checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+    loop = asyncio.get_running_loop()
+    session = create_http_session(concurrency)
+    rate_limiter = HostRateLimiter(rate_limit)
     cursor = conn.cursor()
+    if dedup_stats is None:
+        dedup_stats = new_dedup_stats()
+    scheduler = scheduler or FetchScheduler()
+    breaker = scheduler.breaker
+    success_count = 0
+    error_count = 0
+    pending_writes = []
+    pending_links = []
+    pending_failures = []
+    pending_deferrals = []
+    fetched_this_run = {}
+    # Running fetch -> its URL, and URL -> the versions waiting on that fetch
+    in_flight = {}
+    waiting = {}
+    last_checkpoint = time.monotonic()
     
-    try:
-        # Check if content_type column exists
-        cursor.execute("PRAGMA table_info(note_version)")
-        columns = cursor.fetchall()
-        column_names = [column['name'] for column in columns]
-        
-        if 'content_type' not in column_names:
-            logging.info("Adding content_type column to note_version table")
-            cursor.execute("ALTER TABLE note_version ADD COLUMN content_type TEXT")
+    def collect(done):
+        nonlocal error_count
+        for task in done:
+            url = in_flight.pop(task)
+            versions = waiting.pop(url)
+            try:
+                binary_content, content_type = task.result()
+            except FetchError as e:
+                logging.error(f"Failed to fetch content for versions {versions}: {e}")
+                METRICS.error('fetch_transient' if e.transient else 'fetch_permanent')
+                breaker.record(url, e.transient)
+                pending_failures.extend((version_id, str(e), e.transient) for version_id in versions)
+                error_count += len(versions)
+                continue
+            breaker.record(url, False)
+            METRICS.count('fetched')
+            pending_writes.extend((version_id, binary_content, content_type, url) for version_id in versions)
+            fetched_this_run[url] = (binary_content, content_type)
+    
+    def flush():
+        # Everything learned since the last checkpoint is committed here
+        nonlocal success_count, error_count, last_checkpoint
+        written = write_binary_contents(conn, pending_writes, dedup_stats)
+        success_count += written
+        error_count += len(pending_writes) - written
+        if pending_writes and not written:
+            # The store failed, not the fetch: retry with backoff instead of failing the versions for good
+            record_failures(cursor, [(result[0], 'Could not store fetched content', True) for result in pending_writes],
+                            scheduler.retry_policy)
+        pending_writes.clear()
+        fetched_this_run.clear()
+        
+        if pending_links:
+            link_versions_to_blobs(cursor, pending_links)
+            mark_done(cursor, [link[0] for link in pending_links])
+            success_count += len(pending_links)
+            METRICS.count('versions_linked', len(pending_links))
+            pending_links.clear()
+        if pending_failures:
+            record_failures(cursor, pending_failures, scheduler.retry_policy)
+            pending_failures.clear()
+        if pending_deferrals:
+            defer(cursor, pending_deferrals)
+            pending_deferrals.clear()
+        with METRICS.timer('commit'):
             conn.commit()
-            logging.info("Added content_type column to note_version table")
-        else:
-            logging.info("content_type column already exists in note_version table")
+        last_checkpoint = time.monotonic()
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, session:
+        for note in url_notes:
+            if scheduler.should_stop():
+                break
+            url = note['url']
+            
+            # URLs already in the blob store (or fetched earlier in this batch, or being fetched) are not fetched again
+            if url in fetched_this_run:
+                binary_content, content_type = fetched_this_run[url]
+                pending_writes.append((note['version_id'], binary_content, content_type, url))
+                dedup_stats['fetches_skipped'] += 1
+                continue
+            if url in waiting:
+                waiting[url].append(note['version_id'])
+                dedup_stats['fetches_skipped'] += 1
+                continue
+            known = lookup_source_urls(cursor, [url]).get(url)
+            if known:
+                blob_hash, content_type, size = known
+                pending_links.append((note['version_id'], blob_hash, content_type))
+                dedup_stats['fetches_skipped'] += 1
+                dedup_stats['bytes_saved'] += size
+                continue
+            
+            # Leave hosts with an open circuit alone until their cooldown is over
+            allowed, retry_at = breaker.allow(url)
+            if not allowed:
+                pending_deferrals.append((note['version_id'], retry_at))
+                continue
+            
+            task = loop.run_in_executor(executor, timed_fetch_binary, url, session, rate_limiter, mime_cache)
+            in_flight[task] = url
+            waiting[url] = [note['version_id']]
+            
+            # Keep at most `concurrency` fetches running; checkpoint as batches fill up or time passes
+            if len(in_flight) >= concurrency:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+            pending = len(pending_writes) + len(pending_links) + len(pending_failures) + len(pending_deferrals)
+            if pending >= write_batch_size or (pending and time.monotonic() - last_checkpoint >= checkpoint_interval):
+                flush()
+        
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            collect(done)
+        if pending_writes or pending_links or pending_failures or pending_deferrals:
+            flush()
+    
+    return success_count, error_count
+
+# Function to process all notes with URL references using the concurrent fetch engine
+def process_url_references_concurrent(concurrency=DEFAULT_CONCURRENCY, rate_limit=None,
+                                      write_batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                                      mime_cache_ttl=DEFAULT_MIME_CACHE_TTL,
+                                      claim_batch_size=DEFAULT_CLAIM_BATCH_SIZE, scheduler=None,
+                                      checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+    conn = get_db_connection()
+    mime_cache = ContentTypeCache(mime_cache_ttl) if mime_cache_ttl else None
+    dedup_stats = new_dedup_stats()
+    scheduler = scheduler or FetchScheduler()
+    
+    def run_round():
+        # Claimed lazily in batches as the engine needs more work
+        url_notes = iter_claimed(conn, claim_batch_size)
+        return asyncio.run(
+            fetch_url_references_async(conn, url_notes, concurrency, rate_limit, write_batch_size,
+                                       mime_cache, dedup_stats, scheduler, checkpoint_interval)
+        )
+    
+    try:
+        prepare_fetch_queue(conn)
+        log_queue_counts(conn, 'before run')
+        logging.info(f"Fetching queued URL references (concurrency {concurrency}, "
+                     f"rate limit {rate_limit or 'none'}/s per host)")
+        
+        success_count, error_count = scheduler.run(conn, run_round)
+        
+        logging.info(f"Completed processing URL references. Success: {success_count}, Errors: {error_count}")
+        log_queue_counts(conn, 'after run')
+        if mime_cache:
+            mime_cache.log_stats()
+        scheduler.log_stats()
+        log_dedup_stats(dedup_stats)
+        return success_count, error_count
     
     except Exception as e:
-        logging.error(f"Error ensuring content_type column: {e}")
-        conn.rollback()
+        logging.error(f"Error processing URL references: {e}")
+        return 0, 0
     finally:
         conn.close()
 
 # Main function
 def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Fetch Binary content for notes stored as URL references')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of concurrent fetches; above 1 uses the pooled async engine (default: 1)')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Maximum requests per second per host (default: unlimited)')
+    parser.add_argument('--write-batch-size', type=int, default=DEFAULT_WRITE_BATCH_SIZE,
+                        help=f'Fetched notes written per transaction (default: {DEFAULT_WRITE_BATCH_SIZE})')
+    parser.add_argument('--mime-cache-ttl', type=float, default=DEFAULT_MIME_CACHE_TTL,
+                        help=f'Seconds to reuse a negotiated content type per host/path, 0 to disable (default: {DEFAULT_MIME_CACHE_TTL})')
+    parser.add_argument('--claim-batch-size', type=int, default=DEFAULT_CLAIM_BATCH_SIZE,
+                        help=f'Queued URL references claimed per transaction (default: {DEFAULT_CLAIM_BATCH_SIZE})')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Retry URL references whose fetch failed in an earlier run')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help=f'Fetch attempts before a transient failure becomes permanent (default: {DEFAULT_MAX_ATTEMPTS})')
+    parser.add_argument('--retry-base-delay', type=float, default=DEFAULT_RETRY_BASE_DELAY,
+                        help=f'Seconds before the first retry, doubled for each further attempt (default: {DEFAULT_RETRY_BASE_DELAY})')
+    parser.add_argument('--retry-max-delay', type=float, default=DEFAULT_RETRY_MAX_DELAY,
+                        help=f'Upper bound on the retry delay in seconds (default: {DEFAULT_RETRY_MAX_DELAY})')
+    parser.add_argument('--breaker-threshold', type=int, default=DEFAULT_BREAKER_THRESHOLD,
+                        help=f'Consecutive transient failures that open a host\'s circuit (default: {DEFAULT_BREAKER_THRESHOLD})')
+    parser.add_argument('--breaker-cooldown', type=float, default=DEFAULT_BREAKER_COOLDOWN,
+                        help=f'Seconds an open circuit waits before probing the host again (default: {DEFAULT_BREAKER_COOLDOWN})')
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help='Stop claiming new work after this many seconds; the rest stays queued (default: no limit)')
+    parser.add_argument('--checkpoint-interval', type=float, default=DEFAULT_CHECKPOINT_INTERVAL,
+                        help=f'Maximum seconds between commits of fetched results (default: {DEFAULT_CHECKPOINT_INTERVAL})')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    configure_metrics(args, 'extract_binary_content')
+    
+    # Stop cleanly on Ctrl-C or when the overnight job is terminated; the queue is the checkpoint
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    
     try:
-        # Ensure content_type column exists
-        ensure_content_type_column()
+        if args.retry_failed:
+            conn = get_db_connection()
+            try:
+                prepare_fetch_queue(conn)
+                logging.info(f"Requeued {requeue_failed(conn)} failed fetches")
+            finally:
+                conn.close()
+        
+        scheduler = FetchScheduler(
+            RetryPolicy(args.max_attempts, args.retry_base_delay, args.retry_max_delay),
+            HostCircuitBreaker(args.breaker_threshold, args.breaker_cooldown),
+            deadline=time.time() + args.time_budget if args.time_budget else None,
+            stop_event=STOP_REQUESTED,
+        )
         
         # Process all URL references
-        success_count, error_count = process_url_references()
+        if args.concurrency > 1:
+            success_count, error_count = process_url_references_concurrent(
+                args.concurrency, args.rate_limit, args.write_batch_size, args.mime_cache_ttl,
+                args.claim_batch_size, scheduler, args.checkpoint_interval)
+        else:
+            success_count, error_count = process_url_references(args.mime_cache_ttl, args.claim_batch_size, scheduler)
         
         logging.info(f"Binary content extraction complete. Successfully updated {success_count} notes. Failed to update {error_count} notes.")
     
@@ -198,4 +761,4 @@ def main():
         logging.error(f"Unexpected error in main function: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
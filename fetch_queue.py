@@ -0,0 +1,225 @@
+import time
+import random
+import logging
+import argparse
+from db_connection import get_connection
+
+# Versions claimed per transaction by the fetcher
+DEFAULT_CLAIM_BATCH_SIZE = 200
+
+# note_version rows inspected per transaction by the one-time backfill
+DEFAULT_BACKFILL_BATCH_SIZE = 5000
+
+# Retry defaults for transient fetch failures
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_BASE_DELAY = 30
+DEFAULT_RETRY_MAX_DELAY = 1800
+
+# Queue states
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+FAILED = 'failed'
+
+# Database connection
+def get_db_connection():
+    return get_connection()
+
+# Queue URL versions written before the queue existed, walking note_version by primary key.
+# The checkpoint commits with each batch, so an interrupted backfill resumes where it stopped
+def backfill_fetch_queue(conn, batch_size=DEFAULT_BACKFILL_BATCH_SIZE):
+    cursor = conn.cursor()
+    cursor.execute("SELECT last_version_id, completed FROM binary_fetch_backfill WHERE id = 1")
+    last_version_id, completed = cursor.fetchone()
+    if completed:
+        return 0
+
+    queued = 0
+    while True:
+        cursor.execute(
+            """SELECT MAX(version_id) FROM (
+                   SELECT version_id FROM note_version WHERE version_id > ? ORDER BY version_id LIMIT ?)""",
+            (last_version_id, batch_size)
+        )
+        upper = cursor.fetchone()[0]
+        if upper is None:
+            cursor.execute("UPDATE binary_fetch_backfill SET completed = 1 WHERE id = 1")
+            conn.commit()
+            break
+
+        cursor.execute(
+            """INSERT OR IGNORE INTO binary_fetch_queue (version_id, note_id, url)
+               SELECT version_id, note_id, trim(substr(note_text, 6)) FROM note_version
+               WHERE version_id > ? AND version_id <= ? AND note_text LIKE 'URL: %'""",
+            (last_version_id, upper)
+        )
+        queued += cursor.rowcount
+        cursor.execute("UPDATE binary_fetch_backfill SET last_version_id = ? WHERE id = 1", (upper,))
+        conn.commit()
+        last_version_id = upper
+
+    logging.info(f"Fetch queue backfill complete: {queued} URL references queued")
+    return queued
+
+# Put claims that no fetch is working on back in the queue: those left behind by a fetcher
+# that crashed or was killed, or claimed ahead by one that stopped early. Only one fetcher
+# runs at a time, so this is called at startup and between scheduler rounds
+def release_stale_claims(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE binary_fetch_queue SET state = ?, updated_at = CURRENT_TIMESTAMP WHERE state = ?",
+        (PENDING, IN_PROGRESS)
+    )
+    released = cursor.rowcount
+    conn.commit()
+    if released:
+        logging.info(f"Released {released} claimed fetches back to the queue")
+    return released
+
+# Give failed fetches another go, starting from a fresh attempt count
+def requeue_failed(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """UPDATE binary_fetch_queue SET state = ?, attempts = 0, next_attempt_at = 0, updated_at = CURRENT_TIMESTAMP
+           WHERE state = ?""",
+        (PENDING, FAILED)
+    )
+    conn.commit()
+    return cursor.rowcount
+
+# Exponential backoff with jitter for transient failures
+class RetryPolicy:
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_RETRY_BASE_DELAY,
+                 max_delay=DEFAULT_RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def delay(self, attempts):
+        # "Equal jitter": at least half the exponential delay, so retries never bunch up at zero,
+        # with the other half random so entries that failed together don't retry together
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+# Atomically move the next `limit` due pending versions to in_progress and return them
+def claim_batch(conn, limit=DEFAULT_CLAIM_BATCH_SIZE):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute(
+            """SELECT version_id, note_id, url FROM binary_fetch_queue
+               WHERE state = ? AND next_attempt_at <= ? ORDER BY next_attempt_at, version_id LIMIT ?""",
+            (PENDING, time.time(), limit)
+        )
+        claimed = cursor.fetchall()
+        if claimed:
+            cursor.execute(
+                f"""UPDATE binary_fetch_queue SET state = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE version_id IN ({','.join('?' * len(claimed))})""",
+                (IN_PROGRESS, *(row['version_id'] for row in claimed))
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return claimed
+
+# Stream claimed queue rows batch by batch, so only one batch is held in memory
+def iter_claimed(conn, batch_size=DEFAULT_CLAIM_BATCH_SIZE):
+    while True:
+        claimed = claim_batch(conn, batch_size)
+        if not claimed:
+            return
+        yield from claimed
+
+# Mark fetched versions done; call inside the transaction that stores their payloads
+def mark_done(cursor, version_ids):
+    cursor.executemany(
+        """UPDATE binary_fetch_queue SET state = ?, attempts = attempts + 1, last_error = NULL,
+           updated_at = CURRENT_TIMESTAMP WHERE version_id = ?""",
+        [(DONE, version_id) for version_id in version_ids]
+    )
+
+# Mark versions failed for good; failures are (version_id, error message) pairs
+def mark_failed(cursor, failures):
+    cursor.executemany(
+        """UPDATE binary_fetch_queue SET state = ?, attempts = attempts + 1, last_error = ?,
+           updated_at = CURRENT_TIMESTAMP WHERE version_id = ?""",
+        [(FAILED, error, version_id) for version_id, error in failures]
+    )
+
+# Record failed attempts; failures are (version_id, error message, transient) triples.
+# Transient failures go back to pending with a backoff until max_attempts is reached.
+# Returns (retries scheduled, permanently failed)
+def record_failures(cursor, failures, policy=None):
+    policy = policy or RetryPolicy()
+    attempts = {}
+    for version_id, _, _ in failures:
+        cursor.execute("SELECT attempts FROM binary_fetch_queue WHERE version_id = ?", (version_id,))
+        row = cursor.fetchone()
+        attempts[version_id] = (row[0] if row else 0) + 1
+
+    now = time.time()
+    retries = []
+    permanent = []
+    for version_id, error, transient in failures:
+        if transient and attempts[version_id] < policy.max_attempts:
+            retries.append((PENDING, error, now + policy.delay(attempts[version_id]), version_id))
+        else:
+            permanent.append((version_id, error))
+    cursor.executemany(
+        """UPDATE binary_fetch_queue SET state = ?, attempts = attempts + 1, last_error = ?, next_attempt_at = ?,
+           updated_at = CURRENT_TIMESTAMP WHERE version_id = ?""",
+        retries
+    )
+    mark_failed(cursor, permanent)
+    return len(retries), len(permanent)
+
+# Put claimed versions back without counting an attempt (e.g. their host's circuit is open);
+# deferrals are (version_id, not-before unix time) pairs
+def defer(cursor, deferrals):
+    cursor.executemany(
+        "UPDATE binary_fetch_queue SET state = ?, next_attempt_at = ?, updated_at = CURRENT_TIMESTAMP WHERE version_id = ?",
+        [(PENDING, not_before, version_id) for version_id, not_before in deferrals]
+    )
+
+# Unix time at which the earliest pending entry becomes due, or None if nothing is pending
+def next_due_time(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT MIN(next_attempt_at) FROM binary_fetch_queue WHERE state = ?", (PENDING,))
+    return cursor.fetchone()[0]
+
+# Number of queue rows in each state
+def queue_counts(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT state, COUNT(*) FROM binary_fetch_queue GROUP BY state")
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+# Finish any pending backfill and release stale claims
+def prepare_fetch_queue(conn, backfill_batch_size=DEFAULT_BACKFILL_BATCH_SIZE):
+    backfill_fetch_queue(conn, backfill_batch_size)
+    release_stale_claims(conn)
+
+# Main function
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Inspect and maintain the Binary fetch queue')
+    parser.add_argument('--backfill-batch-size', type=int, default=DEFAULT_BACKFILL_BATCH_SIZE,
+                        help=f'note_version rows inspected per transaction (default: {DEFAULT_BACKFILL_BATCH_SIZE})')
+    parser.add_argument('--requeue-failed', action='store_true',
+                        help='Move failed fetches back to pending')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        prepare_fetch_queue(conn, args.backfill_batch_size)
+        if args.requeue_failed:
+            logging.info(f"Requeued {requeue_failed(conn)} failed fetches")
+        counts = queue_counts(conn)
+        print(', '.join(f"{state}: {counts.get(state, 0)}" for state in (PENDING, IN_PROGRESS, DONE, FAILED)))
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
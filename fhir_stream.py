@@ -0,0 +1,169 @@
+import json
+
+# Default number of characters read from the file per refill
+DEFAULT_READ_SIZE = 1 << 20
+
+_WHITESPACE = ' \t\n\r'
+
+# Characters that can end a number; anything else after one may be the rest of it
+_DELIMITERS = ',}]' + _WHITESPACE
+
+
+class _JSONStream:
+    """Incremental JSON tokenizer over a text file.
+
+    Only one value is held in memory at a time: the buffer is refilled on
+    demand and compacted once consumed, so a Bundle with thousands of
+    base64 attachments never needs to be loaded whole.
+    """
+
+    def __init__(self, file, read_size=DEFAULT_READ_SIZE):
+        self.file = file
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        if self.eof:
+            return False
+        # Drop the consumed prefix before growing the buffer
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.file.read(size or self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, or None at EOF"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON stream, found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode and consume the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # Most likely the value is cut off at the end of the buffer; read more
+                # (doubling, so very large values don't get re-parsed many times)
+                if not self._fill(max(self.read_size, len(self.buf))):
+                    raise
+                continue
+            # A number cut off by the end of the buffer decodes as a shorter one ('12.' as 12,
+            # '1.5e' as 1.5), so it is only complete once a delimiter follows it
+            if (not isinstance(value, (dict, list, str)) and not self.eof
+                    and (end == len(self.buf) or self.buf[end] not in _DELIMITERS)):
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def array_items(self):
+        """Yield the elements of the array starting at the current position one by one"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {separator!r}")
+
+
+def _iter_object(stream):
+    """Yield resources from a top-level object: Bundle entries are streamed, anything else is one resource"""
+    stream.expect('{')
+    fields = {}
+    saw_entries = False
+    if stream.peek() == '}':
+        stream.pos += 1
+    else:
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'entry' and stream.peek() == '[':
+                saw_entries = True
+                for entry in stream.array_items():
+                    if isinstance(entry, dict) and isinstance(entry.get('resource'), dict):
+                        yield entry['resource']
+            else:
+                fields[key] = stream.value()
+            separator = stream.peek()
+            stream.pos += 1
+            if separator == '}':
+                break
+            if separator != ',':
+                raise ValueError(f"Expected ',' or '}}' in JSON object, found {separator!r}")
+
+    if not saw_entries and fields.get('resourceType') != 'Bundle':
+        yield fields
+
+
+def iter_ndjson_lines(file_path):
+    """Yield the raw non-empty lines of an NDJSON file, leaving parsing to the caller"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def _iter_ndjson(file_path, resource_type=None):
+    """Yield resources from a newline-delimited JSON file, one line at a time"""
+    for line in iter_ndjson_lines(file_path):
+        resource = json.loads(line)
+        if resource_type and resource.get('resourceType') != resource_type:
+            continue
+        yield resource
+
+
+def iter_resources(file_path, resource_type=None, read_size=DEFAULT_READ_SIZE):
+    """Yield FHIR resources one at a time from a Bundle, a JSON array, a single resource or NDJSON.
+
+    If resource_type is given, other resource types are skipped.
+    """
+    if file_path.endswith('.ndjson'):
+        yield from _iter_ndjson(file_path, resource_type)
+        return
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        stream = _JSONStream(f, read_size)
+        # NDJSON is just a sequence of top-level objects, so keep reading until EOF
+        while True:
+            first = stream.peek()
+            if first is None:
+                return
+            if first == '{':
+                resources = _iter_object(stream)
+            elif first == '[':
+                resources = stream.array_items()
+            else:
+                raise ValueError(f"Unexpected {first!r} at top level of {file_path}")
+
+            for resource in resources:
+                if not isinstance(resource, dict):
+                    continue
+                if resource_type and resource.get('resourceType') != resource_type:
+                    continue
+                yield resource
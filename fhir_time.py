@@ -0,0 +1,96 @@
+import math
+from datetime import date, datetime, timezone
+
+_UTC = timezone.utc
+
+
+def parse_fhir_datetime(value):
+    """UTC Unix time in seconds of a FHIR date, dateTime or instant string; None if it isn't one.
+
+    Partial dates (YYYY, YYYY-MM) and dates stand for their first instant,
+    and a time without a zone is taken as UTC. Fractions of a second are
+    dropped.
+    """
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    try:
+        if len(value) == 4:
+            moment = datetime(int(value), 1, 1, tzinfo=_UTC)
+        elif len(value) == 7 and value[4] == '-':
+            moment = datetime(int(value[:4]), int(value[5:]), 1, tzinfo=_UTC)
+        elif len(value) == 10:
+            moment = datetime.combine(date.fromisoformat(value), datetime.min.time(), _UTC)
+        else:
+            moment = datetime.fromisoformat(value)
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=_UTC)
+    except (ValueError, OverflowError):
+        return None
+    return math.floor(moment.timestamp())
+
+
+def fhir_period_end(value):
+    """Exclusive end, in UTC Unix time, of the span a FHIR date or dateTime string covers.
+
+    '2015-01-22' ends at the start of 2015-01-23, '2015-01' at the start of
+    February and a full dateTime one second after itself, so an inclusive
+    upper bound given at any precision becomes `epoch < fhir_period_end(bound)`.
+    """
+    start = parse_fhir_datetime(value)
+    if start is None:
+        return None
+    value = value.strip()
+    if len(value) == 4:
+        return parse_fhir_datetime(f'{int(value) + 1:04d}')
+    if len(value) == 7:
+        year, month = int(value[:4]), int(value[5:])
+        return parse_fhir_datetime(f'{year + month // 12:04d}-{month % 12 + 1:02d}')
+    if len(value) == 10:
+        return start + 86400
+    return start + 1
+
+
+def to_epochs(values, cache=None):
+    """parse_fhir_datetime over a batch of values, parsing each distinct string once.
+
+    Timestamps in a chunk of resources repeat a lot (dates, or the same
+    instant on many rows), so a shared cache dict spares most of the parsing.
+    """
+    if cache is None:
+        cache = {}
+    epochs = []
+    for value in values:
+        try:
+            epochs.append(cache[value])
+        except KeyError:
+            epoch = cache[value] = parse_fhir_datetime(value)
+            epochs.append(epoch)
+    return epochs
+
+
+def add_epoch_columns(rows, positions):
+    """Append the epochs of the timestamp strings at `positions` to every row tuple, column by column"""
+    if not positions or not rows:
+        return rows
+    cache = {}
+    columns = [to_epochs([row[position] for row in rows], cache) for position in positions]
+    return [row + epochs for row, epochs in zip(rows, zip(*columns))]
+
+
+def epoch_range(date_from=None, date_to=None):
+    """(start, end) UTC Unix times for an inclusive date range given as FHIR dates or dateTimes.
+
+    Matching epochs satisfy start <= epoch < end; a bound that is None stays
+    None. Raises ValueError for a bound that isn't a date.
+    """
+    start = end = None
+    if date_from:
+        start = parse_fhir_datetime(date_from)
+        if start is None:
+            raise ValueError(f"invalid date {date_from!r}")
+    if date_to:
+        end = fhir_period_end(date_to)
+        if end is None:
+            raise ValueError(f"invalid date {date_to!r}")
+    return start, end
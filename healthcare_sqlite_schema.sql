@@ -1,10 +1,8 @@
 -- SQLite Healthcare Database Schema (Simplified)
 -- Based on FHIR resources: Medication, MedicationRequest, MedicationAdministration
 
--- Drop tables if they exist to ensure clean creation
-DROP TABLE IF EXISTS medication_administration;
-DROP TABLE IF EXISTS medication_request;
-DROP TABLE IF EXISTS medication;
+-- Reference only: databases are created and upgraded by schema_migrations.py
+-- (run db_connect.py); keep this file in step with the migrations
 
 -- Medication table - stores basic medication information
 CREATE TABLE medication (
@@ -21,7 +19,7 @@ CREATE TABLE medication (
 CREATE TABLE medication_request (
     medication_request_id INTEGER PRIMARY KEY AUTOINCREMENT,  -- Internal auto-incremental ID
     medication_request_id_external TEXT UNIQUE,              -- External FHIR resource ID
-    medication_id TEXT,          -- Reference to medication
+    medication_id_external TEXT, -- External ID of the (contained) medication
     medication TEXT,             -- Display name of medication (for cases without medication_id)
     status TEXT,                 -- Status of request (active, completed, etc.)
     practitioner_id TEXT,        -- Prescriber identifier
@@ -36,18 +34,22 @@ CREATE TABLE medication_request (
     timing_period REAL,          -- Period value
     timing_period_unit TEXT,     -- Period unit (day, week, etc.)
     timing_start TEXT,           -- When to start taking
-    timing_end TEXT              -- When to stop taking
+    timing_end TEXT,             -- When to stop taking
+    medication_id INTEGER REFERENCES medication(medication_id),  -- Resolved medication
+    authored_at INTEGER,         -- authored_on as UTC Unix time
+    timing_start_at INTEGER,     -- timing_start as UTC Unix time
+    timing_end_at INTEGER        -- timing_end as UTC Unix time
 );
 
 -- MedicationAdministration table - stores information about medication administration
 CREATE TABLE medication_administration (
     medication_administration_id INTEGER PRIMARY KEY AUTOINCREMENT,  -- Internal auto-incremental ID
     medication_administration_id_external TEXT UNIQUE,              -- External FHIR resource ID
-    medication_id TEXT,          -- Reference to medication
+    medication_id_external TEXT, -- External ID of the (contained) medication
     medication_display TEXT,     -- Display name of medication (for cases without medication_id)
     status TEXT,                 -- Status of administration (completed, etc.)
     practitioner_id TEXT,        -- Administering practitioner identifier
-    request_id TEXT,             -- Associated medication request
+    medication_request_id_external TEXT,  -- External ID of the associated medication request
     encounter_id TEXT,           -- Associated encounter
     effective_start TEXT,        -- When administration started
     effective_end TEXT,          -- When administration ended
@@ -55,5 +57,40 @@ CREATE TABLE medication_administration (
     dosage_route TEXT,           -- Route of administration
     dosage_method TEXT,          -- Method of administration
     dosage_quantity REAL,        -- Dose quantity
-    dosage_unit TEXT             -- Dose unit
+    dosage_unit TEXT,            -- Dose unit
+    medication_id INTEGER REFERENCES medication(medication_id),  -- Resolved medication
+    medication_request_id INTEGER REFERENCES medication_request(medication_request_id),  -- Resolved request
+    effective_start_at INTEGER,  -- effective_start as UTC Unix time
+    effective_end_at INTEGER     -- effective_end as UTC Unix time
+);
+
+-- Indexes for the medication query paths
+-- Meds per encounter, covering the columns a medication list shows, in time order
+CREATE INDEX idx_medication_request_encounter ON medication_request(encounter_id, authored_at, medication_id, status);
+CREATE INDEX idx_medication_administration_encounter ON medication_administration(encounter_id, effective_start_at, medication_id, status);
+CREATE INDEX idx_medication_administration_request ON medication_administration(medication_request_id);
+CREATE INDEX idx_medication_request_medication ON medication_request(medication_id);
+CREATE INDEX idx_medication_administration_medication ON medication_administration(medication_id);
+-- Time ranges, on the UTC epoch columns
+CREATE INDEX idx_medication_request_authored ON medication_request(authored_at);
+CREATE INDEX idx_medication_request_timing ON medication_request(timing_start_at, timing_end_at);
+CREATE INDEX idx_medication_administration_effective ON medication_administration(effective_start_at, effective_end_at);
+
+-- Per-encounter medication totals, kept current by triggers on medication_request and
+-- medication_administration (see medication_timeline.py)
+CREATE TABLE medication_encounter_summary (
+    encounter_id TEXT NOT NULL,         -- Encounter of the requests and administrations
+    medication_id INTEGER NOT NULL,     -- Resolved medication, 0 when unresolved
+    dose_unit TEXT NOT NULL,            -- Dose unit, '' when none is given
+    medication TEXT,                    -- Display name of medication
+    request_count INTEGER NOT NULL DEFAULT 0,         -- Orders
+    administration_count INTEGER NOT NULL DEFAULT 0,  -- Administrations, given or not
+    given_count INTEGER NOT NULL DEFAULT 0,           -- Administrations that gave a dose
+    dose_total REAL,                    -- Sum of the doses given, in dose_unit
+    first_ordered_at INTEGER,           -- First and last authored_on (Unix time)
+    last_ordered_at INTEGER,
+    first_given_at INTEGER,             -- First and last dose given (Unix time)
+    last_given_at INTEGER,
+    PRIMARY KEY (encounter_id, medication_id, dose_unit)
 );
+CREATE INDEX idx_medication_summary_medication ON medication_encounter_summary(medication_id, encounter_id);
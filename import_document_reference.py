@@ -1,9 +1,16 @@
 import json
-import sqlite3
 import os
 import base64
 import logging
-from datetime import datetime
+import argparse
+from itertools import chain
+from db_connection import get_connection
+from fhir_stream import iter_resources
+from fhir_time import parse_fhir_datetime, to_epochs
+from ingest_pipeline import run_pipeline, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+from note_content_store import content_hash, store_blobs, lookup_source_urls
+from note_search import suspend_search_index, resume_search_index, index_new_versions
+from ingest_metrics import METRICS, add_arguments as add_metrics_arguments, configure_from_args as configure_metrics
 
 # Set up logging
 logging.basicConfig(
@@ -13,174 +20,218 @@ logging.basicConfig(
     filemode='w'
 )
 
+# Number of documents written per transaction in bulk mode
+DEFAULT_CHUNK_SIZE = 5000
+
 # Database connection
 def get_db_connection():
-    conn = sqlite3.connect('healthcare.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_connection()
 
-# Function to create tables if they don't exist
-def ensure_tables_exist():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Function to extract (code, display) pairs from a DocumentReference's categories
+def extract_document_categories(doc):
+    categories = []
+    if 'category' in doc and isinstance(doc['category'], list):
+        for category in doc['category']:
+            if 'coding' in category and isinstance(category['coding'], list):
+                for coding in category['coding']:
+                    if 'code' in coding and 'display' in coding:
+                        categories.append((coding['code'], coding['display']))
+    return categories
+
+# Function to load every category code -> category_id pair
+def load_category_map(cursor):
+    cursor.execute("SELECT category_code, category_id FROM note_category")
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+# In-memory category lookup that refreshes from the importer's connection only on a miss
+class CategoryCache:
+    def __init__(self, category_map=None):
+        self.category_map = dict(category_map or {})
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
     
-    # Read the schema file
-    with open('clinical_notes_schema_corrected.sql', 'r') as f:
-        schema_script = f.read()
+    def discover(self, cursor, categories):
+        # Insert categories seen for the first time, so imports need no separate category pass
+        for category_code, category_display in categories:
+            if self.category_map.get(category_code) is not None:
+                continue
+            cursor.execute(
+                "INSERT OR IGNORE INTO note_category (category_code, category_display) VALUES (?, ?)",
+                (category_code, category_display)
+            )
+            self.added += cursor.rowcount
+            cursor.execute(
+                "SELECT category_id FROM note_category WHERE category_code = ?",
+                (category_code,)
+            )
+            self.category_map[category_code] = cursor.fetchone()[0]
     
-    # Execute the schema script
-    try:
-        cursor.executescript(schema_script)
-        conn.commit()
-        logging.info("Database schema created or verified successfully")
-    except sqlite3.Error as e:
-        logging.error(f"Error creating schema: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
-
-# Function to import categories from DocumentReference
-def import_categories(doc_references):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    categories_added = 0
+    def invalidate(self):
+        # Forget everything after a rollback, since discovered categories may have been undone
+        self.category_map = {}
     
-    try:
-        # Extract unique categories from all documents
-        unique_categories = set()
-        for doc in doc_references:
-            if 'category' in doc and isinstance(doc['category'], list):
-                for category in doc['category']:
-                    if 'coding' in category and isinstance(category['coding'], list):
-                        for coding in category['coding']:
-                            if 'code' in coding and 'display' in coding:
-                                unique_categories.add((coding['code'], coding['display']))
-        
-        # Insert unique categories
-        for code, display in unique_categories:
-            try:
-                cursor.execute(
-                    "INSERT INTO note_category (category_code, category_display) VALUES (?, ?)",
-                    (code, display)
-                )
-                categories_added += 1
-            except sqlite3.IntegrityError:
-                # Category already exists (due to UNIQUE constraint)
-                pass
+    def get(self, cursor, category_code):
+        if category_code is None:
+            return None
+        if category_code in self.category_map:
+            self.hits += 1
+            return self.category_map[category_code]
         
-        conn.commit()
-        logging.info(f"Imported {categories_added} categories")
-    except Exception as e:
-        logging.error(f"Error importing categories: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        # Unknown code: reload the map using the caller's cursor (no new connection),
+        # and remember codes that are still missing so they don't trigger another reload
+        self.misses += 1
+        self.category_map = load_category_map(cursor)
+        self.category_map.setdefault(category_code, None)
+        return self.category_map[category_code]
     
-    return categories_added
+    def log_stats(self):
+        logging.info(f"Category cache: {self.hits} hits, {self.misses} misses (each miss reloads on the importer connection), "
+                     f"{self.added} categories discovered")
 
-# Function to get category_id from code
-def get_category_id(category_code):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Function to extract note and version fields from a DocumentReference
+def extract_document_fields(doc):
+    # Extract basic metadata
+    doc_id = doc.get('id')
     
-    try:
-        cursor.execute(
-            "SELECT category_id FROM note_category WHERE category_code = ?",
-            (category_code,)
-        )
-        result = cursor.fetchone()
-        if result:
-            return result['category_id']
-        return None
-    except Exception as e:
-        logging.error(f"Error getting category ID: {e}")
-        return None
-    finally:
-        conn.close()
+    # Get document type
+    note_type = None
+    note_type_code = None
+    if 'type' in doc and 'coding' in doc['type'] and len(doc['type']['coding']) > 0:
+        note_type = doc['type']['coding'][0].get('display')
+        note_type_code = doc['type']['coding'][0].get('code')
+    
+    # Get category code (resolved to category_id by the caller)
+    category_code = None
+    if 'category' in doc and isinstance(doc['category'], list) and len(doc['category']) > 0:
+        if 'coding' in doc['category'][0] and isinstance(doc['category'][0]['coding'], list) and len(doc['category'][0]['coding']) > 0:
+            category_code = doc['category'][0]['coding'][0].get('code')
+    
+    # Get encounter reference
+    encounter_id = None
+    if 'context' in doc and 'encounter' in doc['context'] and isinstance(doc['context']['encounter'], list) and len(doc['context']['encounter']) > 0:
+        encounter_ref = doc['context']['encounter'][0].get('reference', '')
+        if encounter_ref.startswith('Encounter/'):
+            encounter_id = encounter_ref.split('/')[-1]
+    
+    # Get date
+    note_date = None
+    if 'date' in doc:
+        note_date = doc['date']
+    
+    # Server-assigned version, used to skip unchanged documents on re-import
+    source_version = (doc.get('meta') or {}).get('versionId')
+    
+    # Get content; has_version is False when there is no attachment to store.
+    # Inline attachments become a payload keyed by its SHA-256 (hashed here, so the
+    # work is spread over pipeline workers) and are written once to note_blob
+    has_version = False
+    note_text = None
+    payload = None
+    payload_hash = None
+    content_type = None
+    practitioner_id = None
+    if 'content' in doc and isinstance(doc['content'], list) and len(doc['content']) > 0:
+        content_item = doc['content'][0]
+        if 'attachment' in content_item:
+            has_version = True
+            attachment = content_item['attachment']
+            
+            # Get text content - could be in 'data' (base64) or 'url' field
+            if 'data' in attachment:
+                try:
+                    # Try to decode base64 data
+                    with METRICS.timer('decode'):
+                        payload = base64.b64decode(attachment['data'], validate=True)
+                        payload_hash = content_hash(payload)
+                    METRICS.add_bytes('attachment', len(payload))
+                    content_type = attachment.get('contentType') or 'application/octet-stream'
+                except Exception as e:
+                    logging.warning(f"Could not decode base64 data for document {doc_id}: {e}")
+                    note_text = attachment['data']  # Store as is if can't decode
+            elif 'url' in attachment:
+                note_text = f"URL: {attachment['url']}"  # Store URL reference
+            
+            # Get author/practitioner
+            if 'author' in doc and isinstance(doc['author'], list) and len(doc['author']) > 0:
+                author_ref = doc['author'][0].get('reference', '')
+                if author_ref.startswith('Practitioner/'):
+                    practitioner_id = author_ref.split('/')[-1]
+    
+    # Fingerprint of the attachment as received: the payload hash for inline data,
+    # otherwise a hash of the URL reference (or undecodable data) text
+    source_hash = payload_hash
+    if source_hash is None and note_text is not None:
+        source_hash = content_hash(note_text.encode('utf-8'))
+    
+    return {
+        'doc_id': doc_id,
+        'categories': extract_document_categories(doc),
+        'category_code': category_code,
+        'note_type': note_type,
+        'note_type_code': note_type_code,
+        'encounter_id': encounter_id,
+        'note_date': note_date,
+        'has_version': has_version,
+        'note_text': note_text,
+        'payload': payload,
+        'content_type': content_type,
+        'content_hash': payload_hash,
+        'practitioner_id': practitioner_id,
+        'source_version': source_version,
+        'source_hash': source_hash,
+    }
 
 # Function to import DocumentReference resources
-def import_document_references(doc_references):
+def import_document_references(doc_references, category_map=None):
     conn = get_db_connection()
     cursor = conn.cursor()
+    category_cache = CategoryCache(category_map)
     notes_added = 0
     versions_added = 0
+    bytes_written = 0
+    bytes_saved = 0
     
     try:
         for doc in doc_references:
             try:
-                # Extract basic metadata
-                doc_id = doc.get('id')
-                status = doc.get('status', 'unknown')
-                doc_status = doc.get('docStatus', 'unknown')
-                
-                # Get document type
-                note_type = None
-                note_type_code = None
-                if 'type' in doc and 'coding' in doc['type'] and len(doc['type']['coding']) > 0:
-                    note_type = doc['type']['coding'][0].get('display')
-                    note_type_code = doc['type']['coding'][0].get('code')
-                
-                # Get category
-                category_id = None
-                if 'category' in doc and isinstance(doc['category'], list) and len(doc['category']) > 0:
-                    if 'coding' in doc['category'][0] and isinstance(doc['category'][0]['coding'], list) and len(doc['category'][0]['coding']) > 0:
-                        category_code = doc['category'][0]['coding'][0].get('code')
-                        if category_code:
-                            category_id = get_category_id(category_code)
-                
-                # Get encounter reference
-                encounter_id = None
-                if 'context' in doc and 'encounter' in doc['context'] and isinstance(doc['context']['encounter'], list) and len(doc['context']['encounter']) > 0:
-                    encounter_ref = doc['context']['encounter'][0].get('reference', '')
-                    if encounter_ref.startswith('Encounter/'):
-                        encounter_id = encounter_ref.split('/')[-1]
-                
-                # Get date
-                note_date = None
-                if 'date' in doc:
-                    note_date = doc['date']
+                with METRICS.timer('extract'):
+                    fields = extract_document_fields(doc)
+                METRICS.count('documents')
                 
-                # Insert note record
-                cursor.execute(
-                    """INSERT INTO note 
-                       (note_id_external, category_id, note_type, note_type_code, encounter_id, note_date) 
-                       VALUES (?, ?, ?, ?, ?, ?)""",
-                    (doc_id, category_id, note_type, note_type_code, encounter_id, note_date)
-                )
-                note_id = cursor.lastrowid
-                notes_added += 1
+                category_cache.discover(cursor, fields['categories'])
+                category_id = category_cache.get(cursor, fields['category_code'])
                 
-                # Get content
-                if 'content' in doc and isinstance(doc['content'], list) and len(doc['content']) > 0:
-                    content_item = doc['content'][0]
-                    if 'attachment' in content_item:
-                        attachment = content_item['attachment']
-                        
-                        # Get text content - could be in 'data' (base64) or 'url' field
-                        note_text = None
-                        if 'data' in attachment:
-                            try:
-                                # Try to decode base64 data
-                                note_text = base64.b64decode(attachment['data']).decode('utf-8')
-                            except Exception as e:
-                                logging.warning(f"Could not decode base64 data for document {doc_id}: {e}")
-                                note_text = attachment['data']  # Store as is if can't decode
-                        elif 'url' in attachment:
-                            note_text = f"URL: {attachment['url']}"  # Store URL reference
-                        
-                        # Get author/practitioner
-                        practitioner_id = None
-                        if 'author' in doc and isinstance(doc['author'], list) and len(doc['author']) > 0:
-                            author_ref = doc['author'][0].get('reference', '')
-                            if author_ref.startswith('Practitioner/'):
-                                practitioner_id = author_ref.split('/')[-1]
+                with METRICS.timer('insert'):
+                    # Insert note record
+                    cursor.execute(
+                        """INSERT INTO note 
+                           (note_id_external, category_id, note_type, note_type_code, encounter_id, note_date,
+                            note_date_at, source_version, source_hash) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (fields['doc_id'], category_id, fields['note_type'], fields['note_type_code'],
+                         fields['encounter_id'], fields['note_date'], parse_fhir_datetime(fields['note_date']),
+                         fields['source_version'], fields['source_hash'])
+                    )
+                    note_id = cursor.lastrowid
+                    notes_added += 1
+                    
+                    if fields['has_version']:
+                        # Write the payload only if no other version already stored it
+                        if fields['content_hash']:
+                            written, saved = store_blobs(cursor, [(fields['content_hash'], fields['payload'], fields['content_type'])])
+                            bytes_written += written
+                            bytes_saved += saved
+                            METRICS.add_bytes('blob_written', written)
+                            METRICS.add_bytes('blob_deduplicated', saved)
                         
                         # Insert note version
                         cursor.execute(
                             """INSERT INTO note_version 
-                               (note_id, version_number, note_text, practioner_id) 
-                               VALUES (?, ?, ?, ?)""",
-                            (note_id, 1, note_text, practitioner_id)
+                               (note_id, version_number, note_text, practioner_id, content_type, content_hash) 
+                               VALUES (?, ?, ?, ?, ?, ?)""",
+                            (note_id, 1, fields['note_text'], fields['practitioner_id'],
+                             fields['content_type'], fields['content_hash'])
                         )
                         version_id = cursor.lastrowid
                         versions_added += 1
@@ -190,13 +241,20 @@ def import_document_references(doc_references):
                             "UPDATE note SET current_version_id = ? WHERE note_id = ?",
                             (version_id, note_id)
                         )
-                
-                conn.commit()
+                    
+                with METRICS.timer('commit'):
+                    conn.commit()
+                METRICS.count('notes_inserted')
+                METRICS.count('versions_inserted', int(fields['has_version']))
             except Exception as e:
                 logging.error(f"Error processing document {doc.get('id', 'unknown')}: {e}")
+                METRICS.error('document')
                 conn.rollback()
+                category_cache.invalidate()
         
         logging.info(f"Imported {notes_added} notes with {versions_added} versions")
+        logging.info(f"Blob store: {bytes_written} payload bytes written, {bytes_saved} bytes saved by deduplication")
+        category_cache.log_stats()
     except Exception as e:
         logging.error(f"Error in import process: {e}")
         conn.rollback()
@@ -205,47 +263,366 @@ def import_document_references(doc_references):
     
     return notes_added, versions_added
 
+# Function to get the next AUTOINCREMENT id for a table
+def get_next_rowid(cursor, table, id_column):
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+    row = cursor.fetchone()
+    seq = row[0] if row else 0
+    cursor.execute(f"SELECT COALESCE(MAX({id_column}), 0) FROM {table}")
+    return max(seq, cursor.fetchone()[0]) + 1
+
+# Function to extract fields from each document, logging and skipping bad ones
+def iter_document_fields(doc_references):
+    for doc in doc_references:
+        try:
+            with METRICS.timer('extract'):
+                fields = extract_document_fields(doc)
+        except Exception as e:
+            logging.error(f"Error processing document {doc.get('id', 'unknown')}: {e}")
+            continue
+        METRICS.count('documents')
+        yield fields
+
+# Function run in pipeline worker processes: turn raw documents into insert-ready fields
+def transform_documents(doc_references):
+    return list(iter_document_fields(doc_references))
+
+# Function to bulk import DocumentReference resources in chunked transactions
+def import_document_references_bulk(doc_references, chunk_size=DEFAULT_CHUNK_SIZE, category_map=None,
+                                    incremental=False):
+    return write_note_fields_bulk(iter_document_fields(doc_references), chunk_size, category_map, incremental)
+
+# Function to bulk import with extraction spread over a process pool and a single writer thread
+def import_document_references_parallel(doc_references, chunk_size=DEFAULT_CHUNK_SIZE,
+                                        workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH,
+                                        incremental=False):
+    return run_pipeline(
+        doc_references,
+        transform_documents,
+        lambda results: write_note_fields_bulk(chain.from_iterable(results), chunk_size, incremental=incremental),
+        workers=workers,
+        queue_depth=queue_depth,
+    )
+
+# Function to find the notes already imported for a chunk of documents, keyed by note_id_external.
+# Where earlier non-incremental runs imported a document more than once, the newest note wins
+def find_existing_notes(cursor, doc_ids):
+    cursor.execute(
+        """SELECT n.note_id, n.note_id_external, n.source_version, n.source_hash,
+                  nv.note_text, nv.content_hash,
+                  (SELECT MAX(version_number) FROM note_version WHERE note_id = n.note_id) AS version_number
+           FROM note n
+           LEFT JOIN note_version nv ON nv.version_id = n.current_version_id
+           WHERE n.note_id IN (
+               SELECT MAX(note_id) FROM note
+               WHERE note_id_external IN (SELECT value FROM json_each(?))
+               GROUP BY note_id_external
+           )""",
+        (json.dumps([doc_id for doc_id in doc_ids if doc_id is not None]),)
+    )
+    return {row['note_id_external']: dict(row) for row in cursor.fetchall()}
+
+# Function to tell whether a re-imported document carries content its note doesn't have yet.
+# fetched_urls maps Binary URLs to the blobs they were fetched into (see lookup_source_urls)
+def content_changed(fields, note, fetched_urls):
+    if not fields['has_version']:
+        # Nothing to version; metadata changes are applied to the note itself
+        return False
+    if note['source_version'] and note['source_version'] == fields['source_version']:
+        return False
+    if note['source_hash']:
+        return note['source_hash'] != fields['source_hash']
+    
+    # Notes imported before fingerprints were kept: compare with the current version
+    if note['note_text'] is None and note['content_hash'] is None:
+        return True
+    if fields['content_hash']:
+        return note['content_hash'] != fields['content_hash']
+    if note['note_text'] == fields['note_text']:
+        return False
+    # A URL reference that has been fetched since only has the payload it pointed to
+    fetched = fetched_urls.get(reference_url(fields['note_text']))
+    return fetched is None or fetched[0] != note['content_hash']
+
+# Function to compare meta.versionId values; they are opaque in FHIR, so only
+# numeric ones (what most servers assign) are ordered
+def is_older_version(version, than):
+    if version and than and version.isdigit() and than.isdigit():
+        return int(version) < int(than)
+    return False
+
+# Function to get the Binary URL out of a 'URL: <url>' note_text, or None
+def reference_url(note_text):
+    if note_text and note_text.startswith('URL: '):
+        return note_text[5:].strip()
+    return None
+
+# Function to write extracted document fields in chunked transactions.
+# With incremental, documents are matched to existing notes by note_id_external: unchanged
+# ones cost a lookup, changed content appends a version and metadata changes update the note
+def write_note_fields_bulk(document_fields, chunk_size=DEFAULT_CHUNK_SIZE, category_map=None, incremental=False):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    category_cache = CategoryCache(category_map)
+    notes_added = 0
+    versions_added = 0
+    notes_updated = 0
+    notes_unchanged = 0
+    failed_chunks = 0
+    first_note_id = None
+    bytes_written = 0
+    bytes_saved = 0
+    
+    def flush(chunk):
+        # Reserve ids up front so notes and versions can be inserted with executemany;
+        # BEGIN IMMEDIATE holds the write lock so the reserved range stays ours
+        cursor.execute("BEGIN IMMEDIATE")
+        note_id = get_next_rowid(cursor, 'note', 'note_id')
+        version_id = get_next_rowid(cursor, 'note_version', 'version_id')
+        start_note_id = note_id
+        start_version_id = version_id
+        # The chunk's versions are indexed for search together below, not row by row
+        suspend_search_index(cursor)
+        
+        existing = {}
+        fetched_urls = {}
+        if incremental:
+            # A document listed more than once is taken at its last occurrence, so
+            # re-running the same file doesn't flip the note between its copies
+            last_seen = {fields['doc_id']: fields for fields in chunk if fields['doc_id'] is not None}
+            chunk = [fields for fields in chunk if fields['doc_id'] is None or last_seen[fields['doc_id']] is fields]
+            with METRICS.timer('lookup'):
+                existing = find_existing_notes(cursor, last_seen)
+            legacy_urls = [
+                reference_url(fields['note_text']) for fields in chunk
+                if fields['doc_id'] in existing and not existing[fields['doc_id']]['source_hash']
+                and reference_url(fields['note_text'])
+            ]
+            if legacy_urls:
+                fetched_urls = lookup_source_urls(cursor, legacy_urls)
+        
+        # Note dates are parsed for the whole chunk at once
+        for fields, note_date_at in zip(chunk, to_epochs([fields['note_date'] for fields in chunk])):
+            fields['note_date_at'] = note_date_at
+        
+        note_rows = []
+        version_rows = []
+        note_updates = []
+        replaced_note_ids = []
+        blobs = []
+        stale = 0
+        for fields in chunk:
+            note = existing.get(fields['doc_id'])
+            if note and is_older_version(fields['source_version'], note['source_version']):
+                # An earlier copy of the document than the one already imported
+                stale += 1
+                continue
+            new_version_id = None
+            if note is None or content_changed(fields, note, fetched_urls):
+                if fields['has_version']:
+                    new_version_id = version_id
+                    version_number = note['version_number'] + 1 if note and note['version_number'] else 1
+                    version_rows.append((version_id, note['note_id'] if note else note_id, version_number,
+                                         fields['note_text'], fields['practitioner_id'],
+                                         fields['content_type'], fields['content_hash']))
+                    if fields['content_hash']:
+                        blobs.append((fields['content_hash'], fields['payload'], fields['content_type']))
+                    if note:
+                        replaced_note_ids.append(note['note_id'])
+                    version_id += 1
+            
+            if note is None:
+                note_rows.append((
+                    note_id, fields['doc_id'], fields['category_id'],
+                    fields['note_type'], fields['note_type_code'], fields['encounter_id'], fields['note_date'],
+                    fields['note_date_at'], fields['source_version'], fields['source_hash']
+                ))
+                if incremental and fields['doc_id'] is not None:
+                    # A later copy of the same document in this chunk is compared against this one
+                    existing[fields['doc_id']] = {
+                        'note_id': note_id, 'source_version': fields['source_version'],
+                        'source_hash': fields['source_hash'], 'note_text': fields['note_text'],
+                        'content_hash': fields['content_hash'], 'version_number': 1 if new_version_id else None,
+                    }
+                note_id += 1
+                continue
+            
+            note_updates.append({
+                'note_id': note['note_id'], 'category_id': fields['category_id'],
+                'note_type': fields['note_type'], 'note_type_code': fields['note_type_code'],
+                'encounter_id': fields['encounter_id'], 'note_date': fields['note_date'],
+                'note_date_at': fields['note_date_at'],
+                'source_version': fields['source_version'], 'source_hash': fields['source_hash'],
+                'version_id': new_version_id,
+            })
+            note.update(source_version=fields['source_version'], source_hash=fields['source_hash'])
+            if new_version_id:
+                note['version_number'] = (note['version_number'] or 0) + 1
+        
+        with METRICS.timer('insert'):
+            cursor.executemany(
+                """INSERT INTO note 
+                   (note_id, note_id_external, category_id, note_type, note_type_code, encounter_id, note_date,
+                    note_date_at, source_version, source_hash) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                note_rows
+            )
+            # Payloads already in note_blob (from this or earlier imports) are not written again
+            written, saved = store_blobs(cursor, blobs)
+            cursor.executemany(
+                """INSERT INTO note_version 
+                   (version_id, note_id, version_number, note_text, practioner_id, content_type, content_hash) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                version_rows
+            )
+        with METRICS.timer('index'):
+            index_new_versions(cursor, start_version_id, version_id, replaced_note_ids)
+            resume_search_index(cursor)
+        # Only notes whose metadata, fingerprint or current version differ are written
+        updated = 0
+        if note_updates:
+            with METRICS.timer('update'):
+                cursor.executemany(
+                    """UPDATE note SET category_id = :category_id, note_type = :note_type,
+                           note_type_code = :note_type_code, encounter_id = :encounter_id, note_date = :note_date,
+                           note_date_at = :note_date_at, source_version = :source_version, source_hash = :source_hash,
+                           current_version_id = COALESCE(:version_id, current_version_id),
+                           updated_at = CURRENT_TIMESTAMP
+                       WHERE note_id = :note_id AND (
+                           :version_id IS NOT NULL OR category_id IS NOT :category_id OR note_type IS NOT :note_type
+                           OR note_type_code IS NOT :note_type_code OR encounter_id IS NOT :encounter_id
+                           OR note_date IS NOT :note_date OR note_date_at IS NOT :note_date_at
+                           OR source_version IS NOT :source_version
+                           OR source_hash IS NOT :source_hash)""",
+                    note_updates
+                )
+                updated = cursor.rowcount
+        with METRICS.timer('commit'):
+            conn.commit()
+        return start_note_id, len(note_rows), len(version_rows), updated, len(note_updates) - updated + stale, written, saved
+    
+    def import_chunk(chunk, chunk_index):
+        nonlocal notes_added, versions_added, notes_updated, notes_unchanged, failed_chunks, first_note_id
+        nonlocal bytes_written, bytes_saved
+        try:
+            start_note_id, chunk_notes, chunk_versions, updated, unchanged, written, saved = flush(chunk)
+        except Exception as e:
+            # Only this chunk is lost; earlier chunks are already committed
+            logging.error(f"Error importing chunk {chunk_index} ({len(chunk)} documents), rolled back: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            failed_chunks += 1
+            METRICS.error('chunk')
+            return
+        if first_note_id is None:
+            first_note_id = start_note_id
+        notes_added += chunk_notes
+        versions_added += chunk_versions
+        notes_updated += updated
+        notes_unchanged += unchanged
+        bytes_written += written
+        bytes_saved += saved
+        METRICS.count('notes_inserted', chunk_notes)
+        METRICS.count('versions_inserted', chunk_versions)
+        METRICS.count('notes_updated', updated)
+        METRICS.count('notes_unchanged', unchanged)
+        METRICS.add_bytes('blob_written', written)
+        METRICS.add_bytes('blob_deduplicated', saved)
+    
+    isolation_level = conn.isolation_level
+    try:
+        # Let flush() manage transactions explicitly
+        conn.isolation_level = None
+        
+        chunk = []
+        chunk_index = 0
+        for fields in document_fields:
+            try:
+                # Categories are autocommitted here, outside the chunk transaction,
+                # so a rolled-back chunk never leaves the cache pointing at a missing row
+                category_cache.discover(cursor, fields['categories'])
+                fields['category_id'] = category_cache.get(cursor, fields['category_code'])
+                chunk.append(fields)
+            except Exception as e:
+                logging.error(f"Error resolving categories for document {fields['doc_id']}: {e}")
+                METRICS.error('categories')
+                continue
+            
+            if len(chunk) >= chunk_size:
+                import_chunk(chunk, chunk_index)
+                chunk = []
+                chunk_index += 1
+        
+        if chunk:
+            import_chunk(chunk, chunk_index)
+        
+        # Point every imported note at its latest version in a single pass
+        if first_note_id is not None:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(
+                """UPDATE note 
+                   SET current_version_id = (SELECT MAX(nv.version_id) FROM note_version nv WHERE nv.note_id = note.note_id) 
+                   WHERE note_id >= ? AND current_version_id IS NULL""",
+                (first_note_id,)
+            )
+            conn.commit()
+        
+        logging.info(f"Bulk imported {notes_added} notes with {versions_added} versions ({failed_chunks} failed chunks)")
+        if incremental:
+            logging.info(f"Incremental import: {notes_updated} existing notes updated, {notes_unchanged} unchanged")
+        logging.info(f"Blob store: {bytes_written} payload bytes written, {bytes_saved} bytes saved by deduplication")
+        category_cache.log_stats()
+    except Exception as e:
+        logging.error(f"Error in bulk import process: {e}")
+        if conn.in_transaction:
+            conn.rollback()
+    finally:
+        conn.isolation_level = isolation_level
+        conn.close()
+    
+    return notes_added, versions_added
+
 # Main function
 def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Import FHIR DocumentReference resources into healthcare.db')
+    parser.add_argument('--file', default='DocumentReference_patient_12769853_data.json',
+                        help='Bundle, JSON array or NDJSON file of DocumentReference resources')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Import with batched inserts in chunked transactions')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f'Documents per transaction in bulk mode (default: {DEFAULT_CHUNK_SIZE})')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Extract documents in this many worker processes with a single writer (implies --bulk)')
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help=f'Extracted batches allowed to wait for the writer (default: {DEFAULT_QUEUE_DEPTH})')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Match documents to notes already imported and only write what changed (implies --bulk)')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    configure_metrics(args, 'import_document_reference')
+    
     try:
-        # Ensure database tables exist
-        ensure_tables_exist()
-        
         # Load DocumentReference data
-        doc_reference_file = 'DocumentReference_patient_12769853_data.json'
+        doc_reference_file = args.file
         if not os.path.exists(doc_reference_file):
             logging.error(f"File not found: {doc_reference_file}")
             return
         
-        with open(doc_reference_file, 'r') as f:
-            doc_data = json.load(f)
-        
-        # Check if it's an array or a single object
-        if isinstance(doc_data, dict):
-            if doc_data.get('resourceType') == 'Bundle' and 'entry' in doc_data:
-                # Handle FHIR Bundle
-                doc_references = [entry['resource'] for entry in doc_data['entry'] 
-                                if entry.get('resource', {}).get('resourceType') == 'DocumentReference']
-            elif doc_data.get('resourceType') == 'DocumentReference':
-                # Single DocumentReference
-                doc_references = [doc_data]
-            else:
-                doc_references = []
-        elif isinstance(doc_data, list):
-            # Array of resources
-            doc_references = [doc for doc in doc_data if doc.get('resourceType') == 'DocumentReference']
-        else:
-            doc_references = []
-        
-        logging.info(f"Found {len(doc_references)} DocumentReference resources")
-        
-        # Import categories first
-        categories_added = import_categories(doc_references)
+        # Stream resources one at a time; categories are discovered during the same pass
+        doc_references = METRICS.timed_iter('parse', iter_resources(doc_reference_file, 'DocumentReference'))
         
         # Import documents
-        notes_added, versions_added = import_document_references(doc_references)
+        if args.workers > 0:
+            notes_added, versions_added = import_document_references_parallel(
+                doc_references, args.chunk_size, args.workers, args.queue_depth, args.incremental)
+        elif args.bulk or args.incremental:
+            notes_added, versions_added = import_document_references_bulk(
+                doc_references, args.chunk_size, incremental=args.incremental)
+        else:
+            notes_added, versions_added = import_document_references(doc_references)
         
-        logging.info(f"Import complete. Added {categories_added} categories, {notes_added} notes, and {versions_added} versions.")
+        logging.info(f"Import complete. Added {notes_added} notes and {versions_added} versions.")
     
     except Exception as e:
         logging.error(f"Unexpected error in main function: {e}")
@@ -1,6 +1,56 @@
 import json
 import sqlite3
 import os
+import time
+import logging
+import argparse
+from functools import partial
+from db_connection import get_connection
+from fhir_stream import iter_resources, iter_ndjson_lines
+from fhir_time import add_epoch_columns
+from ingest_pipeline import run_pipeline, batched, DEFAULT_QUEUE_DEPTH, DEFAULT_TRANSFORM_BATCH
+from medication_references import (ExternalIdMap, KEYS, resolve_references, reference_columns,
+                                   link_medication_references, contained_medication_key)
+from ingest_metrics import METRICS, add_arguments as add_metrics_arguments, configure_from_args as configure_metrics
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='medication_import.log',
+    filemode='w'
+)
+
+# Number of rows written per executemany/transaction in NDJSON mode
+DEFAULT_BATCH_SIZE = 5000
+
+# Column order of the rows returned by the extract_* functions
+MEDICATION_COLUMNS = (
+    'medication_id_external', 'medication', 'form', 'ingredient', 'strength', 'manufacturer'
+)
+MEDICATION_REQUEST_COLUMNS = (
+    'medication_request_id_external', 'medication_id_external', 'medication', 'status',
+    'practitioner_id', 'encounter_id', 'authored_on', 'dosage_text', 'dosage_route',
+    'dosage_method', 'dosage_quantity', 'dosage_unit', 'timing_frequency', 'timing_period',
+    'timing_period_unit', 'timing_start', 'timing_end'
+)
+MEDICATION_ADMINISTRATION_COLUMNS = (
+    'medication_administration_id_external', 'medication_id_external', 'medication_display', 'status',
+    'practitioner_id', 'medication_request_id_external', 'encounter_id', 'effective_start',
+    'effective_end', 'dosage_text', 'dosage_route', 'dosage_method', 'dosage_quantity',
+    'dosage_unit'
+)
+
+# Timestamps also stored as UTC Unix time, for sorting and range queries:
+# table -> ((column with the FHIR string, epoch column), ...)
+EPOCH_COLUMNS = {
+    'medication_request': (
+        ('authored_on', 'authored_at'), ('timing_start', 'timing_start_at'), ('timing_end', 'timing_end_at'),
+    ),
+    'medication_administration': (
+        ('effective_start', 'effective_start_at'), ('effective_end', 'effective_end_at'),
+    ),
+}
 
 def load_json_file(file_path):
     """Load a JSON file and return its contents"""
@@ -12,18 +62,11 @@ def connect_to_db():
     db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'healthcare.db')
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"Database file not found at {db_path}. Please run db_connect.py first.")
-    return sqlite3.connect(db_path)
+    # Pooled connections may be handed to the pipeline writer thread (one user at a time)
+    return get_connection(db_path, row_factory=None)
 
-def import_medication(conn, medication_data):
-    """Import medication data from medication.json"""
-    cursor = conn.cursor()
-    
-    # Check if medication already exists
-    cursor.execute("SELECT medication_id FROM medication WHERE medication_id_external = ?", (medication_data['id'],))
-    if cursor.fetchone():
-        print(f"Medication {medication_data['id']} already exists, skipping...")
-        return
-    
+def extract_medication(medication_data):
+    """Extract a medication row (in MEDICATION_COLUMNS order) from a Medication resource"""
     # Extract medication data
     medication_id_external = medication_data['id']
     medication = medication_data['code']['coding'][0]['display'] if 'code' in medication_data and 'coding' in medication_data['code'] else None
@@ -58,32 +101,78 @@ def import_medication(conn, medication_data):
                 if contained['id'] == org_id and contained['resourceType'] == 'Organization':
                     manufacturer = contained.get('name')
     
-    # Insert medication data
-    cursor.execute("""
-    INSERT INTO medication (medication_id_external, medication, form, ingredient, strength, manufacturer)
-    VALUES (?, ?, ?, ?, ?, ?)
-    """, (medication_id_external, medication, form, ingredient, strength, manufacturer))
-    
-    conn.commit()
-    print(f"Imported medication: {medication_id_external}")
+    return (medication_id_external, medication, form, ingredient, strength, manufacturer)
 
-def import_medication_request(conn, request_data):
-    """Import medication request data from medication_request.json"""
+def insert_sql(table, columns, on_conflict=None):
+    """Build an INSERT statement for the given table and columns.
+
+    columns[0] must be the UNIQUE external id. on_conflict may be 'skip'
+    (DO NOTHING) or 'update' (DO UPDATE, only when a column actually changed).
+    """
+    placeholders = ', '.join('?' for _ in columns)
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    if on_conflict == 'skip':
+        sql += f" ON CONFLICT({columns[0]}) DO NOTHING"
+    elif on_conflict == 'update':
+        data_columns = columns[1:]
+        assignments = ', '.join(f"{column} = excluded.{column}" for column in data_columns)
+        current = ', '.join(f"{table}.{column}" for column in data_columns)
+        incoming = ', '.join(f"excluded.{column}" for column in data_columns)
+        sql += f" ON CONFLICT({columns[0]}) DO UPDATE SET {assignments} WHERE ({current}) IS NOT ({incoming})"
+    return sql
+
+def epoch_positions(table, columns):
+    """Positions in columns of the timestamp strings whose epochs are stored for table"""
+    return tuple(columns.index(column) for column, _ in EPOCH_COLUMNS.get(table, ()))
+
+def write_columns(table, columns):
+    """Columns written for table: the extracted ones, then their epochs, then the resolved keys"""
+    return columns + tuple(epoch for _, epoch in EPOCH_COLUMNS.get(table, ())) + reference_columns(table)
+
+def find_existing_ids(cursor, table, id_column, external_ids):
+    """Return {external id: rowid} for the external_ids already present in table, using one statement"""
+    cursor.execute(
+        f"SELECT {id_column}, rowid FROM {table} WHERE {id_column} IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(external_ids)),)
+    )
+    return dict(cursor.fetchall())
+
+def get_next_rowid(cursor, table):
+    """Next AUTOINCREMENT id of table; hold the write lock while using it"""
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+    row = cursor.fetchone()
+    seq = row[0] if row else 0
+    cursor.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}")
+    return max(seq, cursor.fetchone()[0]) + 1
+
+def import_medication(conn, medication_data):
+    """Import medication data from medication.json"""
     cursor = conn.cursor()
     
-    # Check if request already exists
-    cursor.execute("SELECT medication_request_id FROM medication_request WHERE medication_request_id_external = ?", (request_data['id'],))
-    if cursor.fetchone():
-        print(f"Medication request {request_data['id']} already exists, skipping...")
+    # Insert medication data; the UNIQUE external id makes an existing medication a no-op
+    with METRICS.timer('extract'):
+        row = extract_medication(medication_data)
+    with METRICS.timer('insert'):
+        cursor.execute(insert_sql('medication', MEDICATION_COLUMNS, 'skip'), row)
+    if cursor.rowcount == 0:
+        METRICS.count('medication_skipped')
+        logging.info(f"Medication {row[0]} already exists, skipping...")
         return
     
+    with METRICS.timer('commit'):
+        conn.commit()
+    METRICS.count('medication_inserted')
+    logging.info(f"Imported medication: {row[0]}")
+
+def extract_medication_request(request_data):
+    """Extract a medication_request row (in MEDICATION_REQUEST_COLUMNS order) from a MedicationRequest resource"""
     # Extract medication reference
-    medication_id = None
+    medication_id_external = None
     medication = None
     if 'contained' in request_data:
         for contained in request_data['contained']:
             if contained['resourceType'] == 'Medication':
-                medication_id = contained['id']
+                medication_id_external = contained_medication_key(request_data, contained)
                 if 'code' in contained and 'coding' in contained['code']:
                     medication = contained['code']['coding'][0]['display']
     
@@ -133,41 +222,52 @@ def import_medication_request(conn, request_data):
                 timing_start = repeat['boundsPeriod'].get('start')
                 timing_end = repeat['boundsPeriod'].get('end')
     
-    # Insert request data
-    cursor.execute("""
-    INSERT INTO medication_request (
-        medication_request_id_external, medication_id, medication, status,
-        practitioner_id, encounter_id, authored_on, dosage_text, dosage_route,
-        dosage_method, dosage_quantity, dosage_unit, timing_frequency, timing_period,
-        timing_period_unit, timing_start, timing_end
-    ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        medication_request_id_external, medication_id, medication, status,
+    return (
+        medication_request_id_external, medication_id_external, medication, status,
         practitioner_id, encounter_id, authored_on, dosage_text, dosage_route,
         dosage_method, dosage_quantity, dosage_unit, timing_frequency, timing_period,
-        timing_period_unit, timing_start, timing_end,  
-    ))
-    
-    conn.commit()
-    print(f"Imported medication request: {medication_request_id_external}")
+        timing_period_unit, timing_start, timing_end,
+    )
 
-def import_medication_administration(conn, admin_data):
-    """Import medication administration data from medication_administration.json"""
+def import_medication_request(conn, request_data, id_map=None):
+    """Import medication request data from medication_request.json"""
     cursor = conn.cursor()
     
-    # Check if administration already exists
-    cursor.execute("SELECT medication_administration_id FROM medication_administration WHERE medication_administration_id_external = ?", (admin_data['id'],))
-    if cursor.fetchone():
-        print(f"Medication administration {admin_data['id']} already exists, skipping...")
+    # Insert request data with its medication resolved to an integer key; the UNIQUE
+    # external id makes an existing request a no-op
+    with METRICS.timer('extract'):
+        rows = add_epoch_columns([extract_medication_request(request_data)], epoch_positions('medication_request', MEDICATION_REQUEST_COLUMNS))
+    if id_map is None:
+        id_map = ExternalIdMap()
+    with METRICS.timer('resolve'):
+        rows, medications_added = resolve_references(cursor, id_map, 'medication_request', MEDICATION_REQUEST_COLUMNS, rows)
+    row = rows[0]
+    columns = write_columns('medication_request', MEDICATION_REQUEST_COLUMNS)
+    with METRICS.timer('insert'):
+        cursor.execute(insert_sql('medication_request', columns, 'skip'), row)
+    if cursor.rowcount == 0:
+        # Nothing references a contained medication added for it, so that goes too
+        conn.rollback()
+        id_map.clear()
+        METRICS.count('medication_request_skipped')
+        logging.info(f"Medication request {row[0]} already exists, skipping...")
         return
     
+    with METRICS.timer('commit'):
+        conn.commit()
+    METRICS.count('medication_request_inserted')
+    METRICS.count('medications_added', medications_added)
+    logging.info(f"Imported medication request: {row[0]}")
+
+def extract_medication_administration(admin_data):
+    """Extract a medication_administration row (in MEDICATION_ADMINISTRATION_COLUMNS order) from a MedicationAdministration resource"""
     # Extract medication reference
-    medication_id = None
+    medication_id_external = None
     medication_display = None
     if 'contained' in admin_data:
         for contained in admin_data['contained']:
             if contained['resourceType'] == 'Medication':
-                medication_id = contained['id']
+                medication_id_external = contained_medication_key(admin_data, contained)
                 if 'code' in contained and 'coding' in contained['code']:
                     medication_display = contained['code']['coding'][0]['display']
     
@@ -176,7 +276,7 @@ def import_medication_administration(conn, admin_data):
     status = admin_data.get('status')
     # patient_id = admin_data['subject']['reference'].split('/')[-1] if 'subject' in admin_data else None
     practitioner_id = admin_data['performer'][0]['actor']['reference']['reference'].split('/')[-1] if 'performer' in admin_data and admin_data['performer'] else None
-    request_id = admin_data['request']['reference'].split('/')[-1] if 'request' in admin_data else None
+    medication_request_id_external = admin_data['request']['reference'].split('/')[-1] if 'request' in admin_data else None
     encounter_id = admin_data['encounter']['reference'].split('/')[-1] if 'encounter' in admin_data else None
     
     # Extract timing
@@ -207,45 +307,268 @@ def import_medication_administration(conn, admin_data):
             dosage_quantity = dosage['dose'].get('value')
             dosage_unit = dosage['dose'].get('code')
     
-    # Insert administration data
-    cursor.execute("""
-    INSERT INTO medication_administration (
-        medication_administration_id_external, medication_id, medication_display, status,
-         practitioner_id, request_id, encounter_id, effective_start,
-        effective_end, dosage_text, dosage_route, dosage_method, dosage_quantity,
-        dosage_unit
-    ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        medication_administration_id_external, medication_id, medication_display, status,
-         practitioner_id, request_id, encounter_id, effective_start,
+    return (
+        medication_administration_id_external, medication_id_external, medication_display, status,
+        practitioner_id, medication_request_id_external, encounter_id, effective_start,
         effective_end, dosage_text, dosage_route, dosage_method, dosage_quantity,
         dosage_unit
-    ))
+    )
+
+def import_medication_administration(conn, admin_data, id_map=None):
+    """Import medication administration data from medication_administration.json"""
+    cursor = conn.cursor()
     
-    conn.commit()
-    print(f"Imported medication administration: {medication_administration_id_external}")
+    # Insert administration data with its medication resolved to an integer key; the UNIQUE
+    # external id makes an existing administration a no-op
+    with METRICS.timer('extract'):
+        rows = add_epoch_columns([extract_medication_administration(admin_data)], epoch_positions('medication_administration', MEDICATION_ADMINISTRATION_COLUMNS))
+    if id_map is None:
+        id_map = ExternalIdMap()
+    with METRICS.timer('resolve'):
+        rows, medications_added = resolve_references(cursor, id_map, 'medication_administration', MEDICATION_ADMINISTRATION_COLUMNS, rows)
+    row = rows[0]
+    columns = write_columns('medication_administration', MEDICATION_ADMINISTRATION_COLUMNS)
+    with METRICS.timer('insert'):
+        cursor.execute(insert_sql('medication_administration', columns, 'skip'), row)
+    if cursor.rowcount == 0:
+        # Nothing references a contained medication added for it, so that goes too
+        conn.rollback()
+        id_map.clear()
+        METRICS.count('medication_administration_skipped')
+        logging.info(f"Medication administration {row[0]} already exists, skipping...")
+        return
+    
+    with METRICS.timer('commit'):
+        conn.commit()
+    METRICS.count('medication_administration_inserted')
+    METRICS.count('medications_added', medications_added)
+    logging.info(f"Imported medication administration: {row[0]}")
+
+# FHIR Bulk Data export files handled by import_bulk_export, in dependency order
+BULK_RESOURCES = (
+    ('Medication', 'medication', MEDICATION_COLUMNS, extract_medication),
+    ('MedicationRequest', 'medication_request', MEDICATION_REQUEST_COLUMNS, extract_medication_request),
+    ('MedicationAdministration', 'medication_administration', MEDICATION_ADMINISTRATION_COLUMNS, extract_medication_administration),
+)
+
+def extract_rows(extract, resources, resource_type=None, timestamps=()):
+    """Run an extract_* function over a list of resources; returns (rows, error_count).
+
+    Resources may also be raw NDJSON lines, which are parsed here (and
+    filtered by resource_type) so pipeline workers do the JSON decoding.
+    The timestamp strings at the `timestamps` positions are parsed for the
+    whole list at once and their epochs appended to the rows.
+    Module-level so it can be shipped to pipeline worker processes.
+    """
+    rows = []
+    errors = 0
+    for resource in resources:
+        if isinstance(resource, str):
+            METRICS.add_bytes('ndjson', len(resource))
+            try:
+                with METRICS.timer('parse'):
+                    resource = json.loads(resource)
+            except json.JSONDecodeError as e:
+                errors += 1
+                logging.warning(f"Could not parse NDJSON line: {e}")
+                continue
+            if resource_type and resource.get('resourceType') != resource_type:
+                continue
+        try:
+            with METRICS.timer('extract'):
+                rows.append(extract(resource))
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            errors += 1
+            logging.warning(f"Could not extract {resource.get('resourceType')} {resource.get('id', 'unknown')}: {e}")
+    if timestamps:
+        with METRICS.timer('timestamps'):
+            rows = add_epoch_columns(rows, timestamps)
+    return rows, errors
+
+def import_ndjson_file(conn, file_path, resource_type, table, columns, extract,
+                       batch_size=DEFAULT_BATCH_SIZE, on_conflict='skip',
+                       workers=0, queue_depth=DEFAULT_QUEUE_DEPTH, id_map=None):
+    """Stream one NDJSON file through an extract_* function, inserting rows in batches.
+
+    Known external ids are looked up once per batch, so a re-run over mostly
+    imported data costs one SELECT per batch; existing rows are left alone
+    ('skip') or upserted when their content changed ('update'). Medication
+    and request references are stored as integer keys, resolved through
+    id_map (an ExternalIdMap shared by the files of one import), and new
+    rows are inserted with reserved ids so id_map learns them without
+    reading them back. With workers > 0, extraction runs in a process pool
+    and this connection is only used from the single writer thread.
+    """
+    cursor = conn.cursor()
+    if id_map is None:
+        id_map = ExternalIdMap()
+    key_column = KEYS[table][0] if table in KEYS else None
+    all_columns = write_columns(table, columns)
+    timestamps = epoch_positions(table, columns)
+    new_sql = insert_sql(table, all_columns + ((key_column,) if key_column else ()), 'skip')
+    update_sql = insert_sql(table, all_columns, 'update')
+    stats = {'read': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'errors': 0}
+    batch = {}
+    
+    def flush():
+        try:
+            # BEGIN IMMEDIATE holds the write lock so the reserved ids stay ours
+            cursor.execute("BEGIN IMMEDIATE")
+            with METRICS.timer('lookup'):
+                existing = find_existing_ids(cursor, table, columns[0], batch.keys())
+            # Only rows that are written get their references resolved, so skipped ones
+            # don't add contained medications nothing points at
+            rows = [row for row in batch.values() if on_conflict == 'update' or row[0] not in existing]
+            with METRICS.timer('resolve'):
+                rows, medications_added = resolve_references(cursor, id_map, table, columns, rows)
+            new_rows = [row for row in rows if row[0] not in existing]
+            inserted = 0
+            if new_rows:
+                if key_column:
+                    next_id = get_next_rowid(cursor, table)
+                    new_ids = {row[0]: next_id + i for i, row in enumerate(new_rows)}
+                    new_rows = [row + (new_ids[row[0]],) for row in new_rows]
+                with METRICS.timer('insert'):
+                    cursor.executemany(new_sql, new_rows)
+                inserted = cursor.rowcount
+            
+            updated = 0
+            if existing and on_conflict == 'update':
+                with METRICS.timer('update'):
+                    cursor.executemany(update_sql, [row for row in rows if row[0] in existing])
+                updated = cursor.rowcount
+            with METRICS.timer('commit'):
+                conn.commit()
+            if key_column:
+                id_map.remember(table, existing)
+                if new_rows:
+                    id_map.remember(table, new_ids)
+            stats['inserted'] += inserted
+            stats['updated'] += updated
+            stats['skipped'] += len(existing) - updated
+            METRICS.count(f'{table}_inserted', inserted)
+            METRICS.count(f'{table}_updated', updated)
+            METRICS.count(f'{table}_skipped', len(existing) - updated)
+            METRICS.count('medications_added', medications_added)
+        except sqlite3.Error as e:
+            conn.rollback()
+            # Medications added by the rolled-back batch may be in the map
+            id_map.clear()
+            stats['errors'] += len(batch)
+            METRICS.error(f'{table}_batch')
+            logging.error(f"Error inserting {len(batch)} {resource_type} rows, batch rolled back: {e}")
+        batch.clear()
+    
+    def write(extracted):
+        for rows, errors in extracted:
+            stats['read'] += len(rows) + errors
+            stats['errors'] += errors
+            METRICS.count(f'{table}_read', len(rows) + errors)
+            METRICS.error(f'{table}_resource', errors)
+            for row in rows:
+                if row[0] in batch:
+                    # Same id twice in one batch: the later line wins, the earlier one is dropped
+                    stats['skipped'] += 1
+                batch[row[0]] = row
+                if len(batch) >= batch_size:
+                    flush()
+        if batch:
+            flush()
+    
+    start = time.perf_counter()
+    if workers > 0:
+        # Ship raw lines to the workers so JSON decoding happens there too
+        if file_path.endswith('.ndjson'):
+            items = iter_ndjson_lines(file_path)
+        else:
+            items = iter_resources(file_path, resource_type)
+        run_pipeline(items, partial(extract_rows, extract, resource_type=resource_type, timestamps=timestamps), write,
+                     workers=workers, queue_depth=queue_depth)
+    else:
+        resources = METRICS.timed_iter('parse', iter_resources(file_path, resource_type))
+        write(extract_rows(extract, chunk, timestamps=timestamps) for chunk in batched(resources, DEFAULT_TRANSFORM_BATCH))
+    
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+def import_bulk_export(conn, directory, batch_size=DEFAULT_BATCH_SIZE, on_conflict='skip',
+                       workers=0, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """Import <ResourceType>.ndjson files from a FHIR Bulk Data ($export) directory"""
+    results = {}
+    id_map = ExternalIdMap()
+    for resource_type, table, columns, extract in BULK_RESOURCES:
+        file_path = os.path.join(directory, f"{resource_type}.ndjson")
+        if not os.path.exists(file_path):
+            logging.info(f"No {resource_type}.ndjson in {directory}, skipping...")
+            continue
+        
+        stats = import_ndjson_file(conn, file_path, resource_type, table, columns, extract, batch_size, on_conflict,
+                                   workers, queue_depth, id_map)
+        rate = stats['read'] / stats['seconds'] if stats['seconds'] else 0
+        logging.info(f"{resource_type}: read {stats['read']}, inserted {stats['inserted']}, updated {stats['updated']}, "
+              f"skipped {stats['skipped']}, errors {stats['errors']} in {stats['seconds']:.2f}s ({rate:.0f} resources/sec)")
+        results[resource_type] = stats
+    
+    # References to rows that only arrived later in this import, or in an earlier one
+    with METRICS.timer('link'):
+        linked = link_medication_references(conn)
+        conn.commit()
+    METRICS.count('references_linked', linked)
+    if linked:
+        logging.info(f"Linked {linked} medication references to rows imported after them")
+    
+    totals = {key: sum(stats[key] for stats in results.values()) for key in ('inserted', 'updated', 'skipped', 'errors')}
+    logging.info(f"Total: inserted {totals['inserted']}, updated {totals['updated']}, "
+          f"skipped {totals['skipped']}, errors {totals['errors']}")
+    return results
 
 def main():
     """Main function to import all medication-related data"""
+    parser = argparse.ArgumentParser(description='Import FHIR medication resources into healthcare.db')
+    parser.add_argument('--ndjson-dir',
+                        help='Directory of Medication/MedicationRequest/MedicationAdministration .ndjson files (FHIR Bulk Data export)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'Rows per batch in NDJSON mode (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--on-conflict', choices=('skip', 'update'), default='skip',
+                        help='What to do with resources that are already imported in NDJSON mode (default: skip)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Extract resources in this many worker processes with a single writer thread')
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help=f'Extracted batches allowed to wait for the writer (default: {DEFAULT_QUEUE_DEPTH})')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    configure_metrics(args, 'import_json_data')
+    
     conn = connect_to_db()
     
     try:
+        if args.ndjson_dir:
+            import_bulk_export(conn, args.ndjson_dir, args.batch_size, args.on_conflict,
+                               args.workers, args.queue_depth)
+            logging.info("Bulk data import completed!")
+            return
+        
         # Import medication data
-        medication_data = load_json_file('medication.json')
+        with METRICS.timer('parse'):
+            medication_data = load_json_file('medication.json')
         import_medication(conn, medication_data)
         
         # Import medication request data
-        request_data = load_json_file('medication_request.json')
-        import_medication_request(conn, request_data)
+        id_map = ExternalIdMap()
+        with METRICS.timer('parse'):
+            request_data = load_json_file('medication_request.json')
+        import_medication_request(conn, request_data, id_map)
         
         # Import medication administration data
-        admin_data = load_json_file('medication_administration.json')
-        import_medication_administration(conn, admin_data)
+        with METRICS.timer('parse'):
+            admin_data = load_json_file('medication_administration.json')
+        import_medication_administration(conn, admin_data, id_map)
         
-        print("Data import completed successfully!")
+        logging.info("Data import completed successfully!")
         
     except Exception as e:
-        print(f"Error during import: {e}")
+        METRICS.error('import')
+        logging.error(f"Error during import: {e}")
     finally:
         conn.close()
 
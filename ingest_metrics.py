@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Seconds between metric reports while an importer runs
+DEFAULT_INTERVAL = 60
+
+
+class _NullTimer:
+    """Timer handed out while metrics are off; entering and leaving it does nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    """Records the time spent in a with-block, and an error if it raised"""
+
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.error(self.stage)
+        return False
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; counts are per bucket, not cumulative"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (None past the last bucket)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class Metrics:
+    """Stage latencies, row and byte counters and error counts for one importer run.
+
+    Every recording method returns at once while the metrics are disabled and
+    timer() then hands out a shared no-op context manager, so instrumented code
+    costs a method call per event when nobody is collecting. Recording is
+    thread-safe. Work done in pipeline worker processes is not recorded; only
+    the process that enabled the metrics reports.
+    """
+
+    def __init__(self, job='ingest', enabled=False):
+        self.job = job
+        self.enabled = enabled
+        self.started_at = time.time()
+        self.stages = {}
+        self.rows = {}
+        self.bytes = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def timer(self, stage):
+        """Context manager timing a stage: with metrics.timer('insert'): ..."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n=1):
+        """Add n to a row counter"""
+        if not self.enabled or not n:
+            return
+        with self._lock:
+            self.rows[name] = self.rows.get(name, 0) + n
+
+    def add_bytes(self, name, n):
+        """Add n to a byte counter"""
+        if not self.enabled or not n:
+            return
+        with self._lock:
+            self.bytes[name] = self.bytes.get(name, 0) + n
+
+    def error(self, name, n=1):
+        """Add n to an error counter"""
+        if not self.enabled or not n:
+            return
+        with self._lock:
+            self.errors[name] = self.errors.get(name, 0) + n
+
+    def timed_iter(self, stage, iterable):
+        """Yield from iterable, timing each step as the stage (e.g. parsing a streamed file)"""
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(stage, iterable)
+
+    def _timed_iter(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(stage, time.perf_counter() - start)
+            yield item
+
+    def snapshot(self):
+        """Current values as a JSON-serialisable dict"""
+        with self._lock:
+            stages = {
+                stage: {
+                    'count': histogram.count,
+                    'seconds': round(histogram.sum, 6),
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                    'buckets': dict(zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts)),
+                }
+                for stage, histogram in self.stages.items()
+            }
+            return {
+                'job': self.job,
+                'timestamp': round(time.time(), 3),
+                'uptime_seconds': round(time.time() - self.started_at, 3),
+                'stages': stages,
+                'rows': dict(self.rows),
+                'bytes': dict(self.bytes),
+                'errors': dict(self.errors),
+            }
+
+    def prometheus_text(self):
+        """Current values in the Prometheus text exposition format"""
+        job = self.job.replace('\\', '\\\\').replace('"', '\\"')
+        lines = [
+            '# HELP ingest_stage_seconds Time spent in each ingest stage',
+            '# TYPE ingest_stage_seconds histogram',
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self.stages.items()):
+                labels = f'job="{job}",stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'ingest_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'ingest_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'ingest_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+                lines.append(f'ingest_stage_seconds_count{{{labels}}} {histogram.count}')
+            for metric, help_text, values in (
+                    ('ingest_rows_total', 'Rows read, written or skipped', self.rows),
+                    ('ingest_bytes_total', 'Bytes processed', self.bytes),
+                    ('ingest_errors_total', 'Errors', self.errors)):
+                lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} counter')
+                for name, value in sorted(values.items()):
+                    lines.append(f'{metric}{{job="{job}",kind="{name}"}} {value}')
+        lines.append('# HELP ingest_last_report_timestamp_seconds When these metrics were written')
+        lines.append('# TYPE ingest_last_report_timestamp_seconds gauge')
+        lines.append(f'ingest_last_report_timestamp_seconds{{job="{job}"}} {time.time():.3f}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsReporter:
+    """Writes the metrics every `interval` seconds from a daemon thread, and once more at exit.
+
+    prometheus_path is rewritten atomically each time, for node_exporter's
+    textfile collector; json_path gets one JSON object appended per report.
+    """
+
+    def __init__(self, metrics, prometheus_path=None, json_path=None, interval=DEFAULT_INTERVAL):
+        self.metrics = metrics
+        self.prometheus_path = prometheus_path
+        self.json_path = json_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        try:
+            if self.prometheus_path:
+                temp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+                with open(temp_path, 'w') as f:
+                    f.write(self.metrics.prometheus_text())
+                os.replace(temp_path, self.prometheus_path)
+            if self.json_path:
+                with open(self.json_path, 'a') as f:
+                    f.write(json.dumps(self.metrics.snapshot()) + '\n')
+        except OSError as e:
+            logging.warning(f"Could not write metrics: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        if self.interval and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the periodic reports and write the final one; safe to call more than once"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.write()
+
+
+# Shared by the importers; disabled until configure() is called
+METRICS = Metrics()
+
+
+def configure(job, prometheus_path=None, json_path=None, interval=DEFAULT_INTERVAL):
+    """Enable METRICS for this process and start reporting; returns the reporter, or None if no output was given"""
+    if not prometheus_path and not json_path:
+        return None
+    METRICS.job = job
+    METRICS.started_at = time.time()
+    METRICS.enabled = True
+    reporter = MetricsReporter(METRICS, prometheus_path, json_path, interval)
+    reporter.start()
+    return reporter
+
+
+def add_arguments(parser):
+    """Add the --metrics-* options to an importer's argument parser"""
+    group = parser.add_argument_group('metrics', 'Per-stage timings, row and byte counters and errors (off by default)')
+    group.add_argument('--metrics-prometheus', metavar='PATH',
+                       help='Write metrics to this Prometheus textfile (e.g. for node_exporter\'s textfile collector)')
+    group.add_argument('--metrics-json', metavar='PATH', help='Append metrics to this file as JSON lines')
+    group.add_argument('--metrics-interval', type=float, default=DEFAULT_INTERVAL,
+                       help=f'Seconds between metric reports; a final report is always written at exit '
+                            f'(default: {DEFAULT_INTERVAL})')
+    return group
+
+
+def configure_from_args(args, job):
+    """Enable metrics if the --metrics-* options ask for them"""
+    return configure(job, args.metrics_prometheus, args.metrics_json, args.metrics_interval)
@@ -0,0 +1,81 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# Defaults for the parallel ingest pipeline
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_QUEUE_DEPTH = 16
+DEFAULT_TRANSFORM_BATCH = 500
+
+# Marks the end of the queue for the writer thread
+_DONE = object()
+
+
+def batched(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def run_pipeline(items, transform, writer, workers=DEFAULT_WORKERS,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, batch_size=DEFAULT_TRANSFORM_BATCH):
+    """Transform items in a process pool and hand the results to a single writer thread.
+
+    transform is called in a worker process with a list of up to batch_size
+    items and must be picklable (a module-level function or a partial of one).
+    writer is called once, in its own thread, with an iterator over the
+    transform results in input order; it owns the SQLite connection. At most
+    queue_depth results wait for the writer, so a slow writer applies
+    back-pressure to reading and transforming instead of piling up rows in
+    memory. Returns whatever writer returns.
+    """
+    results = queue.Queue(maxsize=queue_depth)
+    outcome = {}
+
+    def drain():
+        while True:
+            item = results.get()
+            if item is _DONE:
+                return
+            yield item
+
+    def run_writer():
+        try:
+            outcome['value'] = writer(drain())
+        except BaseException as e:
+            outcome['error'] = e
+            # Keep consuming so the producer never blocks on a dead writer
+            for _ in drain():
+                pass
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Start the workers while this is still the only thread: a fork taken while the
+        # writer holds a lock (sqlite, logging) leaves that lock held forever in the child
+        pool.submit(os.getpid).result()
+        writer_thread = threading.Thread(target=run_writer, name='ingest-writer')
+        writer_thread.start()
+        try:
+            pending = deque()
+            for batch in batched(items, batch_size):
+                if 'error' in outcome:
+                    break
+                pending.append(pool.submit(transform, batch))
+                # Keep every worker busy but don't run far ahead of the writer
+                if len(pending) >= workers * 2:
+                    results.put(pending.popleft().result())
+            while pending:
+                results.put(pending.popleft().result())
+        finally:
+            results.put(_DONE)
+            writer_thread.join()
+
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome.get('value')
@@ -0,0 +1,153 @@
+import json
+
+# External ids remembered per referenced table; past this the map starts over, which
+# bounds memory on very large imports at the cost of re-reading ids that come back
+DEFAULT_MAP_SIZE = 1000000
+
+# Tables that other rows point at: (integer primary key, UNIQUE external id column)
+KEYS = {
+    'medication': ('medication_id', 'medication_id_external'),
+    'medication_request': ('medication_request_id', 'medication_request_id_external'),
+}
+
+# Integer foreign keys resolved from the external ids the importers extract:
+# table -> ((foreign key column, column holding the external id, referenced table), ...)
+REFERENCES = {
+    'medication_request': (
+        ('medication_id', 'medication_id_external', 'medication'),
+    ),
+    'medication_administration': (
+        ('medication_id', 'medication_id_external', 'medication'),
+        ('medication_request_id', 'medication_request_id_external', 'medication_request'),
+    ),
+}
+
+# Column with the display name a contained Medication is added to the medication table with
+DISPLAY_COLUMNS = {
+    'medication_request': 'medication',
+    'medication_administration': 'medication_display',
+}
+
+# medication_id_external of a Medication contained in `resource`. Local ids such as med0311 are
+# only unique inside their resource and clash with other resources' and with top-level Medication
+# ids, so a contained Medication is keyed by its code as 'system|code' instead, which no FHIR id
+# can look like; the same drug then maps to one row whichever resource carries it. One without a
+# code is kept apart under its container, as '<resource type>/<id>#<local id>'
+def contained_medication_key(resource, medication):
+    for coding in medication.get('code', {}).get('coding', []):
+        if coding.get('code'):
+            return f"{coding.get('system', '')}|{coding['code']}"
+    return f"{resource['resourceType']}/{resource['id']}#{medication['id']}"
+
+# external id -> rowid of the referenced tables, kept for the length of an import.
+# Rows the importer writes are remembered as they go and ids read from the
+# database are kept, so resolving a batch only queries the ids not seen before
+class ExternalIdMap:
+    def __init__(self, max_size=DEFAULT_MAP_SIZE):
+        self.max_size = max_size
+        self.ids = {table: {} for table in KEYS}
+
+    # Remember {external id: rowid} for a referenced table
+    def remember(self, table, mapping):
+        ids = self.ids[table]
+        if len(ids) + len(mapping) > self.max_size:
+            ids.clear()
+        ids.update(mapping)
+
+    # Forget everything, e.g. after a rollback discarded rows that were remembered
+    def clear(self):
+        for ids in self.ids.values():
+            ids.clear()
+
+    # Rowids of the given external ids, as {external id: rowid}; ids not in the table are left out.
+    # Ids not in the map yet are read with one statement and remembered
+    def lookup(self, cursor, table, external_ids):
+        ids = self.ids[table]
+        found = {}
+        missing = []
+        for external_id in external_ids:
+            rowid = ids.get(external_id)
+            if rowid is not None:
+                found[external_id] = rowid
+            elif external_id is not None:
+                missing.append(external_id)
+        if missing:
+            key_column, external_column = KEYS[table]
+            cursor.execute(
+                f"""SELECT {external_column}, {key_column} FROM {table}
+                    WHERE {external_column} IN (SELECT value FROM json_each(?))""",
+                (json.dumps(missing),)
+            )
+            read = dict(cursor.fetchall())
+            self.remember(table, read)
+            found.update(read)
+        return found
+
+# Add contained Medications ({external id: display name}) to the medication table; returns
+# {external id: medication_id}. An id another writer added in the meantime is reused
+def add_medications(cursor, id_map, medications):
+    added = {}
+    for external_id, display in medications.items():
+        cursor.execute(
+            """INSERT INTO medication (medication_id_external, medication) VALUES (?, ?)
+               ON CONFLICT(medication_id_external) DO UPDATE SET medication = COALESCE(medication, excluded.medication)
+               RETURNING medication_id""",
+            (external_id, display)
+        )
+        added[external_id] = cursor.fetchone()[0]
+    id_map.remember('medication', added)
+    return added
+
+# Foreign key columns resolve_references appends to the rows of a table
+def reference_columns(table):
+    return tuple(column for column, _, _ in REFERENCES.get(table, ()))
+
+# Append the integer foreign keys of REFERENCES[table] to rows laid out as `columns`;
+# unresolved references get None. Contained Medications that are not in the medication
+# table yet are added to it, so each distinct one is stored once.
+# Returns (rows, number of medications added)
+def resolve_references(cursor, id_map, table, columns, rows):
+    references = REFERENCES.get(table, ())
+    if not references:
+        return rows, 0
+    added = 0
+    resolved = []
+    for _, external_column, target in references:
+        position = columns.index(external_column)
+        found = id_map.lookup(cursor, target, {row[position] for row in rows})
+        if target == 'medication':
+            display = columns.index(DISPLAY_COLUMNS[table])
+            new = {row[position]: row[display] for row in rows
+                   if row[position] is not None and row[position] not in found}
+            if new:
+                found.update(add_medications(cursor, id_map, new))
+                added += len(new)
+        resolved.append([found.get(row[position]) for row in rows])
+    return [row + values for row, values in zip(rows, zip(*resolved))], added
+
+# Fill in the foreign keys still NULL with one statement per reference, e.g. administrations
+# imported before their request, or rows written before the keys existed. Returns rows linked
+def link_medication_references(conn):
+    cursor = conn.cursor()
+    # Contained Medications nobody has added to the medication table yet
+    cursor.execute(
+        """INSERT INTO medication (medication_id_external, medication)
+           SELECT medication_id_external, MAX(display) FROM (
+               SELECT medication_id_external, medication AS display FROM medication_request
+               WHERE medication_id IS NULL AND medication_id_external IS NOT NULL
+               UNION ALL
+               SELECT medication_id_external, medication_display FROM medication_administration
+               WHERE medication_id IS NULL AND medication_id_external IS NOT NULL
+           ) WHERE true GROUP BY medication_id_external
+           ON CONFLICT(medication_id_external) DO NOTHING"""
+    )
+    linked = 0
+    for table, references in REFERENCES.items():
+        for column, external_column, target in references:
+            key_column, target_external_column = KEYS[target]
+            cursor.execute(
+                f"""UPDATE {table} SET {column} = t.{key_column} FROM {target} t
+                    WHERE {table}.{column} IS NULL AND t.{target_external_column} = {table}.{external_column}"""
+            )
+            linked += cursor.rowcount
+    return linked
@@ -0,0 +1,211 @@
+import json
+import time
+import argparse
+from db_connection import get_connection
+from fhir_time import fhir_period_end
+from schema_migrations import rebuild_medication_summary
+
+# Administration statuses that mean no dose was given
+NOT_GIVEN_STATUSES = ('not-done', 'entered-in-error')
+
+# A stretch without doses is a gap once it is this many times the ordered dose interval
+DEFAULT_GAP_FACTOR = 1.5
+
+# Gap threshold for medications whose orders don't say how often to give them
+DEFAULT_GAP_SECONDS = 24 * 3600
+
+# Seconds per UCUM unit of timing.repeat.periodUnit
+PERIOD_UNIT_SECONDS = {
+    's': 1, 'min': 60, 'h': 3600, 'd': 86400, 'wk': 7 * 86400, 'mo': 2629800, 'a': 31557600,
+}
+
+# Database connection
+def get_db_connection():
+    return get_connection()
+
+# Whether administration `alias` gave a dose
+def _given_sql(alias):
+    statuses = ', '.join(f"'{status}'" for status in NOT_GIVEN_STATUSES)
+    return f"(COALESCE({alias}.status, '') NOT IN ({statuses}))"
+
+# Summary rows of an encounter, one per medication and dose unit, in order of the first order or dose
+def encounter_summary(conn, encounter_id):
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT s.*, m.medication_id_external FROM medication_encounter_summary s
+           LEFT JOIN medication m ON m.medication_id = s.medication_id
+           WHERE s.encounter_id = ?
+           ORDER BY COALESCE(MIN(s.first_ordered_at, s.first_given_at), s.first_ordered_at, s.first_given_at),
+                    s.medication_id, s.dose_unit""",
+        (encounter_id,)
+    )
+    return [dict(row) for row in cursor.fetchall()]
+
+# Seconds between doses an order asks for, or None when its timing doesn't say
+def dose_interval(order):
+    unit_seconds = PERIOD_UNIT_SECONDS.get(order['timing_period_unit'])
+    if not unit_seconds or not order['timing_period'] or not order['timing_frequency']:
+        return None
+    return order['timing_period'] * unit_seconds / order['timing_frequency']
+
+# Number of doses an order asks for over its bounds, or None when they aren't known
+def expected_doses(order):
+    interval = dose_interval(order)
+    if interval is None or order['timing_start_at'] is None or order['timing_end_at'] is None:
+        return None
+    # A date-only end includes the whole day
+    end = fhir_period_end(order['timing_end'])
+    return max(0, round((end - order['timing_start_at']) / interval))
+
+# Stretches longer than `threshold` seconds without a dose, from the start of the ordered
+# period (or the first order) to its end (or the last dose)
+def find_gaps(orders, given_at, threshold, now=None):
+    starts = [order['timing_start_at'] or order['authored_at'] for order in orders]
+    starts = [start for start in starts if start is not None]
+    ends = [fhir_period_end(order['timing_end']) for order in orders if order['timing_end_at'] is not None]
+    points = sorted(given_at)
+    if starts and (not points or min(starts) < points[0]):
+        points.insert(0, min(starts))
+    if ends and points and max(ends) > points[-1]:
+        # Up to now for orders still running
+        points.append(min(max(ends), now if now is not None else time.time()))
+    return [{'from': start, 'to': end, 'seconds': end - start}
+            for start, end in zip(points, points[1:]) if end - start > threshold]
+
+# An encounter's medication timeline: per medication, the orders and administrations in time
+# order, the summary totals per dose unit, the doses the orders ask for and the gaps between doses
+def encounter_timeline(conn, encounter_id, gap_factor=DEFAULT_GAP_FACTOR, gap_seconds=DEFAULT_GAP_SECONDS):
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT medication_request_id, medication_request_id_external, COALESCE(medication_id, 0) AS medication_id,
+                   medication, status, authored_on, authored_at, dosage_text,
+                   dosage_quantity, dosage_unit, timing_frequency, timing_period, timing_period_unit,
+                   timing_start, timing_start_at, timing_end, timing_end_at
+            FROM medication_request WHERE encounter_id = ?
+            ORDER BY authored_at, medication_request_id""",
+        (encounter_id,)
+    )
+    orders = [dict(row) for row in cursor.fetchall()]
+    cursor.execute(
+        f"""SELECT medication_administration_id, medication_administration_id_external,
+                   COALESCE(medication_id, 0) AS medication_id, medication_display AS medication, status,
+                   {_given_sql('medication_administration')} AS given, medication_request_id,
+                   effective_start, effective_start_at, effective_end, effective_end_at,
+                   dosage_text, dosage_quantity, dosage_unit
+            FROM medication_administration WHERE encounter_id = ?
+            ORDER BY effective_start_at, medication_administration_id""",
+        (encounter_id,)
+    )
+    administrations = [dict(row) for row in cursor.fetchall()]
+
+    medications = {}
+    def entry_for(row):
+        if row['medication_id'] not in medications:
+            medications[row['medication_id']] = {
+                'medication_id': row['medication_id'] or None,
+                'medication_id_external': row.get('medication_id_external'),
+                'medication': row['medication'],
+                'totals': [], 'orders': [], 'administrations': [],
+            }
+        return medications[row['medication_id']]
+
+    for row in encounter_summary(conn, encounter_id):
+        entry_for(row)['totals'].append({key: row[key] for key in (
+            'dose_unit', 'request_count', 'administration_count', 'given_count', 'dose_total',
+            'first_ordered_at', 'last_ordered_at', 'first_given_at', 'last_given_at')})
+    for order in orders:
+        order['dose_interval'] = dose_interval(order)
+        order['expected_doses'] = expected_doses(order)
+        entry_for(order)['orders'].append(order)
+    for administration in administrations:
+        administration['given'] = bool(administration['given'])
+        entry_for(administration)['administrations'].append(administration)
+
+    for entry in medications.values():
+        counts = [order['expected_doses'] for order in entry['orders']]
+        entry['expected_doses'] = sum(counts) if counts and None not in counts else None
+        intervals = [order['dose_interval'] for order in entry['orders'] if order['dose_interval']]
+        threshold = gap_factor * min(intervals) if intervals else gap_seconds
+        given_at = [a['effective_start_at'] for a in entry['administrations']
+                    if a['given'] and a['effective_start_at'] is not None]
+        entry['gaps'] = find_gaps(entry['orders'], given_at, threshold)
+    return {'encounter_id': encounter_id, 'medications': list(medications.values())}
+
+# UTC display of a Unix time
+def format_time(epoch):
+    if epoch is None:
+        return '?'
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(epoch))
+
+# Print a timeline for people
+def print_timeline(timeline):
+    medications = timeline['medications']
+    print(f"Encounter {timeline['encounter_id']}: {len(medications)} medication(s)")
+    for entry in medications:
+        name = entry['medication'] or 'Unresolved medication'
+        print(f"\n{name}" + (f" ({entry['medication_id_external']})" if entry['medication_id_external'] else ''))
+        for totals in entry['totals']:
+            unit = f" {totals['dose_unit']}" if totals['dose_unit'] else ''
+            dose = f", {totals['dose_total']:g}{unit} given" if totals['dose_total'] is not None else ''
+            print(f"  {totals['request_count']} order(s), {totals['given_count']} of "
+                  f"{totals['administration_count']} administration(s) given{dose}")
+        if entry['expected_doses'] is not None:
+            print(f"  Orders ask for {entry['expected_doses']} dose(s)")
+        events = [(order['authored_at'], 'ordered', order['medication_request_id_external'], order['status'],
+                   order['dosage_text']) for order in entry['orders']]
+        events += [(a['effective_start_at'], 'given' if a['given'] else 'not given',
+                    a['medication_administration_id_external'], a['status'], a['dosage_text'])
+                   for a in entry['administrations']]
+        for at, kind, external_id, status, text in sorted(events, key=lambda e: (e[0] is None, e[0] or 0)):
+            print(f"  {format_time(at):16}  {kind:9}  {external_id}  {status or ''}  {text or ''}")
+        for gap in entry['gaps']:
+            print(f"  gap {format_time(gap['from'])} .. {format_time(gap['to'])} ({gap['seconds'] / 3600:.1f} h)")
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description='Show what was ordered and given in an encounter')
+    parser.add_argument('encounter_id', nargs='?', help='Encounter id, as in medication_request.encounter_id')
+    parser.add_argument('--summary', action='store_true', help='Only print the precomputed per-medication totals')
+    parser.add_argument('--json', action='store_true', help='Print the timeline as JSON')
+    parser.add_argument('--gap-factor', type=float, default=DEFAULT_GAP_FACTOR,
+                        help=f'Report stretches without doses longer than this many ordered dose intervals '
+                             f'(default: {DEFAULT_GAP_FACTOR})')
+    parser.add_argument('--gap-hours', type=float, default=DEFAULT_GAP_SECONDS / 3600,
+                        help=f'Gap threshold for medications without a dose interval '
+                             f'(default: {DEFAULT_GAP_SECONDS / 3600:g})')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute the summary table from scratch')
+    args = parser.parse_args()
+    if not args.encounter_id and not args.rebuild:
+        parser.error('an encounter id or --rebuild is required')
+
+    conn = get_db_connection()
+    try:
+        if args.rebuild:
+            start = time.perf_counter()
+            rows = rebuild_medication_summary(conn)
+            conn.commit()
+            print(f"Rebuilt {rows} summary rows in {time.perf_counter() - start:.2f}s")
+        if not args.encounter_id:
+            return
+        if args.summary:
+            rows = encounter_summary(conn, args.encounter_id)
+            if args.json:
+                print(json.dumps(rows, indent=2))
+                return
+            for row in rows:
+                unit = f" {row['dose_unit']}" if row['dose_unit'] else ''
+                dose = f"{row['dose_total']:g}{unit}" if row['dose_total'] is not None else '-'
+                print(f"{row['medication'] or 'Unresolved medication'}: {row['request_count']} order(s), "
+                      f"{row['given_count']}/{row['administration_count']} given, {dose}, "
+                      f"first dose {format_time(row['first_given_at'])}, last {format_time(row['last_given_at'])}")
+            return
+        timeline = encounter_timeline(conn, args.encounter_id, args.gap_factor, args.gap_hours * 3600)
+        if args.json:
+            print(json.dumps(timeline, indent=2))
+        else:
+            print_timeline(timeline)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import io
+import sqlite3
+import base64
+import hashlib
+import json
+import logging
+import argparse
+from db_connection import get_connection
+
+# Rows converted per transaction by the migrations
+DEFAULT_MIGRATION_BATCH_SIZE = 500
+
+# Bytes copied per read when streaming a payload out of the database
+DEFAULT_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Database connection
+def get_db_connection():
+    return get_connection()
+
+# SHA-256 hex digest used as the blob key
+def content_hash(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+# Return the subset of hashes already in note_blob, using one statement
+def find_existing_hashes(cursor, hashes):
+    cursor.execute(
+        "SELECT content_hash FROM note_blob WHERE content_hash IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(hashes)),)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+# Write payloads that are not stored yet; items are (content_hash, payload, content_type).
+# Returns (bytes_written, bytes_saved)
+def store_blobs(cursor, items):
+    unique = {}
+    for blob_hash, payload, content_type in items:
+        unique.setdefault(blob_hash, (payload, content_type))
+    existing = find_existing_hashes(cursor, unique.keys()) if unique else set()
+
+    new_rows = [
+        (blob_hash, sqlite3.Binary(payload), content_type, len(payload))
+        for blob_hash, (payload, content_type) in unique.items()
+        if blob_hash not in existing
+    ]
+    if new_rows:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO note_blob (content_hash, content, content_type, size) VALUES (?, ?, ?, ?)",
+            new_rows
+        )
+    bytes_written = sum(row[3] for row in new_rows)
+    return bytes_written, sum(len(payload) for _, payload, _ in items) - bytes_written
+
+# Store fetched payloads and point their versions at them.
+# items are (version_id, payload, content_type) or (version_id, payload, content_type, source_url).
+# Returns (bytes_written, bytes_saved)
+def store_binary_contents(cursor, items):
+    blobs = []
+    versions = []
+    sources = []
+    for item in items:
+        version_id, payload, content_type = item[:3]
+        blob_hash = content_hash(payload)
+        blobs.append((blob_hash, payload, content_type))
+        versions.append((blob_hash, content_type, version_id))
+        if len(item) > 3 and item[3]:
+            sources.append((item[3], blob_hash))
+
+    bytes_written, bytes_saved = store_blobs(cursor, blobs)
+    cursor.executemany(
+        """UPDATE note_version
+           SET content_hash = ?, content_type = ?, note_text = NULL
+           WHERE version_id = ?""",
+        versions
+    )
+    if sources:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO note_blob_source (source_url, content_hash) VALUES (?, ?)",
+            sources
+        )
+    return bytes_written, bytes_saved
+
+# Store one fetched payload; returns (bytes_written, bytes_saved)
+def store_binary_content(cursor, version_id, payload, content_type, source_url=None):
+    return store_binary_contents(cursor, [(version_id, payload, content_type, source_url)])
+
+# Return {url: (content_hash, content_type, size)} for URLs whose content is already stored
+def lookup_source_urls(cursor, urls):
+    cursor.execute(
+        """SELECT s.source_url, s.content_hash, b.content_type, b.size
+           FROM note_blob_source s
+           JOIN note_blob b ON b.content_hash = s.content_hash
+           WHERE s.source_url IN (SELECT value FROM json_each(?))""",
+        (json.dumps(list(urls)),)
+    )
+    return {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
+
+# Point versions at already stored blobs without touching the payload; items are (version_id, content_hash, content_type)
+def link_versions_to_blobs(cursor, items):
+    cursor.executemany(
+        """UPDATE note_version
+           SET content_hash = ?, content_type = ?, note_text = NULL
+           WHERE version_id = ?""",
+        [(blob_hash, content_type, version_id) for version_id, blob_hash, content_type in items]
+    )
+
+# Open a version's payload for reading in pieces; returns (reader, size), or (None, 0) if it has none.
+# note_blob payloads are read in place through incremental BLOB I/O, so nothing is loaded up front;
+# only base64 rows not migrated yet are decoded into memory. The reader has read(), seek() and
+# close() like a file, and must be closed before the connection is
+def open_payload(conn, version_id):
+    row = conn.execute(
+        """SELECT b.rowid, nv.content_type
+           FROM note_version nv
+           LEFT JOIN note_blob b ON b.content_hash = nv.content_hash
+           WHERE nv.version_id = ?""",
+        (version_id,)
+    ).fetchone()
+    if row is None:
+        return None, 0
+    blob_rowid, content_type = row
+    
+    if blob_rowid is not None:
+        reader = conn.blobopen('note_blob', 'content', blob_rowid, readonly=True)
+    elif content_type:
+        note_text = conn.execute("SELECT note_text FROM note_version WHERE version_id = ?", (version_id,)).fetchone()[0]
+        if not note_text or note_text.startswith('URL:'):
+            return None, 0
+        reader = io.BytesIO(base64.b64decode(note_text))
+        return reader, len(reader.getbuffer())
+    else:
+        return None, 0
+    return reader, len(reader)
+
+# Copy bytes [start, end) of an open payload to out, chunk_size bytes at a time. out is anything with
+# write(): a file, sys.stdout.buffer, socket.makefile('wb'). Returns the number of bytes copied
+def copy_payload(reader, size, out, start=0, end=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    end = size if end is None else min(end, size)
+    remaining = max(end - start, 0)
+    copied = 0
+    reader.seek(start)
+    while remaining:
+        chunk = reader.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        out.write(chunk)
+        copied += len(chunk)
+        remaining -= len(chunk)
+    return copied
+
+# Copy bytes [start, end) of a version's payload to out without loading the rest of it.
+# Returns (bytes copied, payload size); (0, 0) if the version has no payload
+def stream_payload(conn, version_id, out, start=0, end=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    reader, size = open_payload(conn, version_id)
+    if reader is None:
+        return 0, 0
+    try:
+        return copy_payload(reader, size, out, start, end, chunk_size), size
+    finally:
+        reader.close()
+
+# Move payloads left by older versions as base64 note_text into note_blob, in batches
+def migrate_payloads(conn, batch_size=DEFAULT_MIGRATION_BATCH_SIZE):
+    cursor = conn.cursor()
+    converted = 0
+    failed = 0
+    bytes_saved = 0
+    last_version_id = 0
+
+    while True:
+        # Walk by version_id so each batch is a cheap range read and the migration can be re-run
+        cursor.execute(
+            """SELECT version_id, note_text, content_type FROM note_version
+               WHERE version_id > ? AND content_hash IS NULL
+                 AND content_type IS NOT NULL AND note_text IS NOT NULL AND note_text NOT LIKE 'URL: %'
+               ORDER BY version_id LIMIT ?""",
+            (last_version_id, batch_size)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        items = []
+        for version_id, note_text, content_type in rows:
+            try:
+                items.append((version_id, base64.b64decode(note_text, validate=True), content_type))
+            except (ValueError, TypeError) as e:
+                logging.warning(f"Version {version_id} is not valid base64, leaving it as text: {e}")
+                failed += 1
+
+        try:
+            _, saved = store_binary_contents(cursor, items)
+            conn.commit()
+            converted += len(items)
+            bytes_saved += saved
+        except sqlite3.Error as e:
+            logging.error(f"Error converting batch after version {last_version_id}: {e}")
+            conn.rollback()
+            failed += len(items)
+        last_version_id = rows[-1][0]
+
+    logging.info(f"Moved {converted} payloads into the blob store ({failed} left as text, {bytes_saved} bytes deduplicated)")
+    return converted, failed
+
+# Report how much the content-addressed store saves over storing every version's payload
+def dedup_report(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT COUNT(*), COALESCE(SUM(b.size), 0)
+           FROM note_version nv JOIN note_blob b ON b.content_hash = nv.content_hash"""
+    )
+    versions, logical_bytes = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM note_blob")
+    blobs, stored_bytes = cursor.fetchone()
+    return {
+        'versions': versions,
+        'blobs': blobs,
+        'logical_bytes': logical_bytes,
+        'stored_bytes': stored_bytes,
+        'bytes_saved': logical_bytes - stored_bytes,
+    }
+
+# Main function
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Maintain the content-addressed note payload store')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_MIGRATION_BATCH_SIZE,
+                        help=f'Rows converted per transaction (default: {DEFAULT_MIGRATION_BATCH_SIZE})')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='VACUUM afterwards so the freed space is returned to the filesystem')
+    parser.add_argument('--report', action='store_true',
+                        help='Only print the deduplication report')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if not args.report:
+            migrate_payloads(conn, args.batch_size)
+            if args.vacuum:
+                conn.execute("VACUUM")
+                logging.info("Database vacuumed")
+
+        report = dedup_report(conn)
+        print(f"{report['versions']} versions reference {report['blobs']} unique payloads: "
+              f"{report['logical_bytes']} bytes logical, {report['stored_bytes']} bytes stored, "
+              f"{report['bytes_saved']} bytes saved")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import json
+import sqlite3
+import time
+import logging
+import argparse
+from db_connection import get_connection
+from fhir_time import epoch_range
+
+# Number of results returned by default
+DEFAULT_LIMIT = 20
+
+# Matches scored per query, newest first; 0 ranks every match, so results are the best ones.
+# Scoring costs a few microseconds per row, so a term found in most of a million notes takes
+# a while to rank exhaustively; a window bounds that, at the cost of older matches never
+# being considered
+DEFAULT_RANK_WINDOW = 0
+
+# Searchable text of a note_version row (the search triggers in schema_migrations hold a
+# copy of this expression): plain note_text, or for stored payloads the text extracted by
+# note_text_extraction, falling back to text/* payloads decoded as UTF-8 until that has run.
+# URL references are skipped until extract_binary_content has fetched them.
+def _version_text_sql(alias):
+    return f"""CASE
+        WHEN {alias}.note_text IS NOT NULL AND {alias}.content_type IS NULL AND {alias}.note_text NOT LIKE 'URL: %'
+            THEN {alias}.note_text
+        WHEN {alias}.content_hash IS NOT NULL THEN COALESCE(
+            (SELECT t.text FROM note_blob_text t WHERE t.content_hash = {alias}.content_hash),
+            (SELECT CAST(b.content AS TEXT) FROM note_blob b
+             WHERE b.content_hash = {alias}.content_hash AND {alias}.content_type LIKE 'text/%'))
+    END"""
+
+# Database connection
+def get_db_connection():
+    return get_connection()
+
+# Re-index every note from scratch in one statement, then merge the index segments
+def rebuild_search_index(conn):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM note_fts")
+    cursor.execute(
+        f"""INSERT INTO note_fts (rowid, body)
+            SELECT note_id, text FROM (
+                SELECT nv.note_id, {_version_text_sql('nv')} AS text FROM note_version nv
+                WHERE nv.version_id IN (SELECT MAX(version_id) FROM note_version GROUP BY note_id)
+            ) WHERE text IS NOT NULL"""
+    )
+    indexed = cursor.rowcount
+    cursor.execute("INSERT INTO note_fts (note_fts) VALUES ('optimize')")
+    conn.commit()
+    logging.info(f"Indexed {indexed} notes for full-text search")
+    return indexed
+
+# Stop note_version_fts_insert from indexing rows inserted later in the current transaction.
+# Per row, the trigger costs a MAX(version_id) lookup and an FTS delete and insert, which cuts
+# bulk imports to a third of their speed; a bulk writer instead indexes each chunk with
+# index_new_versions. The switch is a row that only exists inside the writer's transaction,
+# which holds the write lock, so no other connection ever writes with the trigger off. Call
+# resume_search_index before committing; a rollback takes the row away with everything else
+def suspend_search_index(cursor):
+    cursor.execute("INSERT OR IGNORE INTO note_fts_suspended (id) VALUES (1)")
+
+def resume_search_index(cursor):
+    cursor.execute("DELETE FROM note_fts_suspended")
+
+# Index note_version rows first_version_id <= version_id < end_version_id inserted with the trigger
+# suspended, in one statement. Each must be the latest version of its note, as rows appended under
+# the write lock are; replaced_note_ids lists the notes among them that had an earlier version
+def index_new_versions(cursor, first_version_id, end_version_id, replaced_note_ids=()):
+    if replaced_note_ids:
+        cursor.execute(
+            "DELETE FROM note_fts WHERE rowid IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(replaced_note_ids)),)
+        )
+    cursor.execute(
+        f"""INSERT INTO note_fts (rowid, body)
+            SELECT note_id, text FROM (
+                SELECT nv.note_id, {_version_text_sql('nv')} AS text FROM note_version nv
+                WHERE nv.version_id >= ? AND nv.version_id < ?
+            ) WHERE text IS NOT NULL""",
+        (first_version_id, end_version_id)
+    )
+    return cursor.rowcount
+
+# Search notes; returns ranked dicts with note_id, snippet and metadata, best first.
+# query uses FTS5 syntax (words, "phrases", prefix*, AND/OR/NOT). Dates are FHIR dates or dateTimes
+# (e.g. YYYY-MM-DD), inclusive, compared in UTC; ValueError if one isn't a date
+def search_notes(conn, query, category=None, date_from=None, date_to=None, limit=DEFAULT_LIMIT,
+                 rank_window=DEFAULT_RANK_WINDOW):
+    filters = ""
+    params = {'query': query, 'limit': limit, 'window': rank_window or -1}
+    if category:
+        filters += " AND n.category_id = (SELECT category_id FROM note_category WHERE category_code = :category)"
+        params['category'] = category
+    date_from, date_to = epoch_range(date_from, date_to)
+    if date_from is not None:
+        filters += " AND n.note_date_at >= :date_from"
+        params['date_from'] = date_from
+    if date_to is not None:
+        filters += " AND n.note_date_at < :date_to"
+        params['date_to'] = date_to
+
+    # Walk matches newest first, score at most `window` of them, and build snippets
+    # only for the rows actually returned
+    sql = f"""WITH candidates AS (
+                  SELECT f.rowid AS note_id, f.rank AS score
+                  FROM note_fts f
+                  JOIN note n ON n.note_id = f.rowid
+                  WHERE note_fts MATCH :query{filters}
+                  ORDER BY f.rowid DESC LIMIT :window
+              ),
+              top AS (SELECT note_id, score FROM candidates ORDER BY score LIMIT :limit)
+              SELECT n.note_id, n.note_type, n.note_date, c.category_code,
+                     snippet(note_fts, 0, '[', ']', '...', 12) AS snippet, top.score
+              FROM top
+              JOIN note_fts ON note_fts.rowid = top.note_id
+              JOIN note n ON n.note_id = top.note_id
+              LEFT JOIN note_category c ON c.category_id = n.category_id
+              WHERE note_fts MATCH :query
+              ORDER BY top.score"""
+
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    return [dict(row) for row in cursor.fetchall()]
+
+# Main function
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Full-text search over clinical notes')
+    parser.add_argument('query', nargs='?', help='FTS5 query, e.g. fever AND "chest pain"')
+    parser.add_argument('--category', help='Only notes with this note_category code')
+    parser.add_argument('--from', dest='date_from', help='Only notes dated on or after YYYY-MM-DD')
+    parser.add_argument('--to', dest='date_to', help='Only notes dated on or before YYYY-MM-DD')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT,
+                        help=f'Maximum number of results (default: {DEFAULT_LIMIT})')
+    parser.add_argument('--rank-window', type=int, default=DEFAULT_RANK_WINDOW,
+                        help='Only score the newest N matches, faster for very common terms but may miss '
+                             'better older matches (default: 0, score all)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Re-index every note before searching')
+    args = parser.parse_args()
+    try:
+        epoch_range(args.date_from, args.date_to)
+    except ValueError as e:
+        parser.error(str(e))
+
+    conn = get_db_connection()
+    try:
+        if args.rebuild:
+            rebuild_search_index(conn)
+        if not args.query:
+            return
+
+        start = time.perf_counter()
+        try:
+            results = search_notes(conn, args.query, args.category, args.date_from, args.date_to, args.limit,
+                                   args.rank_window)
+        except sqlite3.OperationalError as e:
+            print(f"Invalid search query {args.query!r}: {e}")
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        for result in results:
+            print(f"Note {result['note_id']} ({result['note_date']}, {result['category_code']}, "
+                  f"{result['note_type']}) score {-result['score']:.2f}")
+            print(f"    {result['snippet']}")
+        print(f"{len(results)} results in {elapsed_ms:.1f} ms")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import re
+import zlib
+import logging
+import argparse
+from io import BytesIO
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+from db_connection import get_connection
+from ingest_pipeline import run_pipeline, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+
+try:
+    # Much better layout handling than the built-in fallback when it is installed
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+# Payloads sent to a worker at once; kept small since each one may be a multi-MB PDF
+DEFAULT_EXTRACT_BATCH = 8
+
+# Extracted texts written per transaction
+DEFAULT_WRITE_BATCH_SIZE = 100
+
+# Content types we know how to turn into text
+EXTRACTABLE_TYPES = ('application/pdf', 'text/%', 'application/xml', 'application/xhtml+xml')
+
+# Database connection
+def get_db_connection():
+    return get_connection()
+
+# Collect the text nodes of an HTML document, skipping scripts and styles
+class _HTMLTextParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+# Collapse runs of whitespace left over from markup and layout
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', text).strip()
+
+def extract_html_text(payload):
+    parser = _HTMLTextParser()
+    parser.feed(payload.decode('utf-8', errors='replace'))
+    parser.close()
+    return normalize_text(' '.join(parser.parts))
+
+def extract_xml_text(payload):
+    try:
+        root = ElementTree.fromstring(payload)
+    except ElementTree.ParseError:
+        # Not well-formed (often HTML served as XML); fall back to the lenient parser
+        return extract_html_text(payload)
+    return normalize_text(' '.join(root.itertext()))
+
+# PDF string literal escapes, see PDF 32000-1 7.3.4.2
+_PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f',
+                b'(': b'(', b')': b')', b'\\': b'\\'}
+
+def _decode_pdf_string(raw):
+    def unescape(match):
+        escaped = match.group(1)
+        if escaped[:1].isdigit():
+            return bytes([int(escaped, 8) & 0xFF])
+        return _PDF_ESCAPES.get(escaped, b'')
+    data = re.sub(rb'\\([0-7]{1,3}|.)', unescape, raw, flags=re.S)
+    if data.startswith(b'\xfe\xff'):
+        return data[2:].decode('utf-16-be', errors='replace')
+    return data.decode('cp1252', errors='replace')
+
+_PDF_STREAM_START = re.compile(rb'(?<!end)stream\r?\n')
+_PDF_TEXT_OP = re.compile(rb'\(((?:\\.|[^\\)])*)\)\s*(?:Tj|\'|")|\[((?:\\.|[^\]])*)\]\s*TJ', re.S)
+_PDF_STRING = re.compile(rb'\(((?:\\.|[^\\)])*)\)', re.S)
+_PDF_FIELD_VALUE = re.compile(rb'/V\s*\(((?:\\.|[^\\)])*)\)', re.S)
+
+# Minimal PDF text extraction with the standard library: text-showing operators in
+# (Flate) content streams plus form field values. Used when pypdf is not installed
+def _extract_pdf_text_builtin(payload):
+    parts = []
+    for match in _PDF_STREAM_START.finditer(payload):
+        # The stream dictionary sits between the object header and the stream keyword
+        dictionary = payload[payload.rfind(b' obj', 0, match.start()):match.start()]
+        end = payload.find(b'endstream', match.end())
+        if end < 0:
+            break
+        stream = payload[match.end():end]
+        if b'/Image' in dictionary:
+            continue
+        if b'/FlateDecode' in dictionary:
+            try:
+                stream = zlib.decompress(stream)
+            except zlib.error:
+                continue
+        elif b'/Filter' in dictionary:
+            continue
+        for literal, array in _PDF_TEXT_OP.findall(stream):
+            if array:
+                parts.append(''.join(_decode_pdf_string(s) for s in _PDF_STRING.findall(array)))
+            else:
+                parts.append(_decode_pdf_string(literal))
+    # Filled-in AcroForm fields (names, dates on consent forms) live outside the content streams
+    parts.extend(_decode_pdf_string(value) for value in _PDF_FIELD_VALUE.findall(payload))
+    return normalize_text(' '.join(parts))
+
+def extract_pdf_text(payload):
+    if PdfReader is None:
+        return _extract_pdf_text_builtin(payload), 'builtin-pdf'
+    reader = PdfReader(BytesIO(payload))
+    return normalize_text(' '.join(page.extract_text() or '' for page in reader.pages)), 'pypdf'
+
+# Turn a payload into plain text; returns (text, extractor name)
+def extract_text(content_type, payload):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type == 'application/pdf' or payload.startswith(b'%PDF-'):
+        return extract_pdf_text(payload)
+    if content_type in ('text/html', 'application/xhtml+xml'):
+        return extract_html_text(payload), 'html'
+    if content_type in ('text/xml', 'application/xml'):
+        return extract_xml_text(payload), 'xml'
+    if content_type.startswith('text/'):
+        return normalize_text(payload.decode('utf-8', errors='replace')), 'text'
+    raise ValueError(f"No text extractor for content type {content_type!r}")
+
+# Function run in pipeline worker processes: read each payload by hash and extract its text.
+# Returns (content_hash, text, extractor, error) rows; failures are recorded, not raised
+def extract_blob_texts(hashes):
+    conn = get_db_connection()
+    try:
+        results = []
+        for blob_hash in hashes:
+            row = conn.execute(
+                "SELECT content, content_type FROM note_blob WHERE content_hash = ?", (blob_hash,)
+            ).fetchone()
+            if row is None:
+                continue
+            try:
+                text, extractor = extract_text(row['content_type'], bytes(row['content']))
+                results.append((blob_hash, text, extractor, None))
+            except Exception as e:
+                results.append((blob_hash, None, None, f"{type(e).__name__}: {e}"))
+        return results
+    finally:
+        conn.close()
+
+# Hashes used by note versions that have no extracted text yet (or failed, if retry_failed)
+def find_pending_hashes(cursor, retry_failed=False):
+    type_filter = ' OR '.join('b.content_type LIKE ?' for _ in EXTRACTABLE_TYPES)
+    cursor.execute(
+        f"""SELECT b.content_hash FROM note_blob b
+            LEFT JOIN note_blob_text t ON t.content_hash = b.content_hash
+            WHERE (t.content_hash IS NULL OR (? AND t.text IS NULL))
+              AND ({type_filter})
+              AND EXISTS (SELECT 1 FROM note_version nv WHERE nv.content_hash = b.content_hash)""",
+        (1 if retry_failed else 0, *EXTRACTABLE_TYPES)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+# Extract text for every pending payload in a process pool, writing results from a single writer.
+# Safe to interrupt: each committed batch is skipped on the next run
+def extract_pending_texts(workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH,
+                          batch_size=DEFAULT_EXTRACT_BATCH, write_batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                          retry_failed=False):
+    conn = get_db_connection()
+    try:
+        pending = find_pending_hashes(conn.cursor(), retry_failed)
+    finally:
+        conn.close()
+    logging.info(f"{len(pending)} payloads need text extraction")
+    if not pending:
+        return 0, 0
+
+    def write(batches):
+        # The writer gets its own connection, since it runs in the pipeline's writer thread
+        writer_conn = get_db_connection()
+        extracted = 0
+        failed = 0
+        rows = []
+
+        def flush():
+            writer_conn.executemany(
+                """INSERT INTO note_blob_text (content_hash, text, extractor, error) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(content_hash) DO UPDATE SET
+                       text = excluded.text, extractor = excluded.extractor,
+                       error = excluded.error, extracted_at = CURRENT_TIMESTAMP""",
+                rows
+            )
+            writer_conn.commit()
+            rows.clear()
+
+        try:
+            for batch in batches:
+                for row in batch:
+                    if row[3]:
+                        logging.warning(f"Could not extract text from payload {row[0]}: {row[3]}")
+                        failed += 1
+                    else:
+                        extracted += 1
+                    rows.append(row)
+                if len(rows) >= write_batch_size:
+                    flush()
+                    logging.info(f"Extracted {extracted} payloads so far ({failed} failed)")
+            if rows:
+                flush()
+        finally:
+            writer_conn.close()
+        return extracted, failed
+
+    extracted, failed = run_pipeline(pending, extract_blob_texts, write, workers=workers,
+                                     queue_depth=queue_depth, batch_size=batch_size)
+    logging.info(f"Text extraction complete: {extracted} payloads extracted, {failed} failed")
+    return extracted, failed
+
+# Main function
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Extract plain text from stored note payloads for search')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Extraction worker processes (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help=f'Extracted batches allowed to wait for the writer (default: {DEFAULT_QUEUE_DEPTH})')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_EXTRACT_BATCH,
+                        help=f'Payloads handed to a worker at once (default: {DEFAULT_EXTRACT_BATCH})')
+    parser.add_argument('--write-batch-size', type=int, default=DEFAULT_WRITE_BATCH_SIZE,
+                        help=f'Extracted texts written per transaction (default: {DEFAULT_WRITE_BATCH_SIZE})')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Also retry payloads whose extraction failed before')
+    args = parser.parse_args()
+
+    extract_pending_texts(args.workers, args.queue_depth, args.batch_size,
+                          args.write_batch_size, args.retry_failed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,690 @@
+import hashlib
+import logging
+from functools import lru_cache
+from fhir_time import parse_fhir_datetime
+
+# Every step is written so it can also run against a database that was created by the
+# old drop-and-recreate scripts or patched by hand (PRAGMA user_version still 0): tables
+# and indexes use IF NOT EXISTS and columns are only added when missing.
+#
+# Steps run inside migrate()'s transaction, statement by statement with conn.execute:
+# executescript() and conn.commit() would end that transaction early. A step spells out
+# its own DDL instead of calling into the tools, so it keeps doing what it did when it
+# was released however those change.
+
+# FHIR timestamp strings and the UTC Unix time columns stored next to them (see fhir_time.py)
+_EPOCH_COLUMNS = (
+    ('note', 'note_date', 'note_date_at'),
+    ('medication_request', 'authored_on', 'authored_at'),
+    ('medication_request', 'timing_start', 'timing_start_at'),
+    ('medication_request', 'timing_end', 'timing_end_at'),
+    ('medication_administration', 'effective_start', 'effective_start_at'),
+    ('medication_administration', 'effective_end', 'effective_end_at'),
+)
+
+# Distinct timestamp strings remembered while backfilling the epoch columns
+_BACKFILL_CACHE_SIZE = 65536
+
+
+def _execute_all(conn, statements):
+    for statement in statements:
+        conn.execute(statement)
+
+
+def _create_medication_tables(conn):
+    _execute_all(conn, (
+        """CREATE TABLE IF NOT EXISTS medication (
+            medication_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medication_id_external TEXT UNIQUE,
+            medication TEXT,
+            form TEXT,
+            ingredient TEXT,
+            strength TEXT,
+            manufacturer TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS medication_request (
+            medication_request_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medication_request_id_external TEXT UNIQUE,
+            medication_id TEXT,
+            medication TEXT,
+            status TEXT,
+            practitioner_id TEXT,
+            encounter_id TEXT,
+            authored_on TEXT,
+            dosage_text TEXT,
+            dosage_route TEXT,
+            dosage_method TEXT,
+            dosage_quantity REAL,
+            dosage_unit TEXT,
+            timing_frequency INTEGER,
+            timing_period REAL,
+            timing_period_unit TEXT,
+            timing_start TEXT,
+            timing_end TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS medication_administration (
+            medication_administration_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medication_administration_id_external TEXT UNIQUE,
+            medication_id TEXT,
+            medication_display TEXT,
+            status TEXT,
+            practitioner_id TEXT,
+            request_id TEXT,
+            encounter_id TEXT,
+            effective_start TEXT,
+            effective_end TEXT,
+            dosage_text TEXT,
+            dosage_route TEXT,
+            dosage_method TEXT,
+            dosage_quantity REAL,
+            dosage_unit TEXT
+        )""",
+    ))
+
+
+def _create_note_tables(conn):
+    _execute_all(conn, (
+        """CREATE TABLE IF NOT EXISTS note_category (
+            category_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category_code TEXT NOT NULL,
+            category_display TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(category_code)
+        )""",
+        """CREATE TABLE IF NOT EXISTS note (
+            note_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            note_id_external TEXT,
+            category_id INTEGER,
+            note_type TEXT,
+            note_type_code TEXT,
+            encounter_id INTEGER,
+            note_date DATE,
+            current_version_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (category_id) REFERENCES note_category(category_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS note_version (
+            version_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            note_id INTEGER,
+            version_number INTEGER,
+            note_text TEXT,
+            practioner_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (note_id) REFERENCES note(note_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_note_category ON note(category_id)",
+        "CREATE INDEX IF NOT EXISTS idx_note_type ON note(note_type)",
+        "CREATE INDEX IF NOT EXISTS idx_note_date ON note(note_date)",
+        "CREATE INDEX IF NOT EXISTS idx_note_version ON note_version(note_id, version_number)",
+    ))
+
+
+def _add_content_store(conn):
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(note_version)")]
+    if 'content_type' not in columns:
+        conn.execute("ALTER TABLE note_version ADD COLUMN content_type TEXT")
+    if 'content_blob' not in columns:
+        # Superseded by note_blob, and dropped again by step 12 once its payloads are moved there
+        conn.execute("ALTER TABLE note_version ADD COLUMN content_blob BLOB")
+    if 'content_hash' not in columns:
+        conn.execute("ALTER TABLE note_version ADD COLUMN content_hash TEXT")
+    _execute_all(conn, (
+        # Payloads are stored once per SHA-256, however many versions reference them
+        """CREATE TABLE IF NOT EXISTS note_blob (
+            content_hash TEXT PRIMARY KEY,
+            content BLOB NOT NULL,
+            content_type TEXT,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        # Binary URLs already fetched, so the same URL is never downloaded twice
+        """CREATE TABLE IF NOT EXISTS note_blob_source (
+            source_url TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            FOREIGN KEY (content_hash) REFERENCES note_blob(content_hash)
+        ) WITHOUT ROWID""",
+        # Plain text extracted from each payload, also once per hash; text is NULL and
+        # error set when extraction failed
+        """CREATE TABLE IF NOT EXISTS note_blob_text (
+            content_hash TEXT PRIMARY KEY,
+            text TEXT,
+            extractor TEXT,
+            error TEXT,
+            extracted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (content_hash) REFERENCES note_blob(content_hash)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_note_version_hash ON note_version(content_hash)",
+    ))
+
+
+# Searchable text of a note_version row as the search triggers compute it; a copy of
+# note_search._version_text_sql as released with step 4
+def _search_text_sql(alias):
+    return f"""CASE
+        WHEN {alias}.note_text IS NOT NULL AND {alias}.content_type IS NULL AND {alias}.note_text NOT LIKE 'URL: %'
+            THEN {alias}.note_text
+        WHEN {alias}.content_hash IS NOT NULL THEN COALESCE(
+            (SELECT t.text FROM note_blob_text t WHERE t.content_hash = {alias}.content_hash),
+            (SELECT CAST(b.content AS TEXT) FROM note_blob b
+             WHERE b.content_hash = {alias}.content_hash AND {alias}.content_type LIKE 'text/%'))
+    END"""
+
+
+# Latest version of every note that uses the payload with hash `hash_sql`
+def _latest_versions_with_hash_sql(hash_sql):
+    return f"""SELECT nv.* FROM note_version nv
+               WHERE nv.content_hash = {hash_sql}
+                 AND nv.version_id = (SELECT MAX(version_id) FROM note_version WHERE note_id = nv.note_id)"""
+
+
+_NEW_IS_LATEST = "NEW.version_id = (SELECT MAX(version_id) FROM note_version WHERE note_id = NEW.note_id)"
+
+
+def _add_search_index(conn):
+    created = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_fts'").fetchone() is None
+    # One row per note (rowid = note_id) holding the text of its latest version
+    conn.execute(
+        """CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5(
+            body,
+            tokenize = 'porter unicode61 remove_diacritics 2'
+        )"""
+    )
+    for trigger in ('note_version_fts_insert', 'note_version_fts_update', 'note_version_fts_delete',
+                    'note_blob_text_fts_insert', 'note_blob_text_fts_update'):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    new_text = _search_text_sql('NEW')
+    conn.execute(
+        f"""CREATE TRIGGER note_version_fts_insert AFTER INSERT ON note_version
+            WHEN {_NEW_IS_LATEST}
+            BEGIN
+                DELETE FROM note_fts WHERE rowid = NEW.note_id;
+                INSERT INTO note_fts (rowid, body)
+                SELECT NEW.note_id, text FROM (SELECT {new_text} AS text) WHERE text IS NOT NULL;
+            END"""
+    )
+    conn.execute(
+        f"""CREATE TRIGGER note_version_fts_update
+            AFTER UPDATE OF note_text, content_type, content_hash ON note_version
+            WHEN {_NEW_IS_LATEST}
+            BEGIN
+                DELETE FROM note_fts WHERE rowid = NEW.note_id;
+                INSERT INTO note_fts (rowid, body)
+                SELECT NEW.note_id, text FROM (SELECT {new_text} AS text) WHERE text IS NOT NULL;
+            END"""
+    )
+    # Fall back to the previous version, if any, when the latest one is removed
+    conn.execute(
+        f"""CREATE TRIGGER note_version_fts_delete AFTER DELETE ON note_version
+            WHEN OLD.version_id > (SELECT COALESCE(MAX(version_id), 0) FROM note_version WHERE note_id = OLD.note_id)
+            BEGIN
+                DELETE FROM note_fts WHERE rowid = OLD.note_id;
+                INSERT INTO note_fts (rowid, body)
+                SELECT nv.note_id, {_search_text_sql('nv')} FROM note_version nv
+                WHERE nv.version_id = (SELECT MAX(version_id) FROM note_version WHERE note_id = OLD.note_id)
+                  AND {_search_text_sql('nv')} IS NOT NULL;
+            END"""
+    )
+    # Extracted text arrives after the versions; re-index every note currently showing that payload
+    for name, event in (('note_blob_text_fts_insert', 'INSERT'), ('note_blob_text_fts_update', 'UPDATE OF text')):
+        conn.execute(
+            f"""CREATE TRIGGER {name} AFTER {event} ON note_blob_text
+                BEGIN
+                    DELETE FROM note_fts WHERE rowid IN (
+                        SELECT note_id FROM ({_latest_versions_with_hash_sql('NEW.content_hash')}));
+                    INSERT INTO note_fts (rowid, body)
+                    SELECT note_id, text FROM (
+                        SELECT nv.note_id, {_search_text_sql('nv')} AS text
+                        FROM ({_latest_versions_with_hash_sql('NEW.content_hash')}) nv
+                    ) WHERE text IS NOT NULL;
+                END"""
+        )
+
+    if created:
+        # Index the notes already in the database
+        conn.execute(
+            f"""INSERT INTO note_fts (rowid, body)
+                SELECT note_id, text FROM (
+                    SELECT nv.note_id, {_search_text_sql('nv')} AS text FROM note_version nv
+                    WHERE nv.version_id IN (SELECT MAX(version_id) FROM note_version GROUP BY note_id)
+                ) WHERE text IS NOT NULL"""
+        )
+        conn.execute("INSERT INTO note_fts (note_fts) VALUES ('optimize')")
+
+
+def _add_fetch_queue(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS binary_fetch_queue (
+            version_id INTEGER PRIMARY KEY,
+            note_id INTEGER,
+            url TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (version_id) REFERENCES note_version(version_id)
+        )"""
+    )
+    if 'next_attempt_at' not in [column[1] for column in conn.execute("PRAGMA table_info(binary_fetch_queue)")]:
+        # Unix time before which a retried entry must not be claimed
+        conn.execute("ALTER TABLE binary_fetch_queue ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+    _execute_all(conn, (
+        "DROP INDEX IF EXISTS idx_fetch_queue_state",
+        "CREATE INDEX IF NOT EXISTS idx_fetch_queue_due ON binary_fetch_queue(state, next_attempt_at, version_id)",
+        # Importers write URL references as 'URL: <url>' note_text; queue them as they arrive
+        """CREATE TRIGGER IF NOT EXISTS note_version_fetch_enqueue AFTER INSERT ON note_version
+            WHEN NEW.note_text LIKE 'URL: %'
+            BEGIN
+                INSERT OR IGNORE INTO binary_fetch_queue (version_id, note_id, url)
+                VALUES (NEW.version_id, NEW.note_id, trim(substr(NEW.note_text, 6)));
+            END""",
+        # Versions written before the queue existed are picked up once by fetch_queue.backfill_fetch_queue
+        """CREATE TABLE IF NOT EXISTS binary_fetch_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_version_id INTEGER NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0
+        )""",
+        "INSERT OR IGNORE INTO binary_fetch_backfill (id, last_version_id) VALUES (1, 0)",
+    ))
+
+
+def _add_query_path_indexes(conn):
+    # See check_query_plans.py for the queries these serve
+    _execute_all(conn, (
+        "CREATE INDEX IF NOT EXISTS idx_note_external ON note(note_id_external)",
+        "CREATE INDEX IF NOT EXISTS idx_note_encounter ON note(encounter_id, note_date)",
+        "CREATE INDEX IF NOT EXISTS idx_note_version_latest ON note_version(note_id, version_id)",
+        "CREATE INDEX IF NOT EXISTS idx_note_version_practitioner ON note_version(practioner_id, note_id)",
+        """CREATE INDEX IF NOT EXISTS idx_medication_request_encounter
+            ON medication_request(encounter_id, authored_on, medication_id, status)""",
+        """CREATE INDEX IF NOT EXISTS idx_medication_administration_encounter
+            ON medication_administration(encounter_id, effective_start, medication_id, status)""",
+        "CREATE INDEX IF NOT EXISTS idx_medication_administration_request ON medication_administration(request_id)",
+        "CREATE INDEX IF NOT EXISTS idx_medication_request_medication ON medication_request(medication_id)",
+        "CREATE INDEX IF NOT EXISTS idx_medication_administration_medication ON medication_administration(medication_id)",
+    ))
+
+
+def _add_note_source_columns(conn):
+    # meta.versionId and SHA-256 of the attachment as last imported, for incremental imports
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(note)")]
+    if 'source_version' not in columns:
+        conn.execute("ALTER TABLE note ADD COLUMN source_version TEXT")
+    if 'source_hash' not in columns:
+        conn.execute("ALTER TABLE note ADD COLUMN source_hash TEXT")
+
+
+def _add_medication_references(conn):
+    # The TEXT columns holding FHIR ids become *_external and integer foreign keys take their names
+    for table, old, external, key in (
+            ('medication_request', 'medication_id', 'medication_id_external',
+             'medication_id INTEGER REFERENCES medication(medication_id)'),
+            ('medication_administration', 'medication_id', 'medication_id_external',
+             'medication_id INTEGER REFERENCES medication(medication_id)'),
+            ('medication_administration', 'request_id', 'medication_request_id_external',
+             'medication_request_id INTEGER REFERENCES medication_request(medication_request_id)')):
+        columns = [column[1] for column in conn.execute(f"PRAGMA table_info({table})")]
+        if external not in columns:
+            conn.execute(f"ALTER TABLE {table} RENAME COLUMN {old} TO {external}")
+            columns.remove(old)
+        if key.split()[0] not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {key}")
+    # The renames carried the old indexes over to the TEXT columns; index the keys instead
+    for name, definition in (
+            ('idx_medication_request_encounter',
+             'medication_request(encounter_id, authored_on, medication_id, status)'),
+            ('idx_medication_administration_encounter',
+             'medication_administration(encounter_id, effective_start, medication_id, status)'),
+            ('idx_medication_administration_request', 'medication_administration(medication_request_id)'),
+            ('idx_medication_request_medication', 'medication_request(medication_id)'),
+            ('idx_medication_administration_medication', 'medication_administration(medication_id)')):
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+        conn.execute(f"CREATE INDEX {name} ON {definition}")
+    # Contained Medications were stored under their local ids, which are only unique inside
+    # their resource; the codes were never stored, so they are keyed under their container the
+    # way medication_references.contained_medication_key keys a Medication without a code
+    for table, container in (('medication_request', 'MedicationRequest'),
+                             ('medication_administration', 'MedicationAdministration')):
+        conn.execute(
+            f"""UPDATE {table}
+                SET medication_id_external = '{container}/' || {table}_id_external || '#' || medication_id_external
+                WHERE medication_id IS NULL AND medication_id_external IS NOT NULL
+                  AND instr(medication_id_external, '#') = 0 AND instr(medication_id_external, '|') = 0"""
+        )
+    # Link the rows already imported, adding the contained Medications they name
+    conn.execute(
+        """INSERT INTO medication (medication_id_external, medication)
+           SELECT medication_id_external, MAX(display) FROM (
+               SELECT medication_id_external, medication AS display FROM medication_request
+               WHERE medication_id IS NULL AND medication_id_external IS NOT NULL
+               UNION ALL
+               SELECT medication_id_external, medication_display FROM medication_administration
+               WHERE medication_id IS NULL AND medication_id_external IS NOT NULL
+           ) WHERE true GROUP BY medication_id_external
+           ON CONFLICT(medication_id_external) DO NOTHING"""
+    )
+    for table, column, external_column, target, key_column, target_external_column in (
+            ('medication_request', 'medication_id', 'medication_id_external',
+             'medication', 'medication_id', 'medication_id_external'),
+            ('medication_administration', 'medication_id', 'medication_id_external',
+             'medication', 'medication_id', 'medication_id_external'),
+            ('medication_administration', 'medication_request_id', 'medication_request_id_external',
+             'medication_request', 'medication_request_id', 'medication_request_id_external')):
+        conn.execute(
+            f"""UPDATE {table} SET {column} = t.{key_column} FROM {target} t
+                WHERE {table}.{column} IS NULL AND t.{target_external_column} = {table}.{external_column}"""
+        )
+
+
+# Timestamps of the medication summary: for the orders and the doses, the source column
+# the update triggers watch and its value as Unix time ({ref} is the row). Step 9 parsed
+# the FHIR strings; step 10 moved the summary onto the epoch columns
+_SUMMARY_TIMES_PARSED = (
+    ('authored_on', "CASE WHEN length({ref}.authored_on) >= 10 THEN unixepoch({ref}.authored_on) END"),
+    ('effective_start', "CASE WHEN length({ref}.effective_start) >= 10 THEN unixepoch({ref}.effective_start) END"),
+)
+_SUMMARY_TIMES_EPOCH = (
+    ('authored_at', "{ref}.authored_at"),
+    ('effective_start_at', "{ref}.effective_start_at"),
+)
+
+_SUMMARY_TRIGGERS = (
+    'medication_request_summary_insert', 'medication_request_summary_update', 'medication_request_summary_delete',
+    'medication_administration_summary_insert', 'medication_administration_summary_update',
+    'medication_administration_summary_delete',
+)
+
+
+# Whether administration `alias` gave a dose
+def _summary_given_sql(alias):
+    return f"(COALESCE({alias}.status, '') NOT IN ('not-done', 'entered-in-error'))"
+
+
+# Rows of `alias` in the summary row (encounter, medication, unit) of `ref` (OLD or NEW)
+def _summary_same_key_sql(alias, ref):
+    return (f"{alias}.encounter_id = {ref}.encounter_id "
+            f"AND COALESCE({alias}.medication_id, 0) = COALESCE({ref}.medication_id, 0) "
+            f"AND COALESCE({alias}.dosage_unit, '') = COALESCE({ref}.dosage_unit, '')")
+
+
+# Summary rows aggregated from the requests and administrations matching the filters
+# (aliases r and a). Medication 0 stands for unresolved medications, unit '' for none
+def _summary_aggregate_sql(times, request_filter='true', administration_filter='true'):
+    (_, ordered_at), (_, given_at) = times
+    given = _summary_given_sql('a')
+    return f"""INSERT INTO medication_encounter_summary (
+            encounter_id, medication_id, dose_unit, medication, request_count, administration_count,
+            given_count, dose_total, first_ordered_at, last_ordered_at, first_given_at, last_given_at)
+        SELECT encounter_id, medication_id, dose_unit, MAX(medication), SUM(requests), SUM(administrations),
+               SUM(given), SUM(dose), MIN(ordered_at), MAX(ordered_at), MIN(given_at), MAX(given_at)
+        FROM (
+            SELECT r.encounter_id, COALESCE(r.medication_id, 0) AS medication_id,
+                   COALESCE(r.dosage_unit, '') AS dose_unit, r.medication AS medication,
+                   1 AS requests, 0 AS administrations, 0 AS given, NULL AS dose,
+                   {ordered_at.format(ref='r')} AS ordered_at, NULL AS given_at
+            FROM medication_request r
+            WHERE r.encounter_id IS NOT NULL AND {request_filter}
+            UNION ALL
+            SELECT a.encounter_id, COALESCE(a.medication_id, 0), COALESCE(a.dosage_unit, ''), a.medication_display,
+                   0, 1, {given}, CASE WHEN {given} THEN a.dosage_quantity END,
+                   NULL, CASE WHEN {given} THEN {given_at.format(ref='a')} END
+            FROM medication_administration a
+            WHERE a.encounter_id IS NOT NULL AND {administration_filter}
+        ) WHERE true
+        GROUP BY encounter_id, medication_id, dose_unit"""
+
+
+# Recompute the summary row `ref` (OLD or NEW) belongs to, for updates and deletes
+def _summary_refresh_sql(times, ref):
+    return f"""DELETE FROM medication_encounter_summary
+            WHERE encounter_id = {ref}.encounter_id AND medication_id = COALESCE({ref}.medication_id, 0)
+              AND dose_unit = COALESCE({ref}.dosage_unit, '');
+        {_summary_aggregate_sql(times, _summary_same_key_sql('r', ref), _summary_same_key_sql('a', ref))};"""
+
+
+# Fold one new row into its summary row; counts add up and first/last keep the extremes
+_SUMMARY_UPSERT_SQL = """ON CONFLICT(encounter_id, medication_id, dose_unit) DO UPDATE SET
+            medication = COALESCE(MAX(medication, excluded.medication), medication, excluded.medication),
+            request_count = request_count + excluded.request_count,
+            administration_count = administration_count + excluded.administration_count,
+            given_count = given_count + excluded.given_count,
+            dose_total = CASE WHEN excluded.dose_total IS NULL THEN dose_total
+                              ELSE COALESCE(dose_total, 0) + excluded.dose_total END,
+            first_ordered_at = MIN(COALESCE(first_ordered_at, excluded.first_ordered_at),
+                                   COALESCE(excluded.first_ordered_at, first_ordered_at)),
+            last_ordered_at = MAX(COALESCE(last_ordered_at, excluded.last_ordered_at),
+                                  COALESCE(excluded.last_ordered_at, last_ordered_at)),
+            first_given_at = MIN(COALESCE(first_given_at, excluded.first_given_at),
+                                 COALESCE(excluded.first_given_at, first_given_at)),
+            last_given_at = MAX(COALESCE(last_given_at, excluded.last_given_at),
+                                COALESCE(excluded.last_given_at, last_given_at))"""
+
+
+# (Re)create the triggers that keep the summary current: inserts are folded in at constant
+# cost, updates and deletes recompute the rows they touch
+def _create_summary_triggers(conn, times):
+    (ordered_column, ordered_at), (given_column, given_at) = times
+    for trigger in _SUMMARY_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    given = _summary_given_sql('NEW')
+    conn.execute(
+        f"""CREATE TRIGGER medication_request_summary_insert AFTER INSERT ON medication_request
+            WHEN NEW.encounter_id IS NOT NULL
+            BEGIN
+                INSERT INTO medication_encounter_summary (
+                    encounter_id, medication_id, dose_unit, medication, request_count, first_ordered_at, last_ordered_at)
+                VALUES (NEW.encounter_id, COALESCE(NEW.medication_id, 0), COALESCE(NEW.dosage_unit, ''), NEW.medication,
+                        1, {ordered_at.format(ref='NEW')}, {ordered_at.format(ref='NEW')})
+                {_SUMMARY_UPSERT_SQL};
+            END"""
+    )
+    conn.execute(
+        f"""CREATE TRIGGER medication_administration_summary_insert AFTER INSERT ON medication_administration
+            WHEN NEW.encounter_id IS NOT NULL
+            BEGIN
+                INSERT INTO medication_encounter_summary (
+                    encounter_id, medication_id, dose_unit, medication, administration_count, given_count,
+                    dose_total, first_given_at, last_given_at)
+                VALUES (NEW.encounter_id, COALESCE(NEW.medication_id, 0), COALESCE(NEW.dosage_unit, ''),
+                        NEW.medication_display, 1, {given},
+                        CASE WHEN {given} THEN NEW.dosage_quantity END,
+                        CASE WHEN {given} THEN {given_at.format(ref='NEW')} END,
+                        CASE WHEN {given} THEN {given_at.format(ref='NEW')} END)
+                {_SUMMARY_UPSERT_SQL};
+            END"""
+    )
+    # Columns that feed the summary, per source table; updates to other columns leave it alone
+    for table, columns in (
+            ('medication_request', f'encounter_id, medication_id, medication, dosage_unit, {ordered_column}'),
+            ('medication_administration', 'encounter_id, medication_id, medication_display, dosage_unit, '
+                                          f'dosage_quantity, status, {given_column}')):
+        conn.execute(
+            f"""CREATE TRIGGER {table}_summary_update AFTER UPDATE OF {columns} ON {table}
+                BEGIN
+                    {_summary_refresh_sql(times, 'OLD')}
+                    {_summary_refresh_sql(times, 'NEW')}
+                END"""
+        )
+        conn.execute(
+            f"""CREATE TRIGGER {table}_summary_delete AFTER DELETE ON {table}
+                BEGIN
+                    {_summary_refresh_sql(times, 'OLD')}
+                END"""
+        )
+
+
+def _rebuild_summary(conn, times):
+    conn.execute("DELETE FROM medication_encounter_summary")
+    return conn.execute(_summary_aggregate_sql(times)).rowcount
+
+
+# Timestamps of the summary as its current triggers compute them; a step that recreates the
+# triggers with other ones must point this at them too
+_CURRENT_SUMMARY_TIMES = _SUMMARY_TIMES_EPOCH
+
+
+def rebuild_medication_summary(conn):
+    """Recompute the whole medication summary the way its triggers maintain it.
+
+    Returns the number of summary rows; the caller commits.
+    """
+    return _rebuild_summary(conn, _CURRENT_SUMMARY_TIMES)
+
+
+def _add_medication_summary(conn):
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'medication_encounter_summary'"
+    ).fetchone() is None
+    # One row per encounter, medication and dose unit
+    _execute_all(conn, (
+        """CREATE TABLE IF NOT EXISTS medication_encounter_summary (
+            encounter_id TEXT NOT NULL,
+            medication_id INTEGER NOT NULL,
+            dose_unit TEXT NOT NULL,
+            medication TEXT,
+            request_count INTEGER NOT NULL DEFAULT 0,
+            administration_count INTEGER NOT NULL DEFAULT 0,
+            given_count INTEGER NOT NULL DEFAULT 0,
+            dose_total REAL,
+            first_ordered_at INTEGER,
+            last_ordered_at INTEGER,
+            first_given_at INTEGER,
+            last_given_at INTEGER,
+            PRIMARY KEY (encounter_id, medication_id, dose_unit)
+        )""",
+        """CREATE INDEX IF NOT EXISTS idx_medication_summary_medication
+            ON medication_encounter_summary(medication_id, encounter_id)""",
+    ))
+    _create_summary_triggers(conn, _SUMMARY_TIMES_PARSED)
+    if created:
+        _rebuild_summary(conn, _SUMMARY_TIMES_PARSED)
+
+
+def _add_epoch_timestamps(conn):
+    for table, _, epoch in _EPOCH_COLUMNS:
+        columns = [column[1] for column in conn.execute(f"PRAGMA table_info({table})")]
+        if epoch not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {epoch} INTEGER")
+    # Parsed like the importers do it; with the summary triggers in place every row
+    # backfilled would recompute its summary row, so they are recreated afterwards
+    for trigger in _SUMMARY_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.create_function('fhir_epoch', 1, lru_cache(_BACKFILL_CACHE_SIZE)(parse_fhir_datetime), deterministic=True)
+    for table, column, epoch in _EPOCH_COLUMNS:
+        conn.execute(f"UPDATE {table} SET {epoch} = fhir_epoch({column}) WHERE {column} IS NOT NULL AND {epoch} IS NULL")
+    # Sorting and range filters move from the strings to the epochs
+    conn.execute("DROP INDEX IF EXISTS idx_note_date")
+    for name, definition in (
+            ('idx_note_date_at', 'note(note_date_at)'),
+            ('idx_note_encounter', 'note(encounter_id, note_date_at)'),
+            ('idx_medication_request_encounter',
+             'medication_request(encounter_id, authored_at, medication_id, status)'),
+            ('idx_medication_administration_encounter',
+             'medication_administration(encounter_id, effective_start_at, medication_id, status)'),
+            ('idx_medication_request_authored', 'medication_request(authored_at)'),
+            ('idx_medication_request_timing', 'medication_request(timing_start_at, timing_end_at)'),
+            ('idx_medication_administration_effective',
+             'medication_administration(effective_start_at, effective_end_at)')):
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+        conn.execute(f"CREATE INDEX {name} ON {definition}")
+    # The summary reads the epoch columns from here on
+    _create_summary_triggers(conn, _SUMMARY_TIMES_EPOCH)
+    _rebuild_summary(conn, _SUMMARY_TIMES_EPOCH)
+
+
+def _add_search_index_switch(conn):
+    # Holds a row only inside a bulk writer's transaction, see note_search.suspend_search_index
+    conn.execute("CREATE TABLE IF NOT EXISTS note_fts_suspended (id INTEGER PRIMARY KEY CHECK (id = 1))")
+    conn.execute("DROP TRIGGER IF EXISTS note_version_fts_insert")
+    conn.execute(
+        f"""CREATE TRIGGER note_version_fts_insert AFTER INSERT ON note_version
+            WHEN NOT EXISTS (SELECT 1 FROM note_fts_suspended) AND {_NEW_IS_LATEST}
+            BEGIN
+                DELETE FROM note_fts WHERE rowid = NEW.note_id;
+                INSERT INTO note_fts (rowid, body)
+                SELECT NEW.note_id, text FROM (SELECT {_search_text_sql('NEW')} AS text) WHERE text IS NOT NULL;
+            END"""
+    )
+
+
+def _drop_version_content_blob(conn):
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(note_version)")]
+    if 'content_blob' not in columns:
+        return
+    # Payloads still only in content_blob move into note_blob first, keyed by their SHA-256
+    # like note_content_store.content_hash; one row at a time, so none is held for long
+    version_ids = [row[0] for row in conn.execute(
+        "SELECT version_id FROM note_version WHERE content_blob IS NOT NULL AND content_hash IS NULL"
+    )]
+    for version_id in version_ids:
+        payload, content_type = conn.execute(
+            "SELECT content_blob, content_type FROM note_version WHERE version_id = ?", (version_id,)
+        ).fetchone()
+        payload = bytes(payload)
+        blob_hash = hashlib.sha256(payload).hexdigest()
+        conn.execute(
+            "INSERT OR IGNORE INTO note_blob (content_hash, content, content_type, size) VALUES (?, ?, ?, ?)",
+            (blob_hash, payload, content_type, len(payload))
+        )
+        conn.execute(
+            "UPDATE note_version SET content_hash = ?, note_text = NULL WHERE version_id = ?",
+            (blob_hash, version_id)
+        )
+    conn.execute("ALTER TABLE note_version DROP COLUMN content_blob")
+
+
+# Schema history, oldest first. user_version holds the number of the last step applied;
+# append new steps at the end and never change or reorder released ones
+MIGRATIONS = [
+    (1, 'medication tables', _create_medication_tables),
+    (2, 'clinical note tables', _create_note_tables),
+    (3, 'content-addressed payload store', _add_content_store),
+    (4, 'full-text search index', _add_search_index),
+    (5, 'Binary fetch queue', _add_fetch_queue),
+    (6, 'indexes for the note and medication query paths', _add_query_path_indexes),
+    (7, 'note source fingerprints for incremental imports', _add_note_source_columns),
+    (8, 'integer medication and request foreign keys', _add_medication_references),
+    (9, 'per-encounter medication summary', _add_medication_summary),
+    (10, 'UTC epoch columns for note and medication timestamps', _add_epoch_timestamps),
+    (11, 'bulk-load switch for the search index trigger', _add_search_index_switch),
+    (12, 'drop note_version.content_blob, superseded by note_blob', _drop_version_content_blob),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    """Number of the last migration applied to the database"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply the pending migrations in order; returns how many were applied.
+
+    An up-to-date database costs a single PRAGMA read. Each step runs in
+    one transaction with its version bump, taken under the write lock and
+    re-checking the version first, so two tools starting at once don't
+    both run it and a step that fails leaves nothing behind.
+    """
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return 0
+
+    applied = 0
+    for number, description, step in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        if schema_version(conn) >= number:
+            conn.commit()
+            continue
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        logging.info(f"Applied schema migration {number}: {description}")
+        applied += 1
+    return applied
@@ -0,0 +1,384 @@
+import os
+import sys
+import json
+import base64
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Synthetic FHIR data for benchmarking the importers, shaped like medication.json,
+# medication_request.json, medication_administration.json and the DocumentReference
+# export. Everything derives from the seed, so the same arguments give the same files.
+
+# Port of the local server that answers the generated Binary URLs
+DEFAULT_BINARY_PORT = 8765
+
+# Share of DocumentReferences that point at a Binary URL instead of carrying inline data
+DEFAULT_URL_FRACTION = 0.3
+
+# Approximate size of each inline attachment and each served Binary, in bytes
+DEFAULT_ATTACHMENT_SIZE = 2048
+DEFAULT_BINARY_SIZE = 20 * 1024
+
+# One Medication in the catalog per this many MedicationRequests
+MEDICATIONS_PER_REQUEST = 100
+
+# Written at the end of generation, so a directory can be reused when the parameters match
+MANIFEST = 'manifest.json'
+
+MEDICATION_CATALOG = [
+    ('76388-713-25', 'Myleran 2mg tablet, film coated', 'Busulfan (substance)', 2, 'mg'),
+    ('373994007', 'Prednisone 5mg tablet (Product)', 'Prednisone (substance)', 5, 'mg'),
+    ('1594660', 'Alemtuzumab 10mg/ml (Lemtrada)', 'Alemtuzumab (substance)', 10, 'mg'),
+    ('197361', 'Amlodipine 5 MG Oral Tablet', 'Amlodipine (substance)', 5, 'mg'),
+    ('310965', 'Ibuprofen 200 MG Oral Tablet', 'Ibuprofen (substance)', 200, 'mg'),
+    ('860975', 'Metformin 500 MG Oral Tablet', 'Metformin (substance)', 500, 'mg'),
+    ('313782', 'Acetaminophen 325 MG Oral Tablet', 'Paracetamol (substance)', 325, 'mg'),
+    ('1719286', 'Heparin 5000 UNT/ML Injectable Solution', 'Heparin (substance)', 5000, '[iU]'),
+]
+
+DOSE_FORMS = [
+    ('385057009', 'Film-coated tablet (qualifier value)'),
+    ('385055001', 'Tablet (basic dose form)'),
+    ('385219001', 'Solution for injection (qualifier value)'),
+]
+
+ROUTES = [
+    ('26643006', 'Oral Route', '421521009', 'Swallow - dosing instruction imperative (qualifier value)'),
+    ('47625008', 'Intravenous route (qualifier value)', '422145002', 'Inject - dosing instruction imperative (qualifier value)'),
+    ('34206005', 'Subcutaneous route (qualifier value)', '422145002', 'Inject - dosing instruction imperative (qualifier value)'),
+]
+
+NOTE_CATEGORIES = [
+    ('11488-4', 'Consult note'),
+    ('18842-5', 'Discharge summary'),
+    ('11506-3', 'Progress note'),
+    ('34117-2', 'History and physical note'),
+    ('59284-0', 'Consent Document'),
+]
+
+NOTE_TYPES = [
+    ('2820719', 'Consent Forms'),
+    ('2820507', 'Progress Notes'),
+    ('2820510', 'Consult Notes'),
+    ('2820705', 'Discharge Summaries'),
+]
+
+WORDS = ('patient reports fever cough fatigue denies chest pain shortness of breath stable vitals '
+         'afebrile plan continue current medication follow up in two weeks labs reviewed unremarkable '
+         'history of hypertension diabetes allergies none known exam normal heart lungs abdomen').split()
+
+EPOCH = datetime(2015, 1, 1)
+
+# Build a coding list with one system/code/display entry
+def coding(system, code, display):
+    return {'coding': [{'system': system, 'code': code, 'display': display}]}
+
+# Return a timestamp within five years of EPOCH, as FHIR dateTime text
+def random_datetime(rng):
+    return EPOCH + timedelta(seconds=rng.randrange(5 * 365 * 86400))
+
+# Build Medication i of the catalog, shaped like medication.json
+def make_medication(i, rng):
+    code, display, ingredient, strength, unit = MEDICATION_CATALOG[i % len(MEDICATION_CATALOG)]
+    form_code, form_display = rng.choice(DOSE_FORMS)
+    return {
+        'resourceType': 'Medication',
+        'id': f'med-{i}',
+        'contained': [{'resourceType': 'Organization', 'id': 'mmanu', 'name': f'Manufacturer {i % 37}'}],
+        'code': coding('http://hl7.org/fhir/sid/ndc', code, display),
+        'marketingAuthorizationHolder': {'reference': '#mmanu'},
+        'doseForm': coding('http://snomed.info/sct', form_code, form_display),
+        'ingredient': [{
+            'item': {'concept': coding('http://snomed.info/sct', code, ingredient)},
+            'strengthRatio': {
+                'numerator': {'value': strength, 'system': 'http://unitsofmeasure.org', 'code': unit},
+                'denominator': {'value': 1, 'system': 'http://terminology.hl7.org/CodeSystem/v3-orderableDrugForm',
+                                'code': 'TAB'},
+            },
+        }],
+        'batch': {'lotNumber': str(rng.randrange(10 ** 7)), 'expirationDate': '2027-05-22'},
+    }
+
+# Build MedicationRequest i, shaped like medication_request.json. Its contained Medication is
+# a random catalog entry under a local id that, as in real exports, other resources reuse for
+# other drugs and that matches the id of a different top-level Medication
+def make_medication_request(i, rng, medication_count, encounter_count):
+    medication = rng.randrange(medication_count)
+    local_id = f'med-{i % medication_count}'
+    code, display = MEDICATION_CATALOG[medication % len(MEDICATION_CATALOG)][:2]
+    route_code, route, method_code, method = rng.choice(ROUTES)
+    authored = random_datetime(rng)
+    start = authored + timedelta(days=1)
+    end = start + timedelta(days=rng.choice((6, 13, 29)))
+    quantity = rng.choice((1, 2, 4))
+    return {
+        'resourceType': 'MedicationRequest',
+        'id': f'medrx-{i}',
+        'contained': [{'resourceType': 'Medication', 'id': local_id,
+                       'code': coding('http://snomed.info/sct', code, display)}],
+        'identifier': [{'use': 'official', 'system': 'http://www.bmc.nl/portal/prescriptions', 'value': str(10 ** 7 + i)}],
+        'status': rng.choice(('active', 'active', 'completed', 'stopped', 'on-hold')),
+        'intent': 'order',
+        'medication': {'reference': {'reference': f'#{local_id}'}},
+        'subject': {'reference': f'Patient/pat{i % 1000}'},
+        'encounter': {'reference': f'Encounter/enc-{rng.randrange(encounter_count)}'},
+        'authoredOn': authored.date().isoformat(),
+        'requester': {'reference': f'Practitioner/prac-{rng.randrange(200)}'},
+        'dosageInstruction': [{
+            'sequence': 1,
+            'text': f'Take {quantity} tablets daily starting {start:%B %d, %Y}',
+            'timing': {'repeat': {
+                'boundsPeriod': {'start': start.date().isoformat(), 'end': end.date().isoformat()},
+                'frequency': 1, 'period': 1, 'periodUnit': 'd',
+            }},
+            'route': coding('http://snomed.info/sct', route_code, route),
+            'method': coding('http://snomed.info/sct', method_code, method),
+            'doseAndRate': [{'doseQuantity': {
+                'value': quantity, 'unit': 'TAB',
+                'system': 'http://terminology.hl7.org/CodeSystem/v3-orderableDrugForm', 'code': 'TAB',
+            }}],
+        }],
+    }
+
+# Build MedicationAdministration i, shaped like medication_administration.json; it
+# administers MedicationRequest i
+def make_medication_administration(i, rng, request):
+    medication = request['contained'][0]
+    route_code, route, method_code, method = rng.choice(ROUTES)
+    start = datetime.fromisoformat(request['dosageInstruction'][0]['timing']['repeat']['boundsPeriod']['start'])
+    start += timedelta(hours=rng.randrange(24), minutes=rng.randrange(60))
+    end = start + timedelta(minutes=rng.choice((5, 30, 120)))
+    dose = request['dosageInstruction'][0]['doseAndRate'][0]['doseQuantity']['value']
+    return {
+        'resourceType': 'MedicationAdministration',
+        'id': f'medadmin-{i}',
+        'contained': [medication],
+        'status': rng.choice(('completed', 'completed', 'completed', 'not-done', 'in-progress')),
+        'medication': {'reference': {'reference': f"#{medication['id']}"}},
+        'subject': request['subject'],
+        'encounter': request['encounter'],
+        'occurencePeriod': {'start': f'{start.isoformat()}+00:00', 'end': f'{end.isoformat()}+00:00'},
+        'performer': [{'actor': {'reference': {'reference': f'Practitioner/prac-{rng.randrange(200)}'}}}],
+        'request': {'reference': f"MedicationRequest/{request['id']}"},
+        'dosage': {
+            'text': f'{dose} TAB {route.split(" ")[0].lower()}',
+            'route': coding('http://snomed.info/sct', route_code, route),
+            'method': coding('http://snomed.info/sct', method_code, method),
+            'dose': {'value': dose, 'unit': 'TAB', 'system': 'http://unitsofmeasure.org', 'code': 'TAB'},
+        },
+    }
+
+# Return about `size` bytes of note-like text
+def note_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+# Build DocumentReference i: a url_fraction share reference a Binary on binary_base_url,
+# the rest carry base64 text/plain data
+def make_document_reference(i, rng, encounter_count, url_fraction, attachment_size, binary_base_url):
+    category_code, category_display = rng.choice(NOTE_CATEGORIES)
+    type_code, type_display = rng.choice(NOTE_TYPES)
+    if rng.random() < url_fraction:
+        attachment = {'contentType': 'application/pdf', 'url': f'{binary_base_url}/Binary/doc-{i}'}
+    else:
+        text = f'Note {i}: ' + note_text(rng, attachment_size)
+        attachment = {'contentType': 'text/plain', 'data': base64.b64encode(text.encode('utf-8')).decode('ascii')}
+    return {
+        'resourceType': 'DocumentReference',
+        'id': f'doc-{i}',
+        'meta': {'versionId': '1', 'lastUpdated': f'{random_datetime(rng).isoformat()}Z'},
+        'status': 'current',
+        'type': coding('https://fhir.cerner.com/codeSet/72', type_code, type_display),
+        'category': [coding('http://loinc.org', category_code, category_display)],
+        'subject': {'reference': f'Patient/pat{i % 1000}'},
+        'date': f'{random_datetime(rng).isoformat()}Z',
+        'author': [{'reference': f'Practitioner/prac-{rng.randrange(200)}'}],
+        'content': [{'attachment': attachment}],
+        'context': {'encounter': [{'reference': f'Encounter/enc-{rng.randrange(encounter_count)}'}]},
+    }
+
+# Write resources as NDJSON, one per line; returns how many were written
+def write_ndjson(path, resources):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for resource in resources:
+            f.write(json.dumps(resource, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+    return count
+
+# Write resources as a collection Bundle without building it in memory; returns how many were written
+def write_bundle(path, resources):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"resourceType":"Bundle","type":"collection","entry":[')
+        for resource in resources:
+            if count:
+                f.write(',')
+            f.write(json.dumps({'fullUrl': f"{resource['resourceType']}/{resource['id']}", 'resource': resource},
+                               separators=(',', ':')))
+            count += 1
+        f.write(']}')
+    return count
+
+# Write Medication.ndjson, MedicationRequest.ndjson and MedicationAdministration.ndjson to
+# directory, `count` requests and administrations over a catalog of count/100 medications.
+# Returns {resource type: count}
+def generate_medications(directory, count, seed=0, encounter_count=None):
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    medication_count = max(len(MEDICATION_CATALOG), count // MEDICATIONS_PER_REQUEST)
+    encounter_count = encounter_count or max(1, count // 10)
+    counts = {}
+
+    counts['Medication'] = write_ndjson(
+        os.path.join(directory, 'Medication.ndjson'),
+        (make_medication(i, rng) for i in range(medication_count)))
+
+    # Administrations follow their requests, so both files are written in one pass
+    request_path = os.path.join(directory, 'MedicationRequest.ndjson')
+    admin_path = os.path.join(directory, 'MedicationAdministration.ndjson')
+    with open(request_path, 'w', encoding='utf-8') as requests_file, \
+            open(admin_path, 'w', encoding='utf-8') as admins_file:
+        for i in range(count):
+            request = make_medication_request(i, rng, medication_count, encounter_count)
+            requests_file.write(json.dumps(request, separators=(',', ':')) + '\n')
+            admin = make_medication_administration(i, rng, request)
+            admins_file.write(json.dumps(admin, separators=(',', ':')) + '\n')
+    counts['MedicationRequest'] = count
+    counts['MedicationAdministration'] = count
+    return counts
+
+# Write `count` DocumentReferences to path, as a Bundle or (for .ndjson paths) NDJSON.
+# Returns (documents written, of which Binary URL references)
+def generate_documents(path, count, seed=0, url_fraction=DEFAULT_URL_FRACTION,
+                       attachment_size=DEFAULT_ATTACHMENT_SIZE,
+                       binary_base_url=f'http://127.0.0.1:{DEFAULT_BINARY_PORT}', encounter_count=None):
+    rng = random.Random(seed + 1)
+    encounter_count = encounter_count or max(1, count // 10)
+    url_count = 0
+
+    def documents():
+        nonlocal url_count
+        for i in range(count):
+            doc = make_document_reference(i, rng, encounter_count, url_fraction, attachment_size, binary_base_url)
+            url_count += 'url' in doc['content'][0]['attachment']
+            yield doc
+
+    write = write_ndjson if path.endswith('.ndjson') else write_bundle
+    return write(path, documents()), url_count
+
+# Generate the full data set into directory and record the parameters in its manifest.
+# An existing directory generated with the same parameters is reused as is
+def generate_dataset(directory, scale, seed=0, url_fraction=DEFAULT_URL_FRACTION,
+                     attachment_size=DEFAULT_ATTACHMENT_SIZE, binary_port=DEFAULT_BINARY_PORT, log=print):
+    params = {'scale': scale, 'seed': seed, 'url_fraction': url_fraction,
+              'attachment_size': attachment_size, 'binary_port': binary_port}
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['params'] == params:
+            log(f"Reusing synthetic data in {directory}")
+            return manifest
+        os.remove(manifest_path)
+
+    os.makedirs(directory, exist_ok=True)
+    log(f"Generating {scale} resources per type into {directory}")
+    counts = generate_medications(os.path.join(directory, 'medications'), scale, seed)
+    documents, urls = generate_documents(
+        os.path.join(directory, 'DocumentReference.json'), scale, seed, url_fraction, attachment_size,
+        f'http://127.0.0.1:{binary_port}')
+    counts['DocumentReference'] = documents
+    counts['Binary URL references'] = urls
+
+    manifest = {'params': params, 'counts': counts, 'generated_at': datetime.now().isoformat(timespec='seconds')}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class BinaryHandler(BaseHTTPRequestHandler):
+    """Serves /Binary/<id> the way the EHR does for the fetcher.
+
+    Accept: application/fhir+json returns the Binary resource metadata; any
+    other Accept returns binary_size bytes of content derived from the id.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    binary_size = DEFAULT_BINARY_SIZE
+    # Headers and body go out as separate writes; with Nagle on, keep-alive clients wait
+    # for the delayed ACK (~40ms) on every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self.path.startswith('/Binary/'):
+            self.send_error(404)
+            return
+        binary_id = self.path.rsplit('/', 1)[-1]
+        if self.headers.get('Accept') == 'application/fhir+json':
+            body = json.dumps({'resourceType': 'Binary', 'id': binary_id, 'contentType': 'application/pdf'}).encode()
+            content_type = 'application/fhir+json'
+        else:
+            header = f'%PDF-1.4\n% synthetic {binary_id}\n'.encode()
+            body = header + b'0' * max(self.binary_size - len(header), 0)
+            content_type = 'application/pdf'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Start the Binary server in a daemon thread; returns the server (call shutdown() to stop it)
+def start_binary_server(port=DEFAULT_BINARY_PORT, binary_size=DEFAULT_BINARY_SIZE):
+    handler = type('SizedBinaryHandler', (BinaryHandler,), {'binary_size': binary_size})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic FHIR data for benchmarking the importers')
+    parser.add_argument('directory', help='Output directory')
+    parser.add_argument('--scale', type=int, default=10000,
+                        help='DocumentReferences, MedicationRequests and MedicationAdministrations each (default: 10000)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--url-fraction', type=float, default=DEFAULT_URL_FRACTION,
+                        help=f'Share of documents that reference a Binary URL (default: {DEFAULT_URL_FRACTION})')
+    parser.add_argument('--attachment-size', type=int, default=DEFAULT_ATTACHMENT_SIZE,
+                        help=f'Approximate bytes per inline attachment (default: {DEFAULT_ATTACHMENT_SIZE})')
+    parser.add_argument('--binary-port', type=int, default=DEFAULT_BINARY_PORT,
+                        help=f'Port the Binary URLs point at (default: {DEFAULT_BINARY_PORT})')
+    parser.add_argument('--serve', action='store_true',
+                        help='Afterwards, serve the Binary URLs until interrupted')
+    args = parser.parse_args()
+
+    manifest = generate_dataset(args.directory, args.scale, args.seed, args.url_fraction,
+                                args.attachment_size, args.binary_port)
+    for resource_type, count in manifest['counts'].items():
+        print(f"{resource_type}: {count}")
+
+    if args.serve:
+        server = start_binary_server(args.binary_port)
+        print(f"Serving Binary content on http://127.0.0.1:{args.binary_port}/Binary/ (Ctrl-C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+            sys.exit(0)
+
+if __name__ == "__main__":
+    main()
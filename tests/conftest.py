@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# The scripts live at the top of the checkout and are imported as plain modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Scripts call logging.basicConfig(filename=...) on import; with a handler already on the
+# root logger that is a no-op, so collecting the tests doesn't truncate the checkout's logs
+logging.getLogger().addHandler(logging.NullHandler())
+
+from db_connection import get_connection, close_all
+
+
+class StandInBinaryHandler(BaseHTTPRequestHandler):
+    """Binary endpoint of a stand-in FHIR server, at /Binary/<id>.
+
+    Accept: application/fhir+json returns the Binary resource with its
+    contentType; any other Accept returns the content, labelled with the
+    Binary's real type whatever was asked for. Ids in server.unavailable
+    answer 503, and with server.metadata False the Binary resource isn't
+    served (406), which leaves clients to guess the Accept header. Every
+    request is counted in server.requests by (id, Accept).
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        binary_id = self.path.rsplit('/', 1)[-1]
+        accept = self.headers.get('Accept')
+        with server.lock:
+            server.requests[(binary_id, accept)] += 1
+        if not self.path.startswith('/Binary/'):
+            self.send_error(404)
+            return
+        if binary_id in server.unavailable:
+            self.send_error(503)
+            return
+        content_type = server.content_types.get(binary_id, 'text/plain')
+        if accept == 'application/fhir+json':
+            if not server.metadata:
+                self.send_error(406)
+                return
+            body = json.dumps({'resourceType': 'Binary', 'id': binary_id, 'contentType': content_type}).encode()
+            content_type = 'application/fhir+json'
+        else:
+            # Slow enough that fetches of the same URL overlap
+            time.sleep(server.delay)
+            body = f'content of {binary_id}'.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def fhir_server():
+    """Stand-in FHIR server on a free local port; binary_url(id) gives a Binary's URL"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInBinaryHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = Counter()
+    server.unavailable = set()
+    server.content_types = {}
+    server.metadata = True
+    server.delay = 0.05
+    server.binary_url = lambda binary_id: f'http://127.0.0.1:{server.server_port}/Binary/{binary_id}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+class FakeClock:
+    """time.time stand-in that only moves when told to"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freeze time.time at a fixed instant; clock.advance(seconds) moves it on"""
+    clock = FakeClock(1_600_000_000.0)
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+
+class FakeJitter:
+    """random.uniform stand-in returning the bottom of the range, or the top with high set"""
+
+    high = False
+
+    def __call__(self, low, high):
+        return high if self.high else low
+
+
+@pytest.fixture
+def jitter(monkeypatch):
+    """Take the randomness out of the retry backoff; jitter.high = True picks the longest delays"""
+    jitter = FakeJitter()
+    monkeypatch.setattr(random, 'uniform', jitter)
+    return jitter
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Connection to a freshly migrated healthcare.db in an empty working directory"""
+    monkeypatch.chdir(tmp_path)
+    conn = get_connection()
+    yield conn
+    conn.close()
+    close_all()
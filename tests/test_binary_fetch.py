@@ -0,0 +1,210 @@
+import time
+import sqlite3
+
+import extract_binary_content
+from extract_binary_content import (process_url_references, process_url_references_concurrent, FetchScheduler,
+                                    HostCircuitBreaker)
+from fetch_queue import RetryPolicy, queue_counts, iter_claimed, record_failures, mark_done
+
+
+# Add a note with one URL reference version per URL; the fetch queue trigger queues them.
+# Returns the version ids in the same order
+def add_url_references(conn, urls):
+    cursor = conn.cursor()
+    version_ids = []
+    for i, url in enumerate(urls):
+        cursor.execute("INSERT INTO note (note_id_external) VALUES (?)", (f'doc-{i}',))
+        note_id = cursor.lastrowid
+        cursor.execute(
+            "INSERT INTO note_version (note_id, version_number, note_text) VALUES (?, 1, ?)",
+            (note_id, f'URL: {url}')
+        )
+        version_ids.append(cursor.lastrowid)
+    conn.commit()
+    return version_ids
+
+
+def stored_content(conn, version_id):
+    row = conn.execute(
+        """SELECT b.content FROM note_version nv JOIN note_blob b ON b.content_hash = nv.content_hash
+           WHERE nv.version_id = ?""",
+        (version_id,)
+    ).fetchone()
+    return bytes(row[0]) if row else None
+
+
+def stored_content_type(conn, version_id):
+    return conn.execute("SELECT content_type FROM note_version WHERE version_id = ?", (version_id,)).fetchone()[0]
+
+
+def content_requests(server, binary_id):
+    return sum(count for (requested, accept), count in server.requests.items()
+               if requested == binary_id and accept != 'application/fhir+json')
+
+
+# A scheduler that stops once only retries in the distant future are left
+def scheduler_with_budget():
+    return FetchScheduler(RetryPolicy(base_delay=3600, max_delay=3600), deadline=time.time() + 60)
+
+
+def test_each_url_fetched_once_for_all_its_versions(database, fhir_server):
+    binary_ids = ['a', 'b', 'a', 'c', 'a', 'b']
+    version_ids = add_url_references(database, [fhir_server.binary_url(binary_id) for binary_id in binary_ids])
+
+    success_count, error_count = process_url_references_concurrent(concurrency=4, mime_cache_ttl=0)
+
+    assert (success_count, error_count) == (6, 0)
+    assert queue_counts(database) == {'done': 6}
+    for version_id, binary_id in zip(version_ids, binary_ids):
+        assert stored_content(database, version_id) == f'content of {binary_id}'.encode()
+    # Duplicates of a URL still in flight wait for that fetch instead of starting another
+    assert {binary_id: content_requests(fhir_server, binary_id) for binary_id in 'abc'} == {'a': 1, 'b': 1, 'c': 1}
+
+
+def test_unavailable_binary_is_scheduled_for_retry(database, fhir_server):
+    fhir_server.unavailable.add('down')
+    add_url_references(database, [fhir_server.binary_url('up'), fhir_server.binary_url('down')])
+
+    success_count, error_count = process_url_references_concurrent(
+        concurrency=2, mime_cache_ttl=0, scheduler=scheduler_with_budget())
+
+    assert (success_count, error_count) == (1, 1)
+    assert queue_counts(database) == {'done': 1, 'pending': 1}
+
+
+def test_failed_write_is_retried_not_failed(database, fhir_server, monkeypatch):
+    version_ids = add_url_references(database, [fhir_server.binary_url('a'), fhir_server.binary_url('b')])
+
+    def failing_store(cursor, items):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(extract_binary_content, 'store_binary_contents', failing_store)
+        success_count, error_count = process_url_references_concurrent(
+            concurrency=2, mime_cache_ttl=0, scheduler=scheduler_with_budget())
+
+    assert (success_count, error_count) == (0, 2)
+    rows = database.execute("SELECT state, attempts, last_error FROM binary_fetch_queue ORDER BY version_id").fetchall()
+    assert [tuple(row) for row in rows] == [('pending', 1, 'Could not store fetched content')] * 2
+
+    # Once the store works again the retries go through
+    database.execute("UPDATE binary_fetch_queue SET next_attempt_at = 0")
+    database.commit()
+    assert process_url_references_concurrent(concurrency=2, mime_cache_ttl=0) == (2, 0)
+    assert [stored_content(database, version_id) for version_id in version_ids] == [b'content of a', b'content of b']
+
+
+def test_content_type_is_each_binarys_own(database, fhir_server):
+    fhir_server.content_types.update(report='application/pdf', note='text/plain', scan='image/png')
+    version_ids = add_url_references(database, [fhir_server.binary_url(binary_id) for binary_id in ('report', 'note', 'scan')])
+
+    assert process_url_references() == (3, 0)
+
+    # Binaries under one path don't share a type, whatever the first one's metadata said
+    assert [stored_content_type(database, version_id) for version_id in version_ids] == \
+        ['application/pdf', 'text/plain', 'image/png']
+
+
+def test_fallback_accept_is_cached_but_type_comes_from_the_response(database, fhir_server):
+    fhir_server.metadata = False
+    fhir_server.content_types.update(page='text/html', scan='image/png')
+    version_ids = add_url_references(database, [fhir_server.binary_url('page'), fhir_server.binary_url('scan')])
+
+    assert process_url_references() == (2, 0)
+
+    assert [stored_content_type(database, version_id) for version_id in version_ids] == ['text/html', 'image/png']
+    # The second Binary reused the negotiated Accept header: no metadata request, one content request
+    assert fhir_server.requests[('scan', 'application/fhir+json')] == 0
+    assert content_requests(fhir_server, 'scan') == 1
+
+
+def test_breaker_opens_probes_and_closes(clock):
+    breaker = HostCircuitBreaker(failure_threshold=2, cooldown=10, max_cooldown=25)
+    url = 'http://down.example/Binary/1'
+    other = 'http://up.example/Binary/2'
+
+    breaker.record(url, failed=True)
+    # A non-transient answer proves the host is up and resets the count
+    breaker.record(url, failed=False)
+    breaker.record(url, failed=True)
+    assert breaker.allow(url) == (True, None)
+    breaker.record(url, failed=True)
+    assert breaker.trips == 1
+    assert breaker.allow(url) == (False, clock.now + 10)
+    assert breaker.allow(other) == (True, None)
+
+    # Once the cooldown is over a single probe goes through; each failed probe doubles the cooldown
+    for cooldown in (20, 25):
+        clock.advance(breaker.hosts['down.example']['cooldown'])
+        assert breaker.allow(url) == (True, None)
+        assert breaker.allow(url) == (False, clock.now + 1)
+        breaker.record(url, failed=True)
+        assert breaker.allow(url) == (False, clock.now + cooldown)
+
+    clock.advance(25)
+    assert breaker.allow(url) == (True, None)
+    breaker.record(url, failed=False)
+    assert breaker.allow(url) == (True, None)
+    assert breaker.allow(url) == (True, None)
+    assert breaker.hosts['down.example']['cooldown'] == 10
+    assert (breaker.trips, breaker.deferred) == (1, 5)
+
+
+class FakeStopEvent:
+    """Stop event whose wait() moves the fake clock on instead of sleeping"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.waits = []
+
+    def is_set(self):
+        return False
+
+    def wait(self, seconds):
+        self.waits.append(seconds)
+        self.clock.advance(seconds)
+        return False
+
+
+def failing_then_succeeding_round(conn, policy, rounds):
+    # The first round fails every due entry with a transient error, later ones fetch them
+    def run_round():
+        rounds.append(time.time())
+        claimed = [row['version_id'] for row in iter_claimed(conn)]
+        if len(rounds) == 1:
+            record_failures(conn.cursor(), [(version_id, 'HTTP 503', True) for version_id in claimed], policy)
+            conn.commit()
+            return 0, len(claimed)
+        mark_done(conn.cursor(), claimed)
+        conn.commit()
+        return len(claimed), 0
+    return run_round
+
+
+def test_scheduler_waits_for_retries_due_within_its_budget(database, clock, jitter):
+    add_url_references(database, ['http://fhir.example/Binary/a', 'http://fhir.example/Binary/b'])
+    policy = RetryPolicy(base_delay=30)
+    stop_event = FakeStopEvent(clock)
+    rounds = []
+    start = clock.now
+
+    scheduler = FetchScheduler(policy, deadline=start + 60, stop_event=stop_event)
+    assert scheduler.run(database, failing_then_succeeding_round(database, policy, rounds)) == (2, 2)
+
+    assert stop_event.waits == [15]
+    assert rounds == [start, start + 15]
+    assert queue_counts(database) == {'done': 2}
+
+
+def test_scheduler_leaves_retries_past_its_deadline_queued(database, clock, jitter):
+    add_url_references(database, ['http://fhir.example/Binary/a'])
+    policy = RetryPolicy(base_delay=30)
+    stop_event = FakeStopEvent(clock)
+    rounds = []
+
+    scheduler = FetchScheduler(policy, deadline=clock.now + 10, stop_event=stop_event)
+    assert scheduler.run(database, failing_then_succeeding_round(database, policy, rounds)) == (0, 1)
+
+    assert stop_event.waits == []
+    assert len(rounds) == 1
+    assert queue_counts(database) == {'pending': 1}
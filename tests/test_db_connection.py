@@ -0,0 +1,39 @@
+from db_connection import get_connection
+from import_document_reference import import_document_references_bulk
+
+
+def test_released_connection_is_reset(database):
+    database.execute("CREATE TABLE t (x)")
+    database.commit()
+    conn = get_connection()
+    conn.isolation_level = None
+    conn.execute("BEGIN")
+    conn.execute("INSERT INTO t VALUES (1)")
+    conn.close()
+
+    conn = get_connection()
+    try:
+        assert conn.isolation_level == ''
+        # An implicit transaction again, so rollback() undoes the insert
+        conn.execute("INSERT INTO t VALUES (2)")
+        conn.rollback()
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+
+def test_bulk_import_leaves_pooled_connection_transactional(database):
+    document = {
+        'resourceType': 'DocumentReference', 'id': 'doc-1', 'date': '2015-01-22T10:00:00Z',
+        'content': [{'attachment': {'contentType': 'text/plain', 'data': 'bm90ZQ=='}}],
+    }
+    assert import_document_references_bulk([document]) == (1, 1)
+
+    conn = get_connection()
+    try:
+        assert conn.isolation_level == ''
+        conn.execute("DELETE FROM note")
+        conn.rollback()
+        assert conn.execute("SELECT COUNT(*) FROM note").fetchone()[0] == 1
+    finally:
+        conn.close()
@@ -0,0 +1,42 @@
+import base64
+
+import import_document_reference
+from import_document_reference import import_document_references_bulk
+from note_search import search_notes
+
+
+def document(doc_id, text):
+    return {'resourceType': 'DocumentReference', 'id': doc_id, 'date': '2020-03-01T10:00:00Z',
+            'type': {'coding': [{'code': '11506-3', 'display': 'Progress note'}]},
+            'content': [{'attachment': {'contentType': 'text/plain',
+                                        'data': base64.b64encode(text.encode()).decode()}}]}
+
+
+def test_failed_chunk_is_rolled_back_alone(database, monkeypatch):
+    documents = [document(f'doc-{i}', f'note {i} about {word}')
+                 for i, word in enumerate(['aspirin', 'aspirin', 'warfarin', 'warfarin', 'heparin', 'heparin'])]
+    store_blobs = import_document_reference.store_blobs
+
+    def failing_store_blobs(cursor, items):
+        # The second chunk fails after its notes are inserted
+        if any(payload.endswith(b'warfarin') for _, payload, _ in items):
+            raise RuntimeError('disk full')
+        return store_blobs(cursor, items)
+
+    monkeypatch.setattr(import_document_reference, 'store_blobs', failing_store_blobs)
+    assert import_document_references_bulk(documents, chunk_size=2) == (4, 4)
+
+    notes = database.execute(
+        """SELECT n.note_id_external, CAST(b.content AS TEXT) FROM note n
+           JOIN note_version nv ON nv.version_id = n.current_version_id
+           JOIN note_blob b ON b.content_hash = nv.content_hash
+           ORDER BY n.note_id"""
+    ).fetchall()
+    assert [tuple(row) for row in notes] == [('doc-0', 'note 0 about aspirin'), ('doc-1', 'note 1 about aspirin'),
+                                             ('doc-4', 'note 4 about heparin'), ('doc-5', 'note 5 about heparin')]
+    assert database.execute("SELECT COUNT(*) FROM note_version").fetchone()[0] == 4
+    # The committed chunks are searchable, and the rollback left the search trigger switched on
+    assert len(search_notes(database, 'aspirin')) == 2
+    assert len(search_notes(database, 'heparin')) == 2
+    assert search_notes(database, 'warfarin') == []
+    assert database.execute("SELECT COUNT(*) FROM note_fts_suspended").fetchone()[0] == 0
@@ -0,0 +1,46 @@
+from fetch_queue import RetryPolicy, record_failures, FAILED, PENDING
+
+
+def queue_urls(conn, count):
+    version_ids = []
+    for i in range(count):
+        note_id = conn.execute("INSERT INTO note (note_id_external) VALUES (?)", (f'doc-{i}',)).lastrowid
+        version_ids.append(conn.execute(
+            "INSERT INTO note_version (note_id, version_number, note_text) VALUES (?, 1, ?)",
+            (note_id, f'URL: http://fhir.example/Binary/{i}')
+        ).lastrowid)
+    conn.commit()
+    return version_ids
+
+
+def queue_row(conn, version_id):
+    return tuple(conn.execute(
+        "SELECT state, attempts, last_error, next_attempt_at FROM binary_fetch_queue WHERE version_id = ?",
+        (version_id,)
+    ).fetchone())
+
+
+def test_backoff_doubles_up_to_the_cap(jitter):
+    policy = RetryPolicy(base_delay=30, max_delay=200)
+    assert [policy.delay(attempts) for attempts in range(1, 6)] == [15, 30, 60, 100, 100]
+    jitter.high = True
+    assert [policy.delay(attempts) for attempts in range(1, 6)] == [30, 60, 120, 200, 200]
+
+
+def test_transient_failures_back_off_until_the_attempt_cap(database, clock, jitter):
+    flaky, missing = queue_urls(database, 2)
+    policy = RetryPolicy(max_attempts=3, base_delay=30, max_delay=1800)
+    cursor = database.cursor()
+
+    assert record_failures(cursor, [(flaky, 'HTTP 503', True), (missing, 'HTTP 404', False)], policy) == (1, 1)
+    # A permanent failure is final at once; a transient one is retried after the backoff
+    assert queue_row(database, flaky) == (PENDING, 1, 'HTTP 503', clock.now + 15)
+    assert queue_row(database, missing)[:3] == (FAILED, 1, 'HTTP 404')
+
+    clock.advance(15)
+    assert record_failures(cursor, [(flaky, 'timed out', True)], policy) == (1, 0)
+    assert queue_row(database, flaky) == (PENDING, 2, 'timed out', clock.now + 30)
+
+    clock.advance(30)
+    assert record_failures(cursor, [(flaky, 'HTTP 503', True)], policy) == (0, 1)
+    assert queue_row(database, flaky)[:3] == (FAILED, 3, 'HTTP 503')
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from fhir_stream import iter_resources
+
+RESOURCES = [
+    {'resourceType': 'Observation', 'id': 'obs-1', 'valueQuantity': {'value': 12.5, 'unit': 'mg'},
+     'referenceRange': [{'low': {'value': 1e3}, 'high': {'value': 1.5e-2}}], 'component': []},
+    {'resourceType': 'Observation', 'id': 'obs-2', 'valueInteger': -120, 'interpretation': None,
+     'issued': '2020-03-01T10:00:00+01:00', 'note': [{'text': 'line "quoted" \\ and é\n'}]},
+    {'resourceType': 'MedicationRequest', 'id': 'rx-1', 'doNotPerform': False, 'priority': 0.25,
+     'dosageInstruction': [{'sequence': 1, 'timing': {'repeat': {'frequency': 3, 'period': 1.0E2}}}]},
+]
+
+
+def write(tmp_path, text):
+    path = tmp_path / 'resources.json'
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def read(path, read_size, resource_type=None):
+    return list(iter_resources(path, resource_type, read_size=read_size))
+
+
+@pytest.mark.parametrize('read_size', range(1, 8))
+def test_bundle(tmp_path, read_size):
+    bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'total': 12.5,
+              'entry': [{'fullUrl': f"urn:uuid:{i}", 'resource': resource} for i, resource in enumerate(RESOURCES)],
+              'link': [{'relation': 'self', 'url': 'http://example.org/fhir'}], 'score': 1e2}
+    assert read(write(tmp_path, json.dumps(bundle)), read_size) == RESOURCES
+
+
+@pytest.mark.parametrize('read_size', range(1, 8))
+def test_array(tmp_path, read_size):
+    assert read(write(tmp_path, json.dumps(RESOURCES, indent=1)), read_size) == RESOURCES
+
+
+@pytest.mark.parametrize('read_size', range(1, 8))
+def test_single_resource(tmp_path, read_size):
+    for resource in RESOURCES:
+        assert read(write(tmp_path, json.dumps(resource)), read_size) == [resource]
+
+
+@pytest.mark.parametrize('read_size', range(1, 8))
+def test_concatenated_resources(tmp_path, read_size):
+    path = write(tmp_path, '\n'.join(json.dumps(resource) for resource in RESOURCES) + '\n')
+    assert read(path, read_size) == RESOURCES
+    assert read(path, read_size, 'MedicationRequest') == [RESOURCES[2]]
+
+
+def test_number_straddling_the_default_read_size(tmp_path):
+    # '"total": 12.5' with the read boundary right after '12.'
+    prefix = '{"resourceType": "Bundle", "padding": "'
+    head = '", "total": 12.'
+    text = prefix + 'x' * ((1 << 20) - len(prefix) - len(head)) + head + '5, "entry": [{"resource": {"id": "a"}}]}'
+    assert read(write(tmp_path, text), 1 << 20) == [{'id': 'a'}]
+
+
+def test_malformed_input_is_reported(tmp_path):
+    with pytest.raises(ValueError):
+        read(write(tmp_path, '{"resourceType": "Patient", "id": 12x}'), 3)
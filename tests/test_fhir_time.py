@@ -0,0 +1,66 @@
+import calendar
+
+import pytest
+
+from fhir_time import parse_fhir_datetime, fhir_period_end, epoch_range, to_epochs
+
+
+def utc(year, month, day, hour=0, minute=0, second=0):
+    return calendar.timegm((year, month, day, hour, minute, second))
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2020', utc(2020, 1, 1)),
+    ('2020-03', utc(2020, 3, 1)),
+    ('2020-03-15', utc(2020, 3, 15)),
+    ('2020-03-15T10:30:00Z', utc(2020, 3, 15, 10, 30, 0)),
+    ('2020-03-15T10:30:00+02:00', utc(2020, 3, 15, 8, 30, 0)),
+    ('2020-03-15T23:30:00-05:00', utc(2020, 3, 16, 4, 30, 0)),
+    # Without a zone the time is taken as UTC, and fractions of a second are dropped
+    ('2020-03-15T10:30:00', utc(2020, 3, 15, 10, 30, 0)),
+    ('2020-03-15T10:30:00.999Z', utc(2020, 3, 15, 10, 30, 0)),
+    (' 2020-03-15 ', utc(2020, 3, 15)),
+    ('1969-12-31T23:59:59.5Z', -1),
+])
+def test_parse_fhir_datetime(value, expected):
+    assert parse_fhir_datetime(value) == expected
+
+
+@pytest.mark.parametrize('value', [None, 20200315, '', 'soon', '2020-13', '2020-02-30', '2020-03-15T25:00:00Z'])
+def test_parse_fhir_datetime_rejects_non_dates(value):
+    assert parse_fhir_datetime(value) is None
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2020', utc(2021, 1, 1)),
+    ('2020-03', utc(2020, 4, 1)),
+    ('2020-12', utc(2021, 1, 1)),
+    ('2020-02-29', utc(2020, 3, 1)),
+    ('2020-12-31', utc(2021, 1, 1)),
+    ('2020-03-15T10:30:00Z', utc(2020, 3, 15, 10, 30, 1)),
+    ('2020-03-15T10:30:00+02:00', utc(2020, 3, 15, 8, 30, 1)),
+])
+def test_fhir_period_end_is_exclusive_at_the_values_precision(value, expected):
+    assert fhir_period_end(value) == expected
+
+
+def test_fhir_period_end_of_a_non_date():
+    assert fhir_period_end('soon') is None
+
+
+def test_epoch_range():
+    assert epoch_range('2020-03', '2020-03') == (utc(2020, 3, 1, 0, 0, 0), utc(2020, 4, 1))
+    assert epoch_range('2020-03-15T10:00:00+01:00', None) == (utc(2020, 3, 15, 9, 0, 0), None)
+    assert epoch_range(None, '2020') == (None, utc(2021, 1, 1))
+    assert epoch_range() == (None, None)
+    with pytest.raises(ValueError):
+        epoch_range('yesterday')
+    with pytest.raises(ValueError):
+        epoch_range('2020', '2020-02-30')
+
+
+def test_to_epochs_parses_each_distinct_value_once():
+    cache = {}
+    assert to_epochs(['2020', None, '2020', 'soon'], cache) == [utc(2020, 1, 1, 0, 0, 0), None,
+                                                                 utc(2020, 1, 1, 0, 0, 0), None]
+    assert cache == {'2020': utc(2020, 1, 1, 0, 0, 0), None: None, 'soon': None}
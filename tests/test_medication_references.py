@@ -0,0 +1,92 @@
+import os
+import json
+import shutil
+
+from db_connection import get_connection, close_all
+from import_json_data import (import_medication, import_medication_request, import_medication_administration,
+                              import_bulk_export, load_json_file)
+from medication_references import ExternalIdMap
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def contained_medication(local_id, system, code, display):
+    return {'resourceType': 'Medication', 'id': local_id,
+            'code': {'coding': [{'system': system, 'code': code, 'display': display}]}}
+
+
+def request(request_id, medication):
+    return {'resourceType': 'MedicationRequest', 'id': request_id, 'contained': [medication],
+            'medication': {'reference': {'reference': f"#{medication['id']}"}},
+            'encounter': {'reference': 'Encounter/enc-1'}, 'authoredOn': '2015-01-22'}
+
+
+def test_contained_ids_are_namespaced(database):
+    prednisone = contained_medication('med1', 'http://snomed.info/sct', '373994007', 'Prednisone 5mg tablet')
+    alemtuzumab = contained_medication('med1', 'http://www.nlm.nih.gov/research/umls/rxnorm', '1594660',
+                                       'Alemtuzumab 10mg/ml')
+    conn = get_connection(row_factory=None)
+    try:
+        import_medication(conn, {'resourceType': 'Medication', 'id': 'med1',
+                                 'code': {'coding': [{'display': 'Top-level medication'}]}})
+        id_map = ExternalIdMap()
+        import_medication_request(conn, request('rx-1', prednisone), id_map)
+        import_medication_request(conn, request('rx-2', alemtuzumab), id_map)
+        import_medication_request(conn, request('rx-3', dict(prednisone, id='med7')), id_map)
+        import_medication_administration(conn, {
+            'resourceType': 'MedicationAdministration', 'id': 'admin-1', 'contained': [alemtuzumab],
+            'request': {'reference': 'MedicationRequest/rx-2'}, 'encounter': {'reference': 'Encounter/enc-1'},
+        }, id_map)
+
+        linked = dict(conn.execute(
+            """SELECT r.medication_request_id_external, m.medication FROM medication_request r
+               JOIN medication m ON m.medication_id = r.medication_id"""
+        ).fetchall())
+        assert linked == {'rx-1': 'Prednisone 5mg tablet', 'rx-2': 'Alemtuzumab 10mg/ml',
+                          'rx-3': 'Prednisone 5mg tablet'}
+        # The same drug is one row, and the top-level Medication keeps its own
+        assert conn.execute("SELECT COUNT(*) FROM medication").fetchone()[0] == 3
+        assert conn.execute(
+            "SELECT medication FROM medication WHERE medication_id_external = 'med1'"
+        ).fetchone()[0] == 'Top-level medication'
+        assert conn.execute(
+            """SELECT a.medication_id = r.medication_id FROM medication_administration a
+               JOIN medication_request r ON r.medication_request_id = a.medication_request_id"""
+        ).fetchone()[0] == 1
+    finally:
+        conn.close()
+
+
+def medication_count(conn):
+    return conn.execute("SELECT COUNT(*) FROM medication").fetchone()[0]
+
+
+def test_reimport_into_migrated_database_adds_no_medications(tmp_path, monkeypatch):
+    shutil.copy(os.path.join(REPO, 'healthcare.db'), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    resources = [load_json_file(os.path.join(REPO, f'{name}.json'))
+                 for name in ('medication', 'medication_request', 'medication_administration')]
+    export_dir = tmp_path / 'export'
+    export_dir.mkdir()
+    for resource in resources:
+        (export_dir / f"{resource['resourceType']}.ndjson").write_text(json.dumps(resource) + '\n')
+
+    conn = get_connection(row_factory=None)
+    try:
+        # The legacy contained Medications are keyed under their container, not as top-level ids
+        assert dict(conn.execute(
+            """SELECT r.medication_request_id_external, m.medication_id_external FROM medication_request r
+               JOIN medication m ON m.medication_id = r.medication_id"""
+        ).fetchall()) == {'medrx0303': 'MedicationRequest/medrx0303#med0311'}
+        migrated = medication_count(conn)
+        for _ in range(2):
+            medication, request_data, admin_data = resources
+            import_medication(conn, medication)
+            id_map = ExternalIdMap()
+            import_medication_request(conn, request_data, id_map)
+            import_medication_administration(conn, admin_data, id_map)
+            import_bulk_export(conn, str(export_dir))
+            assert medication_count(conn) == migrated
+    finally:
+        conn.close()
+        close_all()
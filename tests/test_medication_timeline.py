@@ -0,0 +1,100 @@
+from fhir_time import parse_fhir_datetime
+from medication_timeline import rebuild_medication_summary, expected_doses, find_gaps
+
+HOUR = 3600
+T0 = parse_fhir_datetime('2020-03-01T08:00:00Z')
+
+
+def add_request(conn, request_id, encounter_id, medication_id, unit, authored_at):
+    conn.execute(
+        """INSERT INTO medication_request (medication_request_id, encounter_id, medication_id, medication,
+                                           dosage_unit, authored_at)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        (request_id, encounter_id, medication_id, f'medication {medication_id}', unit, authored_at)
+    )
+
+
+def add_administration(conn, administration_id, encounter_id, medication_id, unit, quantity, status, given_at):
+    conn.execute(
+        """INSERT INTO medication_administration (medication_administration_id, encounter_id, medication_id,
+                                                  medication_display, dosage_unit, dosage_quantity, status,
+                                                  effective_start_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (administration_id, encounter_id, medication_id, f'medication {medication_id}', unit, quantity, status,
+         given_at)
+    )
+
+
+def summary(conn):
+    return [tuple(row) for row in conn.execute(
+        "SELECT * FROM medication_encounter_summary ORDER BY encounter_id, medication_id, dose_unit"
+    )]
+
+
+def assert_matches_rebuild(conn):
+    maintained = summary(conn)
+    assert rebuild_medication_summary(conn) == len(maintained)
+    assert summary(conn) == maintained
+    return maintained
+
+
+def test_summary_triggers_match_a_rebuild(database):
+    add_request(database, 1, 'enc-1', 7, 'mg', T0)
+    add_request(database, 2, 'enc-1', 7, 'mg', T0 + 24 * HOUR)
+    add_request(database, 3, 'enc-1', None, None, T0 + HOUR)
+    add_request(database, 4, 'enc-2', 7, 'mg', T0)
+    add_administration(database, 1, 'enc-1', 7, 'mg', 5, 'completed', T0 + HOUR)
+    add_administration(database, 2, 'enc-1', 7, 'mg', 5, 'not-done', T0 + 7 * HOUR)
+    add_administration(database, 3, 'enc-1', 7, 'mg', 10, None, T0 + 13 * HOUR)
+    add_administration(database, 4, 'enc-1', 7, 'g', 1, 'completed', T0 + 2 * HOUR)
+    add_administration(database, 5, 'enc-2', None, None, None, 'completed', T0)
+
+    rows = assert_matches_rebuild(database)
+    assert rows[:3] == [
+        ('enc-1', 0, '', 'medication None', 1, 0, 0, None, T0 + HOUR, T0 + HOUR, None, None),
+        ('enc-1', 7, 'g', 'medication 7', 0, 1, 1, 1, None, None, T0 + 2 * HOUR, T0 + 2 * HOUR),
+        ('enc-1', 7, 'mg', 'medication 7', 2, 3, 2, 15, T0, T0 + 24 * HOUR, T0 + HOUR, T0 + 13 * HOUR),
+    ]
+
+    # A dose marked not given, one moved to another unit and one to another encounter
+    database.execute("UPDATE medication_administration SET status = 'entered-in-error' WHERE "
+                     "medication_administration_id = 3")
+    database.execute("UPDATE medication_administration SET dosage_unit = 'g' WHERE medication_administration_id = 1")
+    database.execute("UPDATE medication_request SET encounter_id = 'enc-2' WHERE medication_request_id = 2")
+    rows = assert_matches_rebuild(database)
+    assert ('enc-1', 7, 'mg', 'medication 7', 1, 2, 0, None, T0, T0, None, None) in rows
+
+    database.execute("DELETE FROM medication_administration WHERE medication_administration_id IN (1, 4)")
+    database.execute("DELETE FROM medication_request WHERE medication_request_id = 3")
+    rows = assert_matches_rebuild(database)
+    assert [row[:3] for row in rows] == [('enc-1', 7, 'mg'), ('enc-2', 0, ''), ('enc-2', 7, 'mg')]
+
+
+def order(timing_start=None, timing_end=None, frequency=None, period=None, period_unit=None, authored_at=None):
+    return {'timing_start': timing_start, 'timing_start_at': parse_fhir_datetime(timing_start),
+            'timing_end': timing_end, 'timing_end_at': parse_fhir_datetime(timing_end),
+            'timing_frequency': frequency, 'timing_period': period, 'timing_period_unit': period_unit,
+            'authored_at': authored_at}
+
+
+def test_expected_doses():
+    # Three times a day over two whole days: the date-only end includes its day
+    assert expected_doses(order('2020-03-01', '2020-03-02', 3, 1, 'd')) == 6
+    assert expected_doses(order('2020-03-01T08:00:00Z', '2020-03-01T20:00:00Z', 1, 4, 'h')) == 3
+    assert expected_doses(order('2020-03-01', '2020-03-02', 3, 1, 'fortnight')) is None
+    assert expected_doses(order('2020-03-01', None, 3, 1, 'd')) is None
+
+
+def test_find_gaps():
+    orders = [order('2020-03-01T08:00:00Z', '2020-03-01T20:00:00Z', 1, 4, 'h')]
+    given_at = [T0 + HOUR, T0 + 3 * HOUR]
+    threshold = 1.5 * 4 * HOUR
+    # From the last dose to the end of the order
+    assert find_gaps(orders, given_at, threshold, now=T0 + 24 * HOUR) == [
+        {'from': T0 + 3 * HOUR, 'to': T0 + 12 * HOUR + 1, 'seconds': 9 * HOUR + 1}]
+    # An order still running is only open up to now
+    assert find_gaps(orders, given_at, threshold, now=T0 + 6 * HOUR) == []
+    # Before the first dose a gap runs from the order's start, or from when it was authored without one
+    assert find_gaps([order(authored_at=T0)], [T0 + 10 * HOUR], threshold) == [
+        {'from': T0, 'to': T0 + 10 * HOUR, 'seconds': 10 * HOUR}]
+    assert find_gaps([], [T0, T0 + HOUR], threshold) == []
@@ -0,0 +1,52 @@
+import tarfile
+
+from view_note_content import export_notes
+
+
+def add_note(conn, note_id, note_text, content_type=None):
+    conn.execute("INSERT INTO note (note_id, note_type) VALUES (?, 'Progress note')", (note_id,))
+    version_id = conn.execute(
+        "INSERT INTO note_version (note_id, version_number, note_text, content_type) VALUES (?, 1, ?, ?)",
+        (note_id, note_text, content_type)
+    ).lastrowid
+    conn.execute("UPDATE note SET current_version_id = ? WHERE note_id = ?", (version_id, note_id))
+
+
+def notes_with_a_bad_payload(conn):
+    add_note(conn, 1, 'first note')
+    # A payload not moved into the blob store yet, and not valid base64
+    add_note(conn, 2, 'abc', 'application/pdf')
+    add_note(conn, 3, 'third note')
+    conn.commit()
+
+
+def test_failed_file_does_not_stop_the_export(database, tmp_path):
+    notes_with_a_bad_payload(database)
+    messages = []
+
+    exported, skipped, failed = export_notes(output_dir=str(tmp_path / 'out'), log=messages.append)
+
+    assert (exported, skipped, failed) == (2, 0, 1)
+    assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == ['note_1.txt', 'note_3.txt']
+    assert any(message.startswith('Could not export note 2') for message in messages)
+
+
+def test_failed_archive_member_is_left_out(database, tmp_path):
+    notes_with_a_bad_payload(database)
+    archive = tmp_path / 'notes.tar'
+
+    assert export_notes(archive_path=str(archive), log=lambda message: None) == (2, 0, 1)
+    with tarfile.open(archive) as tar:
+        assert tar.getnames() == ['note_1.txt', 'note_3.txt']
+
+
+def test_note_without_current_version_exports_its_latest(database, tmp_path):
+    add_note(database, 1, 'first note')
+    # As a bulk import leaves a note until its final pass sets current_version_id
+    database.execute("INSERT INTO note (note_id, note_type) VALUES (2, 'Progress note')")
+    database.execute("INSERT INTO note_version (note_id, version_number, note_text) VALUES (2, 1, 'draft')")
+    database.execute("INSERT INTO note_version (note_id, version_number, note_text) VALUES (2, 2, 'final')")
+    database.commit()
+
+    assert export_notes(output_dir=str(tmp_path / 'out'), log=lambda message: None) == (2, 0, 0)
+    assert (tmp_path / 'out' / 'note_2.txt').read_text() == 'final'
@@ -0,0 +1,26 @@
+from check_query_plans import QUERY_PATHS, check_query_plans, schema_database
+
+
+def test_every_query_path_uses_an_index():
+    conn = schema_database()
+    try:
+        results = check_query_plans(conn)
+    finally:
+        conn.close()
+
+    # A freshly migrated schema has every table, so no path is skipped
+    assert set(results) == set(QUERY_PATHS)
+    assert {name: scans for name, (plan, scans) in results.items() if scans} == {}
+
+
+def test_full_scan_is_reported():
+    conn = schema_database()
+    try:
+        results = check_query_plans(conn, {
+            'notes of a type code': ("SELECT note_id FROM note WHERE note_type_code = ?", ('2820507',)),
+        })
+    finally:
+        conn.close()
+
+    plan, scans = results['notes of a type code']
+    assert scans == ['SCAN note']
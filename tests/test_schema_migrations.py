@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+import schema_migrations
+from schema_migrations import MIGRATIONS, SCHEMA_VERSION, migrate, schema_version
+
+
+def test_failed_step_leaves_nothing_behind(tmp_path, monkeypatch):
+    conn = sqlite3.connect(tmp_path / 'healthcare.db')
+    number, description, step = MIGRATIONS[4]
+
+    def failing_step(conn):
+        step(conn)
+        raise RuntimeError('interrupted')
+
+    migrations = list(MIGRATIONS)
+    migrations[4] = (number, description, failing_step)
+    monkeypatch.setattr(schema_migrations, 'MIGRATIONS', migrations)
+    with pytest.raises(RuntimeError):
+        migrate(conn)
+
+    assert schema_version(conn) == number - 1
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'binary_fetch%'").fetchall() == []
+
+    monkeypatch.setattr(schema_migrations, 'MIGRATIONS', MIGRATIONS)
+    assert migrate(conn) == SCHEMA_VERSION - number + 1
+    conn.close()
+
+
+def test_content_blob_payloads_move_to_the_blob_store(tmp_path, monkeypatch):
+    conn = sqlite3.connect(tmp_path / 'healthcare.db')
+    with monkeypatch.context() as patch:
+        patch.setattr(schema_migrations, 'MIGRATIONS', MIGRATIONS[:11])
+        patch.setattr(schema_migrations, 'SCHEMA_VERSION', 11)
+        migrate(conn)
+    conn.execute("INSERT INTO note (note_id, note_type) VALUES (1, 'Progress note')")
+    conn.execute(
+        """INSERT INTO note_version (version_id, note_id, version_number, content_type, content_blob)
+           VALUES (1, 1, 1, 'text/plain', CAST('stored before the blob store' AS BLOB))"""
+    )
+    conn.commit()
+
+    assert migrate(conn) == SCHEMA_VERSION - 11
+    assert 'content_blob' not in [column[1] for column in conn.execute("PRAGMA table_info(note_version)")]
+    assert conn.execute(
+        """SELECT CAST(b.content AS TEXT), b.content_type, b.size FROM note_version nv
+           JOIN note_blob b ON b.content_hash = nv.content_hash WHERE nv.version_id = 1"""
+    ).fetchone() == ('stored before the blob store', 'text/plain', 28)
+    # The moved payload is searchable like any other
+    assert conn.execute("SELECT rowid FROM note_fts WHERE note_fts MATCH 'blob'").fetchall() == [(1,)]
+    conn.close()
@@ -1,13 +1,30 @@
-import sqlite3
-import base64
+import io
 import os
+import sys
+import json
+import time
+import codecs
+import tarfile
+import zipfile
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from db_connection import get_connection
+from fhir_time import epoch_range
+from note_content_store import open_payload, copy_payload, stream_payload
+
+# Notes read per fetchmany() call in export mode
+DEFAULT_EXPORT_BATCH = 500
+
+# Threads writing exported files
+DEFAULT_EXPORT_WORKERS = 8
+
+# Bytes read from the start of a text payload for the preview
+PREVIEW_BYTES = 4096
 
 # Function to get database connection
 def get_db_connection():
-    conn = sqlite3.connect('healthcare.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_connection()
 
 # Function to get note content by ID
 def get_note_content(note_id):
@@ -15,11 +32,14 @@ def get_note_content(note_id):
     cursor = conn.cursor()
     
     try:
-        # Get note details
+        # Get note details for the current version; the payload itself is streamed from note_blob
+        # later, so note_text is only read for plain text notes and URL references
         cursor.execute(
-            """SELECT n.note_id, n.note_type, nv.note_text, nv.content_type 
+            """SELECT n.note_id, n.note_type, nv.version_id, nv.content_type,
+                      CASE WHEN nv.content_type IS NULL THEN nv.note_text END AS note_text
                FROM note n 
-               JOIN note_version nv ON n.note_id = nv.note_id 
+               JOIN note_version nv ON nv.version_id = COALESCE(
+                   n.current_version_id, (SELECT MAX(version_id) FROM note_version WHERE note_id = n.note_id)) 
                WHERE n.note_id = ?""",
             (note_id,)
         )
@@ -37,9 +57,8 @@ def get_note_content(note_id):
     finally:
         conn.close()
 
-# Function to save binary content to file
-def save_content_to_file(content, content_type, note_id):
-    # Determine file extension based on content type
+# Function to pick a file extension for a content type
+def content_extension(content_type):
     extension = 'bin'  # Default
     if content_type == 'application/pdf':
         extension = 'pdf'
@@ -51,27 +70,274 @@ def save_content_to_file(content, content_type, note_id):
         extension = 'xml'
     elif content_type.startswith('image/'):
         extension = content_type.split('/')[-1]  # e.g., jpeg, png
-    
+    return extension
+
+# Function to save an open payload (or bytes [start, end) of it) to file, copying it in chunks
+def save_content_to_file(reader, size, content_type, note_id, output_dir='note_content', start=0, end=None):
     # Create output directory if it doesn't exist
-    output_dir = 'note_content'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
     
-    # Create filename
-    filename = f"{output_dir}/note_{note_id}.{extension}"
+    # Create filename; a range gets its own file next to the whole document
+    suffix = '' if (start, end) == (0, None) else f"_{start}-{min(end if end is not None else size, size)}"
+    filename = f"{output_dir}/note_{note_id}{suffix}.{content_extension(content_type)}"
     
     # Write content to file
     with open(filename, 'wb') as f:
-        f.write(content)
+        copy_payload(reader, size, f, start, end)
     
     return filename
 
+# Function to decode the start of a text payload for the preview; returns None if it isn't UTF-8
+def preview_text(reader, size):
+    reader.seek(0)
+    head = reader.read(PREVIEW_BYTES)
+    try:
+        # Incremental decoding tolerates a character cut in half at the end of the read
+        text = codecs.getincrementaldecoder('utf-8')().decode(head)
+    except UnicodeDecodeError:
+        return None
+    return text[:500] + ("..." if len(text) > 500 or size > len(head) else "")
+
+# Function to parse a START:END byte range (END exclusive, either side optional) into (start, end)
+def parse_byte_range(value):
+    start, sep, end = value.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected START:END, got {value!r}")
+    try:
+        byte_range = (int(start) if start else 0, int(end) if end else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected byte offsets, got {value!r}")
+    if byte_range[0] < 0 or (byte_range[1] is not None and byte_range[1] < byte_range[0]):
+        raise argparse.ArgumentTypeError(f"invalid byte range {value!r}")
+    return byte_range
+
+# Function to build the query for the current version of every note matching the filters.
+# Dates are FHIR dates or dateTimes (e.g. YYYY-MM-DD), inclusive, compared in UTC
+def build_export_query(note_ids=None, encounter_id=None, category=None, date_from=None, date_to=None):
+    filters = []
+    params = {}
+    if note_ids:
+        filters.append("n.note_id IN (SELECT value FROM json_each(:note_ids))")
+        params['note_ids'] = json.dumps(list(note_ids))
+    if encounter_id is not None:
+        filters.append("n.encounter_id = :encounter_id")
+        params['encounter_id'] = encounter_id
+    if category:
+        filters.append("n.category_id = (SELECT category_id FROM note_category WHERE category_code = :category)")
+        params['category'] = category
+    date_from, date_to = epoch_range(date_from, date_to)
+    if date_from is not None:
+        filters.append("n.note_date_at >= :date_from")
+        params['date_from'] = date_from
+    if date_to is not None:
+        filters.append("n.note_date_at < :date_to")
+        params['date_to'] = date_to
+    
+    # Payloads are not selected; they are streamed from note_blob when each file is written
+    sql = f"""SELECT n.note_id, nv.version_id, nv.content_type,
+                     CASE WHEN nv.content_type IS NULL THEN nv.note_text END AS note_text
+              FROM note n
+              JOIN note_version nv ON nv.version_id = COALESCE(
+                  n.current_version_id, (SELECT MAX(version_id) FROM note_version WHERE note_id = n.note_id))
+              {'WHERE ' + ' AND '.join(filters) if filters else ''}
+              ORDER BY n.note_id"""
+    return sql, params
+
+# Function to name the file for an exported row; None for URL references not fetched yet
+def export_name(note):
+    if note['content_type']:
+        return f"note_{note['note_id']}.{content_extension(note['content_type'])}"
+    if note['note_text'] and note['note_text'].startswith('URL:'):
+        return None
+    return f"note_{note['note_id']}.txt"
+
+# Function to write an exported row to out; binary payloads are streamed in chunks
+def write_export(conn, note, out):
+    if note['content_type']:
+        stream_payload(conn, note['version_id'], out)
+    else:
+        out.write((note['note_text'] or '').encode('utf-8'))
+
+# Function to stream the matching rows from the cursor a batch at a time
+def iter_export_batches(conn, sql, params, batch_size=DEFAULT_EXPORT_BATCH):
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+# Function to open a tar (.tar, .tar.gz, .tgz, or - for a tar stream on stdout) or zip archive;
+# returns (add(name, reader, size), close()), where reader is a file-like object holding size bytes
+def open_archive(path):
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        
+        def add_to_zip(name, reader, size):
+            with archive.open(name, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                copy_payload(reader, size, member)
+        return add_to_zip, archive.close
+    
+    if path == '-':
+        archive = tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+    else:
+        archive = tarfile.open(path, 'w|gz' if path.endswith(('.gz', '.tgz')) else 'w|')
+    mtime = time.time()
+    
+    def add(name, reader, size):
+        # The header needs the size up front, which the blob store knows without reading the payload
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        archive.addfile(info, reader)
+    return add, archive.close
+
+# Function to open an exported row for adding to an archive; returns (reader, size). Binary payloads
+# are read straight from the database
+def open_export(conn, note):
+    if not note['content_type']:
+        data = (note['note_text'] or '').encode('utf-8')
+        return io.BytesIO(data), len(data)
+    reader, size = open_payload(conn, note['version_id'])
+    if reader is None:
+        return io.BytesIO(), 0
+    return reader, size
+
+# Function to export the current version of many notes, either as files in output_dir or packed
+# into one archive. Rows are read in batches and payloads are copied from the database in chunks,
+# so memory use doesn't depend on document size. Plain files are written by a thread pool, each
+# thread with its own connection; archives are written in note_id order. A note that can't be read
+# or written is logged and left out, and the export goes on. Returns (exported, skipped, failed)
+def export_notes(note_ids=None, encounter_id=None, category=None, date_from=None, date_to=None,
+                 output_dir='note_content', archive_path=None, workers=DEFAULT_EXPORT_WORKERS,
+                 batch_size=DEFAULT_EXPORT_BATCH, log=print):
+    sql, params = build_export_query(note_ids, encounter_id, category, date_from, date_to)
+    conn = get_db_connection()
+    exported = 0
+    skipped = 0
+    failed = 0
+    start = time.perf_counter()
+    
+    # Blob handles belong to one connection, so every writer thread reads through its own
+    worker_state = threading.local()
+    worker_connections = []
+    
+    # Returns the file name, None for a skipped URL reference, or False if the note failed
+    def write_file(note):
+        name = export_name(note)
+        if name is None:
+            return None
+        if not hasattr(worker_state, 'conn'):
+            worker_state.conn = get_db_connection()
+            worker_connections.append(worker_state.conn)
+        path = os.path.join(output_dir, name)
+        try:
+            with open(path, 'wb') as f:
+                write_export(worker_state.conn, note, f)
+        except Exception as e:
+            log(f"Could not export note {note['note_id']}: {e}")
+            # Don't leave a truncated file behind
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+        return name
+    
+    if archive_path:
+        add_to_archive, close_archive = open_archive(archive_path)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rows in iter_export_batches(conn, sql, params, batch_size):
+                if archive_path:
+                    names = [export_name(note) for note in rows]
+                    for i, (note, name) in enumerate(zip(rows, names)):
+                        if name is None:
+                            continue
+                        try:
+                            reader, size = open_export(conn, note)
+                        except Exception as e:
+                            log(f"Could not export note {note['note_id']}: {e}")
+                            names[i] = False
+                            continue
+                        # Once a member is started the archive can't skip it, so write errors still stop the export
+                        try:
+                            add_to_archive(name, reader, size)
+                        finally:
+                            reader.close()
+                else:
+                    names = list(executor.map(write_file, rows))
+                skipped += names.count(None)
+                failed += sum(1 for name in names if name is False)
+                exported += sum(1 for name in names if name)
+                log(f"Exported {exported} notes ({skipped} URL references not fetched yet, {failed} failed)")
+    finally:
+        if archive_path:
+            close_archive()
+        for worker_conn in worker_connections:
+            worker_conn.close()
+        conn.close()
+    
+    log(f"Exported {exported} notes to {archive_path or output_dir} in {time.perf_counter() - start:.1f}s")
+    if failed:
+        log(f"{failed} notes could not be exported, see the errors above")
+    return exported, skipped, failed
+
+# Function to read note IDs from a comma-separated list or a file with one ID per line
+def parse_note_ids(ids=None, ids_file=None):
+    note_ids = []
+    if ids:
+        note_ids.extend(int(note_id) for note_id in ids.split(',') if note_id.strip())
+    if ids_file:
+        with open(ids_file, 'r') as f:
+            note_ids.extend(int(line) for line in f if line.strip())
+    return note_ids
+
 # Main function
 def main():
     # Set up argument parser
-    parser = argparse.ArgumentParser(description='View clinical note content')
-    parser.add_argument('note_id', type=int, help='ID of the note to view')
+    parser = argparse.ArgumentParser(description='View clinical note content, or export many notes at once')
+    parser.add_argument('note_id', type=int, nargs='?', help='ID of the note to view')
+    parser.add_argument('--range', type=parse_byte_range, metavar='START:END',
+                        help='Only save bytes START (inclusive) to END (exclusive) of the payload, e.g. 0:1048576 or 5000000:')
+    parser.add_argument('--output',
+                        help='Write the payload here instead of note_content/note_<id>.<ext> (- writes it to stdout)')
+    export = parser.add_argument_group('bulk export', 'Export the current version of every note matching all given filters')
+    export.add_argument('--ids', help='Comma-separated note IDs')
+    export.add_argument('--ids-file', help='File with one note ID per line')
+    export.add_argument('--encounter', help='Only notes of this encounter')
+    export.add_argument('--category', help='Only notes with this note_category code')
+    export.add_argument('--from', dest='date_from', help='Only notes dated on or after YYYY-MM-DD')
+    export.add_argument('--to', dest='date_to', help='Only notes dated on or before YYYY-MM-DD')
+    export.add_argument('--all', action='store_true', help='Export every note')
+    export.add_argument('--output-dir', default='note_content', help='Directory for exported files (default: note_content)')
+    export.add_argument('--archive',
+                        help='Pack exported files into this .zip, .tar or .tar.gz instead (- streams a tar to stdout)')
+    export.add_argument('--workers', type=int, default=DEFAULT_EXPORT_WORKERS,
+                        help=f'Threads decoding and writing files (default: {DEFAULT_EXPORT_WORKERS})')
+    export.add_argument('--batch-size', type=int, default=DEFAULT_EXPORT_BATCH,
+                        help=f'Notes read per batch (default: {DEFAULT_EXPORT_BATCH})')
     args = parser.parse_args()
+    try:
+        epoch_range(args.date_from, args.date_to)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    note_ids = parse_note_ids(args.ids, args.ids_file)
+    if note_ids or args.encounter or args.category or args.date_from or args.date_to or args.all:
+        # Keep stdout clean when it carries the tar stream
+        log = (lambda message: print(message, file=sys.stderr)) if args.archive == '-' else print
+        _, _, failed = export_notes(note_ids, args.encounter, args.category, args.date_from, args.date_to,
+                                    args.output_dir, args.archive, args.workers, args.batch_size, log)
+        if failed:
+            sys.exit(1)
+        return
+    if args.note_id is None:
+        parser.error('give a note_id to view, or export filters (--ids, --encounter, --category, --from/--to, --all)')
+    
+    start, end = args.range or (0, None)
     
     # Get note content
     note = get_note_content(args.note_id)
@@ -79,39 +345,62 @@ def main():
     if not note:
         return
     
-    print(f"Note ID: {note['note_id']}")
-    print(f"Note Type: {note['note_type']}")
-    print(f"Content Type: {note['content_type'] or 'Not specified'}")
+    # With --output - the payload goes to stdout, so the details go to stderr
+    out = sys.stderr if args.output == '-' else sys.stdout
+    print(f"Note ID: {note['note_id']}", file=out)
+    print(f"Note Type: {note['note_type']}", file=out)
+    print(f"Content Type: {note['content_type'] or 'Not specified'}", file=out)
     
     # Check if content is a URL reference
-    if note['note_text'].startswith('URL:'):
-        print(f"Content: {note['note_text']}")
-        print("Note: This content is a URL reference and has not been fetched.")
+    if note['note_text'] and note['note_text'].startswith('URL:'):
+        print(f"Content: {note['note_text']}", file=out)
+        print("Note: This content is a URL reference and has not been fetched.", file=out)
     elif note['content_type']:
-        # Try to decode base64 content
+        # Copied from note_blob in chunks, so a large scan never has to fit in memory
+        conn = get_db_connection()
+        reader = None
         try:
-            binary_content = base64.b64decode(note['note_text'])
+            reader, size = open_payload(conn, note['version_id'])
+            if reader is None:
+                print("Note: This version has no stored content.", file=out)
+                return
+            print(f"Size: {size} bytes", file=out)
             
             # For text content, display it
-            if note['content_type'] in ['text/plain', 'text/html', 'text/xml']:
-                try:
-                    text_content = binary_content.decode('utf-8')
-                    print("\nContent Preview:")
-                    print(text_content[:500] + ("..." if len(text_content) > 500 else ""))
-                except UnicodeDecodeError:
-                    print("\nContent is binary and cannot be displayed as text.")
-            else:
-                print("\nContent is binary and cannot be displayed directly.")
+            if args.output != '-':
+                if note['content_type'] in ['text/plain', 'text/html', 'text/xml']:
+                    text_content = preview_text(reader, size)
+                    if text_content is not None:
+                        print("\nContent Preview:")
+                        print(text_content)
+                    else:
+                        print("\nContent is binary and cannot be displayed as text.")
+                else:
+                    print("\nContent is binary and cannot be displayed directly.")
             
             # Save content to file
-            filename = save_content_to_file(binary_content, note['content_type'], note['note_id'])
-            print(f"\nContent saved to: {filename}")
+            if args.output == '-':
+                copied = copy_payload(reader, size, sys.stdout.buffer, start, end)
+                sys.stdout.buffer.flush()
+                print(f"Wrote {copied} bytes to stdout", file=out)
+            elif args.output:
+                with open(args.output, 'wb') as f:
+                    copied = copy_payload(reader, size, f, start, end)
+                print(f"\nContent saved to: {args.output} ({copied} bytes)")
+            else:
+                filename = save_content_to_file(reader, size, note['content_type'], note['note_id'], start=start, end=end)
+                print(f"\nContent saved to: {filename}")
         except Exception as e:
-            print(f"Error decoding content: {e}")
+            print(f"Error reading content: {e}", file=out)
+        finally:
+            if reader is not None:
+                reader.close()
+            conn.close()
     else:
         # Display text content
+        note_text = note['note_text'] or ''
         print("\nContent:")
-        print(note['note_text'][:500] + ("..." if len(note['note_text']) > 500 else ""))
+        print(note_text[:500] + ("..." if len(note_text) > 500 else ""))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file